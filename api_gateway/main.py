@@ -1,12 +1,28 @@
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
+from jose import JWTError, jwt
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+import asyncio
+import base64
+import hashlib
+import hmac
 import httpx
+import json
 import os
+import random
+import sys
+import time
+import redis.asyncio as aioredis
+from common import metrics
 
 # ==========================================
 # CONFIGURATION
 # ==========================================
+# Nhiều replica: liệt kê cách nhau bởi dấu phẩy (vd: http://order_1:8000,http://order_2:8000)
 SERVICE_URLS = {
     "user": os.getenv("USER_SERVICE_URL", "http://user_service:8000"),
     "product": os.getenv("PRODUCT_SERVICE_URL", "http://product_service:8000"),
@@ -14,6 +30,91 @@ SERVICE_URLS = {
     "payment": os.getenv("PAYMENT_SERVICE_URL", "http://payment_service:8000"),
 }
 
+# Upstream connection pools (override per service: USER_UPSTREAM_MAX_CONNECTIONS, ...)
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_MAX_QUEUE = int(os.getenv("UPSTREAM_MAX_QUEUE", "200"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "5"))
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "30"))
+# SSE (Accept: text/event-stream) dùng pool riêng: mỗi client idle giữ một connection suốt
+# thời gian stream, không được chiếm slot của request thường
+UPSTREAM_STREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_STREAM_MAX_CONNECTIONS", "5000"))
+
+# Load balancing giữa các replica: round_robin | least_outstanding
+UPSTREAM_LB_STRATEGY = os.getenv("UPSTREAM_LB_STRATEGY", "round_robin")
+# Passive ejection: loại replica sau N lỗi liên tiếp trong M giây
+UPSTREAM_EJECT_FAILURES = int(os.getenv("UPSTREAM_EJECT_FAILURES", "3"))
+UPSTREAM_EJECT_SECONDS = float(os.getenv("UPSTREAM_EJECT_SECONDS", "30"))
+# Status coi như upstream lỗi (ejection, circuit breaker, retry)
+UPSTREAM_FAILURE_STATUS = {502, 503, 504}
+
+# Circuit breaker mỗi service (override: ORDER_UPSTREAM_BREAKER_ERROR_RATE, ...)
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "2"))
+BREAKER_SLOW_CALL_RATE = float(os.getenv("BREAKER_SLOW_CALL_RATE", "0.5"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "15"))
+BREAKER_HALF_OPEN_CALLS = int(os.getenv("BREAKER_HALF_OPEN_CALLS", "3"))
+
+# Retry (chỉ GET) với full jitter, hedged request cho route có "hedge": true
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv("UPSTREAM_RETRY_BACKOFF", "0.05"))
+UPSTREAM_HEDGE_DELAY = float(os.getenv("UPSTREAM_HEDGE_DELAY", "0.15"))
+
+# Response cache cho public catalog reads (route có "cache_ttl")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+RESPONSE_CACHE_MAX_BODY = int(os.getenv("RESPONSE_CACHE_MAX_BODY", str(2 * 1024 * 1024)))
+RESPONSE_CACHE_STALE_TTL = float(os.getenv("RESPONSE_CACHE_STALE_TTL", "60"))
+RESPONSE_CACHE_REDIS_URL = os.getenv("RESPONSE_CACHE_REDIS_URL", "")  # rỗng = chỉ cache in-memory
+
+# Gộp các GET giống hệt nhau đang chạy thành một request upstream
+REQUEST_COALESCING = os.getenv("REQUEST_COALESCING", "true").lower() == "true"
+COALESCE_VARY_HEADERS = [
+    h.strip().lower() for h in os.getenv("COALESCE_VARY_HEADERS", "accept,accept-language").split(",") if h.strip()
+]
+
+# Access log: JSON lines, ghi bởi background writer (không chặn request)
+ACCESS_LOG_ENABLED = os.getenv("ACCESS_LOG_ENABLED", "true").lower() == "true"
+ACCESS_LOG_PATH = os.getenv("ACCESS_LOG_PATH", "")  # rỗng = stdout
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv("ACCESS_LOG_SAMPLE_RATE", "1.0"))  # lỗi (>= 500) luôn được ghi
+ACCESS_LOG_QUEUE_SIZE = int(os.getenv("ACCESS_LOG_QUEUE_SIZE", "10000"))
+ACCESS_LOG_HEADERS = os.getenv("ACCESS_LOG_HEADERS", "false").lower() == "true"
+ACCESS_LOG_REDACT = {
+    f.strip().lower() for f in os.getenv(
+        "ACCESS_LOG_REDACT",
+        "authorization,cookie,set-cookie,x-user-identity,x-user-identity-signature,password,token,access_token"
+    ).split(",") if f.strip()
+}
+
+# Route table: JSON file (list các route như DEFAULT_ROUTES), mặc định dùng DEFAULT_ROUTES
+GATEWAY_ROUTES_FILE = os.getenv("GATEWAY_ROUTES_FILE")
+DEFAULT_ROUTES = [
+    # [CRITICAL] Auth routes (No /api prefix) - giữ nguyên path
+    {"prefix": "/token", "service": "user", "rewrite": "/token", "exact": True},
+    {"prefix": "/register", "service": "user", "rewrite": "/register", "exact": True},
+    {"prefix": "/verify-token", "service": "user", "rewrite": "/verify-token", "exact": True},
+    # Static files: /api/products/static/x.jpg → /static/x.jpg
+    {"prefix": "/api/products/static", "service": "product", "rewrite": "/static", "public": True, "cache_ttl": 3600},
+    # Standard routes: strip /api/{service}
+    {"prefix": "/api/users/restaurants", "service": "user", "rewrite": "/restaurants",
+     "public": True, "hedge": True, "cache_ttl": 60},
+    {"prefix": "/api/users", "service": "user"},
+    {"prefix": "/api/products", "service": "product", "public": True, "hedge": True, "cache_ttl": 30},
+    {"prefix": "/api/orders", "service": "order"},
+    {"prefix": "/api/payments", "service": "payment"},
+]
+
+# Edge auth - cùng secret/algorithm với user_service.create_access_token
+JWT_SECRET = os.getenv("JWT_SECRET", "secret")
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+IDENTITY_SECRET = os.getenv("IDENTITY_SECRET", JWT_SECRET)
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", "300"))
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "10000"))
+IDENTITY_HEADER = "x-user-identity"
+IDENTITY_SIGNATURE_HEADER = "x-user-identity-signature"
+
 # ==========================================
 # APP SETUP
 # ==========================================
@@ -35,162 +136,951 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # ==========================================
-# ROUTING LOGIC
+# UPSTREAM POOLS
 # ==========================================
 
-def get_service_url(path: str) -> str:
+def upstream_setting(name: str, key: str, default):
+    """Đọc cấu hình riêng cho từng upstream, fallback về giá trị chung"""
+    value = os.getenv(f"{name.upper()}_UPSTREAM_{key}")
+    return type(default)(value) if value is not None else default
+
+class CircuitBreaker:
     """
-    Xác định service dựa trên path
+    Circuit breaker cho một service: closed -> open -> half-open -> closed.
     
-    CRITICAL ROUTES (No /api prefix):
-    - /token → User Service
-    - /register → User Service  
-    - /verify-token → User Service
+    - closed: ghi nhận kết quả các call gần nhất; tỉ lệ lỗi hoặc tỉ lệ call chậm
+      vượt ngưỡng thì chuyển open.
+    - open: từ chối ngay (gateway trả 503) trong open_seconds.
+    - half-open: cho tối đa half_open_calls request thử; tất cả thành công thì
+      closed, một lỗi thì open lại.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str):
+        self.name = name
+        self.min_calls = upstream_setting(name, "BREAKER_MIN_CALLS", BREAKER_MIN_CALLS)
+        self.error_rate = upstream_setting(name, "BREAKER_ERROR_RATE", BREAKER_ERROR_RATE)
+        self.slow_call_seconds = upstream_setting(name, "BREAKER_SLOW_CALL_SECONDS", BREAKER_SLOW_CALL_SECONDS)
+        self.slow_call_rate = upstream_setting(name, "BREAKER_SLOW_CALL_RATE", BREAKER_SLOW_CALL_RATE)
+        self.open_seconds = upstream_setting(name, "BREAKER_OPEN_SECONDS", BREAKER_OPEN_SECONDS)
+        self.half_open_calls = upstream_setting(name, "BREAKER_HALF_OPEN_CALLS", BREAKER_HALF_OPEN_CALLS)
+        # (ok, slow) của các call gần nhất
+        self.calls = deque(maxlen=upstream_setting(name, "BREAKER_WINDOW", BREAKER_WINDOW))
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.trial_inflight = 0
+        self.trial_successes = 0
+
+    def allow(self) -> bool:
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                return False
+            self.state = self.HALF_OPEN
+            self.trial_inflight = 0
+            self.trial_successes = 0
+        if self.state == self.HALF_OPEN:
+            if self.trial_inflight >= self.half_open_calls:
+                return False
+            self.trial_inflight += 1
+        return True
+
+    def cancel(self):
+        """Call đã được allow() nhưng không chạy tới cùng (bị huỷ / không lấy được slot)"""
+        if self.state == self.HALF_OPEN:
+            self.trial_inflight = max(0, self.trial_inflight - 1)
+
+    def record(self, ok: bool, latency: float):
+        slow = latency >= self.slow_call_seconds
+        if self.state == self.HALF_OPEN:
+            self.trial_inflight = max(0, self.trial_inflight - 1)
+            if not ok or slow:
+                self._open()
+                return
+            self.trial_successes += 1
+            if self.trial_successes >= self.half_open_calls:
+                self.state = self.CLOSED
+                self.calls.clear()
+                print(f"✅ Circuit closed: {self.name}")
+            return
+        if self.state == self.OPEN:
+            return
+        
+        self.calls.append((ok, slow))
+        if len(self.calls) < self.min_calls:
+            return
+        errors = sum(1 for call_ok, _ in self.calls if not call_ok)
+        slow_calls = sum(1 for _, call_slow in self.calls if call_slow)
+        if errors / len(self.calls) >= self.error_rate or slow_calls / len(self.calls) >= self.slow_call_rate:
+            self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.calls.clear()
+        print(f"⚠️ Circuit opened: {self.name}")
+
+    def snapshot(self) -> dict:
+        calls = len(self.calls)
+        return {
+            "state": self.state,
+            "calls": calls,
+            "error_rate": round(sum(1 for ok, _ in self.calls if not ok) / calls, 3) if calls else 0.0,
+            "slow_rate": round(sum(1 for _, slow in self.calls if slow) / calls, 3) if calls else 0.0,
+            "retry_in": round(max(0.0, self.open_seconds - (time.monotonic() - self.opened_at)), 1)
+                        if self.state == self.OPEN else None,
+        }
+
+class UpstreamPool:
+    """
+    Một replica của upstream, với một httpx.AsyncClient dùng chung
+    (keep-alive + connection reuse).
     
-    STANDARD ROUTES:
-    - /api/users/* → User Service
-    - /api/products/* → Product Service
-    - /api/orders/* → Order Service
-    - /api/payments/* → Payment Service
+    Số request đang chờ bị giới hạn ở max_connections + max_queue; vượt quá thì
+    gateway trả 503 ngay thay vì xếp hàng vô hạn.
     """
+
+    def __init__(self, name: str, base_url: str, stream: bool = False):
+        self.name = name
+        self.base_url = base_url
+        if stream:
+            # Stream dài, idle lâu: không xếp hàng, không timeout đọc
+            max_connections = upstream_setting(name, "STREAM_MAX_CONNECTIONS", UPSTREAM_STREAM_MAX_CONNECTIONS)
+            max_queue = 0
+            read_timeout = None
+        else:
+            max_connections = upstream_setting(name, "MAX_CONNECTIONS", UPSTREAM_MAX_CONNECTIONS)
+            max_queue = upstream_setting(name, "MAX_QUEUE", UPSTREAM_MAX_QUEUE)
+            read_timeout = upstream_setting(name, "TIMEOUT", UPSTREAM_TIMEOUT)
+        max_keepalive = upstream_setting(name, "MAX_KEEPALIVE", UPSTREAM_MAX_KEEPALIVE)
+        self.max_pending = max_connections + max_queue
+        self.pending = 0
+        self.eject_failures = upstream_setting(name, "EJECT_FAILURES", UPSTREAM_EJECT_FAILURES)
+        self.eject_seconds = upstream_setting(name, "EJECT_SECONDS", UPSTREAM_EJECT_SECONDS)
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive,
+                keepalive_expiry=upstream_setting(name, "KEEPALIVE_EXPIRY", UPSTREAM_KEEPALIVE_EXPIRY),
+            ),
+            timeout=httpx.Timeout(
+                upstream_setting(name, "TIMEOUT", UPSTREAM_TIMEOUT),
+                read=read_timeout,
+                pool=upstream_setting(name, "POOL_TIMEOUT", UPSTREAM_POOL_TIMEOUT),
+            ),
+            event_hooks=metrics.upstream_hooks(name),
+        )
+
+    @property
+    def ejected(self) -> bool:
+        return self.ejected_until > time.monotonic()
+
+    def try_acquire(self) -> bool:
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+        return True
+
+    def release(self):
+        self.pending -= 1
+
+    def record_success(self):
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        """Passive health check: lỗi liên tiếp quá ngưỡng thì tạm loại replica"""
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.eject_failures:
+            self.consecutive_failures = 0
+            self.ejected_until = time.monotonic() + self.eject_seconds
+            print(f"⚠️ Ejected {self.name} replica {self.base_url} for {self.eject_seconds}s")
+
+    async def aclose(self):
+        await self.client.aclose()
+
+class UpstreamGroup:
+    """Các replica của một service + load balancing"""
+
+    def __init__(self, name: str, urls: List[str]):
+        self.name = name
+        self.replicas = [UpstreamPool(name, url) for url in urls]
+        # Pool riêng cho SSE (không giới hạn chung với request thường)
+        self.stream_replicas = [UpstreamPool(name, url, stream=True) for url in urls]
+        self.strategy = upstream_setting(name, "LB_STRATEGY", UPSTREAM_LB_STRATEGY)
+        self.breaker = CircuitBreaker(name)
+        self._next = 0
+
+    def pick(self, exclude: Optional[UpstreamPool] = None, stream: bool = False) -> UpstreamPool:
+        replicas = self.stream_replicas if stream else self.replicas
+        # Nếu mọi replica đều bị loại thì vẫn thử (fail-open) thay vì trả lỗi ngay
+        candidates = [r for r in replicas if not r.ejected] or replicas
+        if exclude is not None and len(candidates) > 1:
+            candidates = [r for r in candidates if r is not exclude]
+        if self.strategy == "least_outstanding":
+            return min(candidates, key=lambda r: r.pending)
+        pool = candidates[self._next % len(candidates)]
+        self._next += 1
+        return pool
+
+    async def aclose(self):
+        await asyncio.gather(*(pool.aclose() for pool in self.replicas + self.stream_replicas))
+
+upstreams: Dict[str, UpstreamGroup] = {}
+
+@app.on_event("startup")
+async def open_upstreams():
+    global route_table
+    for name, urls in SERVICE_URLS.items():
+        upstreams[name] = UpstreamGroup(name, [url.strip() for url in urls.split(",") if url.strip()])
+    route_table = RouteTable([Route(**entry) for entry in load_routes()])
+
+@app.on_event("startup")
+async def start_access_log():
+    access_log.start()
+
+@app.on_event("shutdown")
+async def stop_access_log():
+    await access_log.stop()
+
+@app.on_event("shutdown")
+async def close_upstreams():
+    await asyncio.gather(*(group.aclose() for group in upstreams.values()))
+    upstreams.clear()
+    await response_cache.aclose()
+
+# ==========================================
+# EDGE AUTH
+# ==========================================
+
+class IdentityCache:
+    """LRU cache có TTL: sha256(token) -> (expires_at, identity headers)"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: dict, expires_at: float):
+        self._entries[key] = (min(expires_at, time.time() + self.ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+identity_cache = IdentityCache(IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL)
+
+def sign_identity(identity: dict) -> dict:
+    """
+    Đóng gói identity thành header cho downstream:
+    - x-user-identity: base64url(JSON)
+    - x-user-identity-signature: HMAC-SHA256(IDENTITY_SECRET, x-user-identity)
+    """
+    payload = base64.urlsafe_b64encode(
+        json.dumps(identity, separators=(",", ":"), sort_keys=True).encode()
+    ).decode()
+    signature = hmac.new(IDENTITY_SECRET.encode(), payload.encode(), hashlib.sha256).hexdigest()
+    return {IDENTITY_HEADER: payload, IDENTITY_SIGNATURE_HEADER: signature}
+
+def resolve_identity(authorization: Optional[str]) -> Optional[dict]:
+    """
+    Verify JWT ngay tại gateway (không gọi /verify-token).
+    Trả về identity headers đã ký, hoặc None nếu không có/không hợp lệ token -
+    khi đó request vẫn được forward và downstream tự quyết định.
+    """
+    if not authorization or not authorization.startswith("Bearer "):
+        return None
     
-    # [CRITICAL] Special auth routes
-    if path in ["/token", "/register", "/verify-token"]:
-        print(f"🔑 Auth route detected: {path} → User Service")
-        return SERVICE_URLS["user"]
+    token = authorization.split(" ")[1]
+    key = hashlib.sha256(token.encode()).hexdigest()
+    cached = identity_cache.get(key)
+    if cached is not None:
+        return cached
     
-    # Static files
-    if path.startswith("/api/products/static"):
-        return SERVICE_URLS["product"]
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except JWTError:
+        return None
     
-    # Standard API routes
-    if path.startswith("/api/users"):
-        return SERVICE_URLS["user"]
-    elif path.startswith("/api/products"):
-        return SERVICE_URLS["product"]
-    elif path.startswith("/api/orders"):
-        return SERVICE_URLS["order"]
-    elif path.startswith("/api/payments"):
-        return SERVICE_URLS["payment"]
-    else:
-        raise HTTPException(status_code=404, detail=f"No service found for path: {path}")
+    expires_at = float(payload.get("exp", time.time() + IDENTITY_CACHE_TTL))
+    identity = {
+        "user_id": payload.get("user_id"),
+        "username": payload.get("sub"),
+        "role": payload.get("role"),
+        "exp": int(expires_at),
+    }
+    signed = sign_identity(identity)
+    identity_cache.put(key, signed, expires_at)
+    return signed
+
+# ==========================================
+# ROUTING LOGIC
+# ==========================================
 
-def strip_api_prefix(path: str) -> str:
+class Route:
     """
-    Chuyển đổi path từ Gateway → Service
-    
-    Examples:
-    - /token → /token (giữ nguyên)
-    - /register → /register (giữ nguyên)
-    - /api/users/restaurants → /restaurants
-    - /api/products/static/images/x.jpg → /static/images/x.jpg
+    Một dòng trong route table.
+    Path gửi tới service = rewrite + phần còn lại sau prefix
+    (rewrite mặc định "" tức là strip prefix).
+    public: GET không phụ thuộc user (được cache kể cả khi có credential - credential bị bỏ).
+    cache_ttl > 0: GET được cache ở gateway - route không public chỉ cache request không credential.
     """
-    
-    # Special routes: keep as-is
-    if path in ["/token", "/register", "/verify-token"]:
+
+    def __init__(self, prefix: str, service: str, rewrite: str = "", exact: bool = False,
+                 public: bool = False, hedge: bool = False, cache_ttl: float = 0,
+                 cache_stale: Optional[float] = None):
+        if service not in upstreams:
+            raise ValueError(f"Route {prefix} points to unknown service: {service}")
+        self.prefix = prefix.rstrip("/") or "/"
+        self.service = service
+        self.rewrite = rewrite.rstrip("/")
+        self.exact = exact
+        self.public = public
+        self.hedge = hedge
+        self.cache_ttl = cache_ttl
+        self.cache_stale = RESPONSE_CACHE_STALE_TTL if cache_stale is None else cache_stale
+
+    def target_path(self, rest: List[str], trailing_slash: bool = False) -> str:
+        """rewrite + các segment còn lại sau prefix (segment rỗng của "//" đã bị bỏ khi match)"""
+        path = self.rewrite + "".join(f"/{segment}" for segment in rest)
+        if rest and trailing_slash:
+            path += "/"
+        return path or "/"
+
+class RouteTrieNode:
+    __slots__ = ("children", "route")
+
+    def __init__(self):
+        self.children: Dict[str, "RouteTrieNode"] = {}
+        self.route: Optional[Route] = None
+
+class RouteTable:
+    """
+    Route table compile thành trie theo từng segment của path.
+    Một lần lookup trả về (route, path đã rewrite), ưu tiên prefix dài nhất;
+    route "/" (nếu có) là fallback cuối cùng.
+    """
+
+    def __init__(self, routes: List[Route]):
+        self.routes = routes
+        self.root = RouteTrieNode()
+        for route in routes:
+            node = self.root
+            for segment in self._segments(route.prefix):
+                node = node.children.setdefault(segment, RouteTrieNode())
+            node.route = route
+
+    @staticmethod
+    def _segments(path: str) -> List[str]:
+        return [segment for segment in path.split("/") if segment]
+
+    @staticmethod
+    def _accept(route: Optional[Route], path: str) -> Optional[Route]:
+        if route is not None and (not route.exact or path == route.prefix):
+            return route
+        return None
+
+    def match(self, path: str) -> Optional[Tuple[Route, str]]:
+        segments = self._segments(path)
+        best, best_depth = self._accept(self.root.route, path), 0
+        node = self.root
+        for depth, segment in enumerate(segments, start=1):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            route = self._accept(node.route, path)
+            if route is not None:
+                best, best_depth = route, depth
+        if best is None:
+            return None
+        # Path upstream dựng lại từ segment đã chuẩn hoá, không cắt chuỗi gốc theo len(prefix)
+        return best, best.target_path(segments[best_depth:], path.endswith("/"))
+
+def load_routes() -> List[dict]:
+    if GATEWAY_ROUTES_FILE:
+        with open(GATEWAY_ROUTES_FILE) as f:
+            return json.load(f)
+    return DEFAULT_ROUTES
+
+route_table: Optional[RouteTable] = None
+
+def route_label(scope) -> str:
+    """Metrics label: prefix của route trong route table (proxy là catch-all)"""
+    path = scope["path"]
+    if path in ("/", "/health", metrics.METRICS_PATH):
         return path
-    
-    # Static files: strip /api/products
-    if path.startswith("/api/products/static"):
-        return path.replace("/api/products", "", 1)
-    
-    # Standard routes: strip /api/{service}
-    if path.startswith("/api/users"):
-        stripped = path.replace("/api/users", "", 1)
-        return stripped if stripped else "/"
-    elif path.startswith("/api/products"):
-        stripped = path.replace("/api/products", "", 1)
-        return stripped if stripped else "/"
-    elif path.startswith("/api/orders"):
-        stripped = path.replace("/api/orders", "", 1)
-        return stripped if stripped else "/"
-    elif path.startswith("/api/payments"):
-        stripped = path.replace("/api/payments", "", 1)
-        return stripped if stripped else "/"
-    
-    return path
+    match = route_table.match(path) if route_table else None
+    return match[0].prefix if match else metrics.UNMATCHED_ROUTE
+
+# Đăng ký /metrics trước proxy catch-all
+metrics.install(app, route_label=route_label)
 
 # ==========================================
-# PROXY ENDPOINT
+# UPSTREAM CALLS (circuit breaker, retry, hedging)
 # ==========================================
 
-@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
-async def proxy(path: str, request: Request):
-    """Forward requests to appropriate service"""
-    
-    full_path = f"/{path}"
-    
-    # DEBUG logging
-    print("=" * 60)
-    print(f"📥 GATEWAY REQUEST:")
-    print(f"   Method: {request.method}")
-    print(f"   Path: {full_path}")
-    print(f"   Headers: {dict(request.headers)}")
-    print(f"   Query: {dict(request.query_params)}")
+class UpstreamUnavailable(Exception):
+    """Không gửi request đi được: circuit open hoặc hàng đợi upstream đầy"""
+
+async def send_once(group: UpstreamGroup, pool: UpstreamPool, method: str, path: str,
+                    headers: dict, params: dict, content) -> Tuple[UpstreamPool, httpx.Response]:
+    """
+    Gửi một request tới một replica (stream=True). Slot của pool được giữ
+    cho tới khi gọi close_upstream(pool, response).
+    """
+    if not group.breaker.allow():
+        raise UpstreamUnavailable(f"Circuit open: {group.name}")
+    if not pool.try_acquire():
+        group.breaker.cancel()
+        raise UpstreamUnavailable(f"Service overloaded: {group.name}")
     
-    # 1. Determine service
+    started = time.monotonic()
     try:
-        service_url = get_service_url(full_path)
-        print(f"✅ Service: {service_url}")
-    except HTTPException as e:
-        print(f"❌ No service found for: {full_path}")
-        return JSONResponse(
-            status_code=e.status_code,
-            content={"error": str(e.detail)}
+        upstream_request = pool.client.build_request(
+            method=method,
+            url=path,
+            headers=headers,
+            params=params,
+            content=content,
         )
+        response = await pool.client.send(upstream_request, stream=True)
+    except httpx.RequestError:
+        pool.release()
+        pool.record_failure()
+        group.breaker.record(False, time.monotonic() - started)
+        metrics.observe_upstream(group.name, method, "error", time.monotonic() - started)
+        raise
+    except BaseException:
+        # Bị huỷ (request hedge thua cuộc / client disconnect)
+        pool.release()
+        group.breaker.cancel()
+        raise
     
-    # 2. Build target URL
-    target_path = strip_api_prefix(full_path)
-    target_url = f"{service_url}{target_path}"
-    print(f"🎯 Target URL: {target_url}")
+    failed = response.status_code in UPSTREAM_FAILURE_STATUS
+    if failed:
+        pool.record_failure()
+    else:
+        pool.record_success()
+    group.breaker.record(not failed, time.monotonic() - started)
+    return pool, response
+
+async def close_upstream(pool: UpstreamPool, response: httpx.Response):
+    await response.aclose()
+    pool.release()
+
+async def discard_upstreams(tasks: list):
+    """Huỷ các request hedge thua cuộc; bản nào đã có response thì đóng để trả slot của pool"""
+    for task in tasks:
+        task.cancel()
+    await asyncio.wait(tasks)
+    for task in tasks:
+        if task.cancelled() or task.exception() is not None:
+            continue
+        try:
+            await close_upstream(*task.result())
+        except Exception:
+            pass
+
+async def send_hedged(group: UpstreamGroup, path: str, headers: dict, params: dict) -> Tuple[UpstreamPool, httpx.Response]:
+    """
+    Hedged GET: nếu replica đầu chưa trả header sau UPSTREAM_HEDGE_DELAY thì gửi
+    thêm một bản tới replica khác; lấy kết quả về trước, huỷ/đóng bản còn lại.
+    Caller bị huỷ giữa chừng -> huỷ/đóng mọi bản (kể cả bản đã thắng) rồi raise CancelledError.
+    """
+    primary = group.pick()
+    tasks = [asyncio.create_task(send_once(group, primary, "GET", path, headers, params, None))]
+    winner: Optional[asyncio.Task] = None
+    error: Optional[BaseException] = None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=UPSTREAM_HEDGE_DELAY)
+        if not done:
+            tasks.append(asyncio.create_task(
+                send_once(group, group.pick(exclude=primary), "GET", path, headers, params, None)
+            ))
+        pending = set(tasks)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and winner is None:
+                    winner = task
+                elif task.exception() is not None:
+                    error = task.exception()
+    except BaseException:
+        winner = None  # caller bị huỷ: không trả response nào
+        raise
+    finally:
+        losers = [task for task in tasks if task is not winner]
+        if losers:
+            # Dọn trong task riêng: caller bị huỷ lúc này thì việc dọn vẫn chạy hết
+            try:
+                await asyncio.shield(asyncio.create_task(discard_upstreams(losers)))
+            except asyncio.CancelledError:
+                if winner is not None:
+                    asyncio.create_task(discard_upstreams([winner]))
+                raise
+    if winner is None:
+        raise error
+    return winner.result()
+
+async def forward(route: Route, method: str, path: str, headers: dict, params: dict,
+                  content, stream: bool = False) -> Tuple[UpstreamPool, httpx.Response]:
+    """
+    Gửi request tới service của route; GET được retry (full jitter) và hedge.
+    stream=True (SSE): pool stream riêng của service, không retry / hedge.
+    """
+    group = upstreams[route.service]
+    if stream:
+        return await send_once(group, group.pick(stream=True), method, path, headers, params, content)
+    if method != "GET":
+        return await send_once(group, group.pick(), method, path, headers, params, content)
     
-    # 3. Copy headers (exclude host, content-length)
-    headers = {
-        key: value for key, value in request.headers.items() 
-        if key.lower() not in ["host", "content-length"]
-    }
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        last_attempt = attempt == UPSTREAM_RETRIES
+        try:
+            if route.hedge:
+                pool, response = await send_hedged(group, path, headers, params)
+            else:
+                pool, response = await send_once(group, group.pick(), method, path, headers, params, None)
+        except httpx.RequestError:
+            if last_attempt:
+                raise
+        else:
+            if last_attempt or response.status_code not in UPSTREAM_FAILURE_STATUS:
+                return pool, response
+            await close_upstream(pool, response)
+        await asyncio.sleep(random.uniform(0, UPSTREAM_RETRY_BACKOFF * (2 ** attempt)))
+
+# ==========================================
+# RESPONSE CACHE
+# ==========================================
+
+class SingleFlight:
+    """
+    Gộp các lời gọi cùng key đang chạy: chỉ một task thực sự chạy, các caller
+    khác chờ kết quả của nó. Task chạy độc lập với caller nên một client
+    ngắt kết nối không làm hỏng kết quả của những client còn lại.
+    """
+
+    def __init__(self):
+        self.calls: Dict[str, asyncio.Task] = {}
+
+    def start(self, key: str, fn: Callable[[], Awaitable]) -> asyncio.Task:
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.create_task(fn())
+            self.calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return task
+
+    async def do(self, key: str, fn: Callable[[], Awaitable]):
+        return await asyncio.shield(self.start(key, fn))
+
+    def _done(self, key: str, task: asyncio.Task):
+        self.calls.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # tránh warning "exception was never retrieved"
+
+class CachedResponse:
+    """Response đã buffer: dùng để lưu cache và trả cho mọi request được gộp"""
+
+    __slots__ = ("status_code", "headers", "body", "etag", "stored_at", "fresh_until", "stale_until")
+
+    def __init__(self, status_code: int, headers: dict, body: bytes, etag: str,
+                 stored_at: float, fresh_until: float, stale_until: float):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+        self.stored_at = stored_at
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "status_code": self.status_code,
+            "headers": self.headers,
+            "body": base64.b64encode(self.body).decode(),
+            "etag": self.etag,
+            "stored_at": self.stored_at,
+            "fresh_until": self.fresh_until,
+            "stale_until": self.stale_until,
+        })
+
+    @classmethod
+    def from_json(cls, raw: str) -> "CachedResponse":
+        data = json.loads(raw)
+        data["body"] = base64.b64decode(data["body"])
+        return cls(**data)
+
+class OversizedResponse:
+    """
+    Response quá RESPONSE_CACHE_MAX_BODY: giữ nguyên response upstream đang mở
+    (cùng phần body đã đọc) để một caller stream tiếp thay vì gửi lại request.
+    Không ai nhận trong CLAIM_TIMEOUT giây (mọi waiter đã ngắt) thì tự đóng.
+    """
+
+    CLAIM_TIMEOUT = 5.0
+
+    def __init__(self, pool: UpstreamPool, response: httpx.Response, head: bytes, chunks):
+        self.pool = pool
+        self.response = response
+        self.head = head
+        self.chunks = chunks
+        self.taken = False
+        asyncio.get_running_loop().call_later(self.CLAIM_TIMEOUT, self._discard)
+
+    def take(self) -> bool:
+        """Chỉ caller đầu tiên được stream; các waiter khác tự gửi request riêng"""
+        if self.taken:
+            return False
+        self.taken = True
+        return True
+
+    def _discard(self):
+        if self.take():
+            asyncio.create_task(close_upstream(self.pool, self.response))
+
+    async def _body(self):
+        yield self.head
+        async for chunk in self.chunks:
+            yield chunk
+
+    def to_response(self) -> StreamingResponse:
+        # Body đã được decode (aiter_bytes) nên bỏ content-encoding/length gốc
+        headers = {
+            name: value for name, value in response_headers(self.response).items()
+            if name.lower() not in ("content-encoding", "content-length")
+        }
+        return StreamingResponse(
+            self._body(),
+            status_code=self.response.status_code,
+            headers=headers,
+            background=BackgroundTask(close_upstream, self.pool, self.response),
+        )
+
+class ResponseCache:
+    """LRU in-memory (L1), tuỳ chọn thêm Redis (L2) để chia sẻ giữa các gateway"""
+
+    def __init__(self, max_entries: int, redis_url: str):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._redis = aioredis.from_url(redis_url) if redis_url else None
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+        if self._redis is None:
+            return None
+        try:
+            raw = await self._redis.get(f"gwcache:{key}")
+        except Exception as e:
+            print(f"⚠️ Response cache (redis) read failed: {e}")
+            return None
+        if raw is None:
+            return None
+        entry = CachedResponse.from_json(raw)
+        self._store_local(key, entry)
+        return entry
+
+    async def put(self, key: str, entry: CachedResponse):
+        self._store_local(key, entry)
+        if self._redis is None:
+            return
+        try:
+            ttl = max(1, int(entry.stale_until - time.time()))
+            await self._redis.set(f"gwcache:{key}", entry.to_json(), ex=ttl)
+        except Exception as e:
+            print(f"⚠️ Response cache (redis) write failed: {e}")
+
+    def _store_local(self, key: str, entry: CachedResponse):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def aclose(self):
+        if self._redis is not None:
+            await self._redis.close()
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_REDIS_URL)
+cache_fills = SingleFlight()
+
+# Header không lưu vào cache (body đã được decode, length tính lại khi trả)
+UNCACHED_RESPONSE_HEADERS = {"content-encoding", "content-length", "set-cookie", "etag", "age", "x-cache"}
+
+def cache_key(full_path: str, query_params: dict) -> str:
+    """Key = path + query đã sắp xếp (?b=2&a=1 và ?a=1&b=2 dùng chung entry)"""
+    query = urlencode(sorted(query_params.items()))
+    return f"{full_path}?{query}" if query else full_path
+
+def is_cacheable(response: httpx.Response, body: bytes) -> bool:
+    cache_control = response.headers.get("cache-control", "").lower()
+    return (
+        response.status_code == 200
+        and len(body) <= RESPONSE_CACHE_MAX_BODY
+        and "no-store" not in cache_control
+        and "private" not in cache_control
+        and "set-cookie" not in response.headers
+    )
+
+async def fetch_buffered(route: Route, target_path: str, headers: dict, params: dict,
+                         store_key: Optional[str] = None):
+    """
+    GET upstream và buffer body (để chia sẻ cho nhiều client); lưu vào cache
+    với store_key nếu response hợp lệ.
+    Đọc tối đa RESPONSE_CACHE_MAX_BODY (kể cả response chunked không có content-length);
+    vượt quá thì trả OversizedResponse để caller stream tiếp response đang mở.
+    """
+    pool, response = await forward(route, "GET", target_path, headers, params, None)
+    chunks = response.aiter_bytes()
+    body = bytearray()
+    try:
+        async for chunk in chunks:
+            body += chunk
+            if len(body) > RESPONSE_CACHE_MAX_BODY:
+                return OversizedResponse(pool, response, bytes(body), chunks)
+    except BaseException:
+        await close_upstream(pool, response)
+        raise
+    await close_upstream(pool, response)
+    body = bytes(body)
     
-    # 4. Get query params
-    query_params = dict(request.query_params)
+    now = time.time()
+    entry = CachedResponse(
+        status_code=response.status_code,
+        headers={
+            name: value for name, value in response_headers(response).items()
+            if name.lower() not in UNCACHED_RESPONSE_HEADERS
+        },
+        body=body,
+        etag=response.headers.get("etag") or f'"{hashlib.sha1(body).hexdigest()}"',
+        stored_at=now,
+        fresh_until=now + route.cache_ttl,
+        stale_until=now + route.cache_ttl + route.cache_stale,
+    )
+    if store_key is not None and is_cacheable(response, body):
+        await response_cache.put(store_key, entry)
+    return entry
+
+def public_headers(headers: dict) -> dict:
+    """Header gửi upstream cho response dùng chung: bỏ credential của client"""
+    return {
+        name: value for name, value in headers.items()
+        if name.lower() not in ("authorization", "cookie", IDENTITY_HEADER, IDENTITY_SIGNATURE_HEADER)
+    }
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # So sánh weak: bỏ tiền tố W/
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in tags
+
+def cached_response(entry: CachedResponse, request: Request, cache_status: str) -> Response:
+    headers = dict(entry.headers)
+    headers["x-cache"] = cache_status
+    if entry.status_code == 200:
+        headers["etag"] = entry.etag
+        headers["age"] = str(max(0, int(time.time() - entry.stored_at)))
+        if etag_matches(request.headers.get("if-none-match"), entry.etag):
+            return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, status_code=entry.status_code, headers=headers)
+
+async def serve_cached(route: Route, full_path: str, target_path: str, headers: dict,
+                       params: dict, request: Request) -> Optional[Response]:
+    """
+    GET trên route có cache_ttl:
+    - còn fresh: trả từ cache (HIT), hỗ trợ If-None-Match → 304
+    - stale nhưng trong cửa sổ cache_stale: trả bản cũ (STALE) và refresh ở nền
+    - miss: một request upstream duy nhất cho mọi client cùng key (single-flight)
+    """
+    key = cache_key(full_path, params)
+    # Response public, không phụ thuộc user → không gửi credential của client lên
+    fill_headers = public_headers(headers)
+    fill = lambda: fetch_buffered(route, target_path, fill_headers, params, store_key=key)
     
-    # 5. Get body
-    body = None
-    if request.method in ["POST", "PUT", "PATCH"]:
-        body = await request.body()
-        print(f"📦 Body: {body.decode('utf-8') if body else 'None'}")
+    entry = await response_cache.get(key)
+    now = time.time()
+    if entry is not None and now < entry.fresh_until:
+        return cached_response(entry, request, "HIT")
+    if entry is not None and now < entry.stale_until:
+        cache_fills.start(key, fill)
+        return cached_response(entry, request, "STALE")
     
-    # 6. Forward request
-    async with httpx.AsyncClient(timeout=30.0) as client:
+    entry = await cache_fills.do(key, fill)
+    if isinstance(entry, OversizedResponse):
+        return entry.to_response() if entry.take() else None
+    return cached_response(entry, request, "MISS")
+
+# ==========================================
+# REQUEST COALESCING
+# ==========================================
+coalesced_gets = SingleFlight()
+
+def has_credentials(request: Request) -> bool:
+    return (
+        "authorization" in request.headers
+        or "cookie" in request.headers
+        or "access_token" in request.query_params
+    )
+
+def can_cache(route: Route, request: Request) -> bool:
+    """
+    GET trên route có cache_ttl. Cache gửi upstream không kèm credential nên chỉ dùng
+    khi route public (response không phụ thuộc user) hoặc request không có credential.
+    Cache miss cũng được gộp (single-flight qua cache_fills).
+    """
+    return (
+        request.method == "GET"
+        and bool(route.cache_ttl)
+        and (route.public or not has_credentials(request))
+    )
+
+def is_event_stream(request: Request) -> bool:
+    return "text/event-stream" in request.headers.get("accept", "")
+
+def can_coalesce(route: Route, request: Request) -> bool:
+    """
+    GET không có credential (Authorization, Cookie, access_token) trên route không cache:
+    response của một user không bao giờ được chia cho user khác.
+    SSE (text/event-stream) không bao giờ gộp vì response không kết thúc.
+    """
+    return (
+        REQUEST_COALESCING
+        and request.method == "GET"
+        and not is_event_stream(request)
+        and not has_credentials(request)
+    )
+
+async def serve_coalesced(route: Route, target_path: str, headers: dict, params: dict,
+                          request: Request) -> Optional[Response]:
+    """
+    Các GET giống nhau (service, path, query, vary headers) đang chạy đồng thời
+    dùng chung một request upstream; response được buffer và fan-out cho mọi waiter.
+    """
+    vary = "&".join(f"{name}={request.headers.get(name, '')}" for name in COALESCE_VARY_HEADERS)
+    key = f"{route.service}:{cache_key(target_path, params)}|{vary}"
+    entry = await coalesced_gets.do(
+        key, lambda: fetch_buffered(route, target_path, headers, params)
+    )
+    if isinstance(entry, OversizedResponse):
+        return entry.to_response() if entry.take() else None
+    return Response(content=entry.body, status_code=entry.status_code, headers=entry.headers)
+
+# ==========================================
+# ACCESS LOG
+# ==========================================
+
+class AccessLog:
+    """
+    Access log có cấu trúc (JSON lines).
+    Request chỉ put_nowait vào queue; background task ghi theo batch trong
+    executor nên I/O không chạy trên event loop. Queue đầy thì bỏ record và
+    đếm số record bị bỏ.
+    """
+
+    def __init__(self, path: str, sample_rate: float, max_queue: int):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self._task: Optional[asyncio.Task] = None
+        self._stream = None
+
+    def record(self, entry: dict):
+        if entry["status"] < 500 and random.random() >= self.sample_rate:
+            return
+        try:
+            self.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self):
+        if ACCESS_LOG_ENABLED and self._task is None:
+            self._stream = open(self.path, "a", buffering=1) if self.path else sys.stdout
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
         try:
-            response = await client.request(
-                method=request.method,
-                url=target_url,
-                headers=headers,
-                params=query_params,
-                content=body,
-            )
-            
-            print(f"📤 Response Status: {response.status_code}")
-            print("=" * 60)
-            
-            # Return response
-            return StreamingResponse(
-                response.iter_bytes(),
-                status_code=response.status_code,
-                headers=dict(response.headers),
-                media_type=response.headers.get("content-type")
-            )
-            
-        except httpx.RequestError as e:
-            print(f"❌ Request error: {e}")
-            print("=" * 60)
-            return JSONResponse(
-                status_code=503,
-                content={"error": f"Service unavailable: {str(e)}"}
-            )
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self._flush()  # ghi nốt phần còn trong queue
+        if self._stream is not sys.stdout:
+            self._stream.close()
+
+    async def _run(self):
+        while True:
+            first = await self.queue.get()  # chờ có record, rồi gom cả batch
+            await self._flush([first])
+
+    async def _flush(self, batch: Optional[list] = None):
+        batch = batch or []
+        while not self.queue.empty() and len(batch) < 1000:
+            batch.append(self.queue.get_nowait())
+        if self.dropped:
+            batch.append({"ts": time.time(), "event": "access_log_dropped", "count": self.dropped})
+            self.dropped = 0
+        if not batch:
+            return
+        lines = "".join(json.dumps(entry, separators=(",", ":"), default=str) + "\n" for entry in batch)
+        await asyncio.get_running_loop().run_in_executor(None, self._write, lines)
+
+    def _write(self, lines: str):
+        self._stream.write(lines)
+        self._stream.flush()
+
+access_log = AccessLog(ACCESS_LOG_PATH, ACCESS_LOG_SAMPLE_RATE, ACCESS_LOG_QUEUE_SIZE)
+
+def redact(values) -> dict:
+    return {
+        key: "[REDACTED]" if key.lower() in ACCESS_LOG_REDACT else value
+        for key, value in values.items()
+    }
+
+def log_access(request: Request, response: Response, started: float, fields: dict) -> Response:
+    """Ghi một access log record rồi trả lại response"""
+    if ACCESS_LOG_ENABLED:
+        entry = {
+            "ts": time.time(),
+            "method": request.method,
+            "status": response.status_code,
+            # Với response stream: thời gian tới khi nhận được header upstream
+            "latency_ms": round((time.monotonic() - started) * 1000, 2),
+            "client": request.client.host if request.client else None,
+            "query": redact(request.query_params),
+            **fields,
+        }
+        if ACCESS_LOG_HEADERS:
+            entry["headers"] = redact(request.headers)
+        access_log.record(entry)
+    return response
 
 # ==========================================
 # HEALTH CHECK
@@ -202,37 +1092,144 @@ async def root():
         "service": "API Gateway",
         "status": "running",
         "routes": {
-            "auth": {
-                "/token": "POST - Login (OAuth2 form)",
-                "/register": "POST - Register",
-                "/verify-token": "GET - Verify token"
-            },
-            "api": {
-                "/api/users/*": "User Service",
-                "/api/products/*": "Product Service",
-                "/api/orders/*": "Order Service",
-                "/api/payments/*": "Payment Service"
-            }
+            route.prefix: f"{route.service} → {route.rewrite or '/'}"
+            for route in (route_table.routes if route_table else [])
         }
     }
 
 @app.get("/health")
 async def health_check():
-    """Check service health"""
-    status = {}
-    async with httpx.AsyncClient(timeout=5.0) as client:
-        for name, url in SERVICE_URLS.items():
-            try:
-                response = await client.get(f"{url}/")
-                status[name] = "healthy" if response.status_code == 200 else "unhealthy"
-            except:
-                status[name] = "unreachable"
+    """Check service health (từng replica)"""
+    async def probe(pool: UpstreamPool) -> dict:
+        try:
+            response = await pool.client.get("/", timeout=5.0)
+            status = "healthy" if response.status_code == 200 else "unhealthy"
+        except httpx.HTTPError:
+            status = "unreachable"
+        return {
+            "url": pool.base_url,
+            "status": status,
+            "pending": pool.pending,
+            "ejected": pool.ejected,
+        }
+    
+    async def probe_group(group: UpstreamGroup) -> dict:
+        replicas = await asyncio.gather(*(probe(pool) for pool in group.replicas))
+        healthy = any(r["status"] == "healthy" for r in replicas)
+        return {
+            "status": "healthy" if healthy else "unhealthy",
+            "strategy": group.strategy,
+            "breaker": group.breaker.snapshot(),
+            "replicas": replicas,
+        }
+    
+    names = list(upstreams.keys())
+    results = await asyncio.gather(*(probe_group(upstreams[name]) for name in names))
+    status = dict(zip(names, results))
     
     return {
         "gateway": "healthy",
         "services": status
     }
 
+# ==========================================
+# PROXY ENDPOINT
+# (đăng ký sau cùng để catch-all không che /health)
+# ==========================================
+
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade",
+}
+
+STRIPPED_REQUEST_HEADERS = HOP_BY_HOP_HEADERS | {"host", IDENTITY_HEADER, IDENTITY_SIGNATURE_HEADER}
+
+def response_headers(response: httpx.Response) -> dict:
+    """Header upstream gửi lại client (bỏ hop-by-hop headers)"""
+    return {
+        key: value for key, value in response.headers.items()
+        if key.lower() not in HOP_BY_HOP_HEADERS
+    }
+
+@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
+async def proxy(path: str, request: Request):
+    """Forward requests to appropriate service"""
+    
+    started = time.monotonic()
+    full_path = f"/{path}"
+    log = {"path": full_path}
+    
+    # 1. Determine service + target path (một lần lookup trong route table)
+    match = route_table.match(full_path)
+    if match is None:
+        return log_access(request, JSONResponse(
+            status_code=404,
+            content={"error": f"No service found for path: {full_path}"}
+        ), started, log)
+    route, target_path = match
+    log["service"] = route.service
+    
+    # 2. Copy headers (exclude host + hop-by-hop; content-length giữ lại cho body stream)
+    # Identity headers từ client bị loại bỏ, chỉ gateway mới được set
+    headers = {
+        key: value for key, value in request.headers.items() 
+        if key.lower() not in STRIPPED_REQUEST_HEADERS
+    }
+    identity_headers = resolve_identity(request.headers.get("authorization"))
+    if identity_headers:
+        headers.update(identity_headers)
+    
+    # 3. Get query params
+    query_params = dict(request.query_params)
+    
+    # 4. Body: stream từng chunk lên upstream, không buffer trong gateway
+    body = None
+    if request.method in ["POST", "PUT", "PATCH"]:
+        body = request.stream()
+    
+    # 5. Forward request (response cache cho route có cache_ttl, coalescing cho GET
+    #    không credential trên route còn lại; còn lại pooled client, streamed
+    #    response, breaker/retry/hedge)
+    try:
+        if can_cache(route, request):
+            cached = await serve_cached(route, full_path, target_path, headers, query_params, request)
+            if cached is not None:
+                log["cache"] = cached.headers.get("x-cache")
+                return log_access(request, cached, started, log)
+        elif can_coalesce(route, request):
+            coalesced = await serve_coalesced(route, target_path, headers, query_params, request)
+            if coalesced is not None:
+                log["cache"] = "COALESCED"
+                return log_access(request, coalesced, started, log)
+        pool, response = await forward(
+            route, request.method, target_path, headers, query_params, body,
+            stream=request.method == "GET" and is_event_stream(request),
+        )
+    except UpstreamUnavailable as e:
+        log["error"] = str(e)
+        return log_access(request, JSONResponse(
+            status_code=503,
+            content={"error": str(e)}
+        ), started, log)
+    except httpx.RequestError as e:
+        log["error"] = f"{type(e).__name__}: {e}"
+        return log_access(request, JSONResponse(
+            status_code=503,
+            content={"error": f"Service unavailable: {str(e)}"}
+        ), started, log)
+    
+    log["upstream"] = pool.base_url
+    
+    # Trả raw bytes (giữ nguyên content-encoding). StreamingResponse chỉ đọc chunk
+    # tiếp theo khi client nhận xong chunk trước (backpressure); khi client ngắt
+    # kết nối, stream bị huỷ và background task đóng upstream.
+    return log_access(request, StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        headers=response_headers(response),
+        background=BackgroundTask(close_upstream, pool, response),
+    ), started, log)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
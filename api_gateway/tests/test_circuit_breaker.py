@@ -0,0 +1,85 @@
+from api_gateway.main import CircuitBreaker
+
+
+def make_breaker():
+    breaker = CircuitBreaker("test")
+    breaker.min_calls = 4
+    breaker.error_rate = 0.5
+    breaker.slow_call_seconds = 1.0
+    breaker.slow_call_rate = 0.5
+    breaker.open_seconds = 10
+    breaker.half_open_calls = 2
+    return breaker
+
+
+def expire_open_window(breaker):
+    breaker.opened_at -= breaker.open_seconds
+
+
+def test_stays_closed_below_min_calls():
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record(False, 0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_opens_on_error_rate():
+    breaker = make_breaker()
+    breaker.record(True, 0.1)
+    breaker.record(True, 0.1)
+    breaker.record(False, 0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record(False, 0.1)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_opens_on_slow_call_rate():
+    breaker = make_breaker()
+    for latency in (0.1, 0.1, 2.0, 2.0):
+        breaker.record(True, latency)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_open_limits_trial_calls():
+    breaker = make_breaker()
+    for _ in range(4):
+        breaker.record(False, 0.1)
+    expire_open_window(breaker)
+
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    # Trial bị huỷ thì trả lại chỗ cho request khác
+    breaker.cancel()
+    assert breaker.allow()
+
+
+def test_half_open_closes_after_successful_trials():
+    breaker = make_breaker()
+    for _ in range(4):
+        breaker.record(False, 0.1)
+    expire_open_window(breaker)
+
+    assert breaker.allow() and breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.record(True, 0.1)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.snapshot()["calls"] == 0
+
+
+def test_half_open_failure_reopens():
+    breaker = make_breaker()
+    for _ in range(4):
+        breaker.record(False, 0.1)
+    expire_open_window(breaker)
+
+    assert breaker.allow()
+    breaker.record(False, 0.1)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert breaker.snapshot()["retry_in"] > 0
@@ -0,0 +1,75 @@
+import pytest
+
+from api_gateway.main import Route, RouteTable, upstreams
+
+
+@pytest.fixture(autouse=True)
+def known_services(monkeypatch):
+    for name in ("user", "product", "frontend"):
+        monkeypatch.setitem(upstreams, name, None)
+
+
+def make_table(entries):
+    return RouteTable([Route(**entry) for entry in entries])
+
+
+def test_longest_prefix_wins():
+    table = make_table([
+        {"prefix": "/api/users", "service": "user"},
+        {"prefix": "/api/users/restaurants", "service": "user", "rewrite": "/restaurants"},
+    ])
+    route, target = table.match("/api/users/restaurants/7")
+    assert route.prefix == "/api/users/restaurants"
+    assert target == "/restaurants/7"
+
+    route, target = table.match("/api/users/me")
+    assert route.prefix == "/api/users"
+    assert target == "/me"
+
+
+def test_matches_whole_segments_only():
+    table = make_table([{"prefix": "/api/products", "service": "product"}])
+    assert table.match("/api/productsx") is None
+    assert table.match("/api/products")[1] == "/"
+
+
+def test_exact_route_only_matches_its_path():
+    table = make_table([
+        {"prefix": "/token", "service": "user", "rewrite": "/token", "exact": True},
+    ])
+    assert table.match("/token")[1] == "/token"
+    assert table.match("/token/refresh") is None
+
+
+def test_root_route_is_final_fallback():
+    table = make_table([
+        {"prefix": "/", "service": "frontend"},
+        {"prefix": "/api/products", "service": "product"},
+    ])
+    assert table.match("/api/products/1")[0].service == "product"
+
+    route, target = table.match("/index.html")
+    assert route.service == "frontend"
+    assert target == "/index.html"
+    assert table.match("/")[1] == "/"
+
+
+def test_unknown_service_is_rejected():
+    with pytest.raises(ValueError):
+        Route(prefix="/api/nowhere", service="nowhere")
+
+
+def test_empty_segments_are_normalized_before_rewrite():
+    table = make_table([
+        {"prefix": "/api/orders", "service": "user"},
+        {"prefix": "/api/products/static", "service": "product", "rewrite": "/static"},
+    ])
+    assert table.match("/api//orders/5") == (table.routes[0], "/5")
+    assert table.match("/api/orders//5")[1] == "/5"
+    assert table.match("//api/products/static//a.jpg")[1] == "/static/a.jpg"
+
+
+def test_trailing_slash_is_kept():
+    table = make_table([{"prefix": "/api/orders", "service": "user"}])
+    assert table.match("/api/orders/5/")[1] == "/5/"
+    assert table.match("/api/orders/")[1] == "/"
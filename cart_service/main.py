@@ -7,12 +7,13 @@ from pydantic import BaseModel
 from typing import Optional, List
 from datetime import datetime
 import os
+from common import auth, metrics
+from common.auth import verify_token
 
 # ==========================================
 # CONFIG
 # ==========================================
 DATABASE_URL = os.getenv("DATABASE_URL")
-USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user_service:8000")
 
 # Database
 engine = create_engine(DATABASE_URL, echo=False)
@@ -67,6 +68,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+auth.install(app)
+metrics.install(app, engine=engine)
 
 def get_db():
     db = SessionLocal()
@@ -75,26 +78,6 @@ def get_db():
     finally:
         db.close()
 
-async def verify_token(authorization: str = Header(None)):
-    """Verify JWT token từ User Service"""
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    token = authorization.split(" ")[1]
-    import httpx
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                f"{USER_SERVICE_URL}/verify-token",
-                headers={"Authorization": f"Bearer {token}"},
-                timeout=5.0
-            )
-            if response.status_code == 200:
-                return response.json()
-            raise HTTPException(status_code=401, detail="Invalid token")
-        except:
-            raise HTTPException(status_code=401, detail="Auth failed")
-
 @app.on_event("startup")
 async def startup():
     Base.metadata.create_all(bind=engine)
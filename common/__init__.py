@@ -0,0 +1 @@
+# Shared helpers cho các FastAPI services (copy vào image qua Dockerfile: COPY common ./common)
@@ -0,0 +1,282 @@
+from fastapi import HTTPException
+from jose import JWTError, jwt
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import httpx
+import redis.asyncio as aioredis
+from common import metrics
+
+# ==========================================
+# CONFIGURATION
+# ==========================================
+JWT_SECRET = os.getenv("JWT_SECRET", "secret")
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+IDENTITY_SECRET = os.getenv("IDENTITY_SECRET", JWT_SECRET)
+USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user_service:8000")
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379")
+
+AUTH_PROFILE_CACHE_TTL = float(os.getenv("AUTH_PROFILE_CACHE_TTL", "60"))
+AUTH_PROFILE_CACHE_SIZE = int(os.getenv("AUTH_PROFILE_CACHE_SIZE", "10000"))
+AUTH_INVALIDATION_CHANNEL = os.getenv("AUTH_INVALIDATION_CHANNEL", "auth:user-invalidated")
+
+# Token cho call nội bộ giữa các service (vd drone_service -> order_service)
+SERVICE_ROLE = "service"
+SERVICE_TOKEN_TTL = int(os.getenv("SERVICE_TOKEN_TTL", "3600"))
+
+# Header do api_gateway ký (xem api_gateway/main.py::sign_identity)
+IDENTITY_HEADER = b"x-user-identity"
+IDENTITY_SIGNATURE_HEADER = b"x-user-identity-signature"
+
+# ==========================================
+# PROFILE CACHE
+# ==========================================
+class ProfileCache:
+    """LRU cache có TTL cho profile user (user_id -> dict), thread-safe"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, Tuple[float, dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, profile = entry
+            if expires_at <= time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return profile
+
+    def put(self, user_id: int, profile: dict):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, profile)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+profile_cache = ProfileCache(AUTH_PROFILE_CACHE_SIZE, AUTH_PROFILE_CACHE_TTL)
+
+# ==========================================
+# IDENTITY
+# ==========================================
+# Identity header của request hiện tại, set bởi IdentityMiddleware
+_request_identity: ContextVar[Optional[Tuple[str, str]]] = ContextVar("request_identity", default=None)
+
+class IdentityMiddleware:
+    """ASGI middleware: giữ identity header (do gateway ký) cho verify_token"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        headers = dict(scope.get("headers") or [])
+        identity = headers.get(IDENTITY_HEADER)
+        signature = headers.get(IDENTITY_SIGNATURE_HEADER)
+        token = _request_identity.set(
+            (identity.decode(), signature.decode()) if identity and signature else None
+        )
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_identity.reset(token)
+
+def decode_signed_identity(identity: str, signature: str) -> Optional[dict]:
+    """Kiểm tra chữ ký HMAC + hạn dùng của identity header"""
+    expected = hmac.new(IDENTITY_SECRET.encode(), identity.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, signature):
+        return None
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(identity.encode()))
+    except ValueError:
+        return None
+    if claims.get("exp", 0) <= time.time():
+        return None
+    return claims
+
+def decode_token_claims(authorization: Optional[str]) -> dict:
+    """Lấy {user_id, username, role} từ identity header, hoặc decode JWT tại chỗ"""
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    signed = _request_identity.get()
+    if signed:
+        claims = decode_signed_identity(*signed)
+        if claims:
+            return claims
+    
+    token = authorization.split(" ")[1]
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return {
+        "user_id": payload.get("user_id"),
+        "username": payload.get("sub"),
+        "role": payload.get("role"),
+    }
+
+# ==========================================
+# PROFILE LOOKUP
+# ==========================================
+_user_client: Optional[httpx.AsyncClient] = None
+
+def get_user_client() -> httpx.AsyncClient:
+    global _user_client
+    if _user_client is None:
+        _user_client = httpx.AsyncClient(
+            base_url=USER_SERVICE_URL,
+            timeout=5.0,
+            event_hooks=metrics.upstream_hooks("user"),
+        )
+    return _user_client
+
+async def fetch_user_profile(user_id: int, authorization: str) -> Optional[dict]:
+    """
+    Profile từ cache; cache miss mới gọi user_service /verify-token.
+    Trả None nếu user_service không trả lời được hoặc lỗi phía nó (5xx, 429...)
+    - caller dùng claims của token. Chỉ 401/403/404 mới coi là token không hợp lệ.
+    """
+    profile = profile_cache.get(user_id)
+    if profile is not None:
+        return profile
+    
+    try:
+        response = await get_user_client().get(
+            "/verify-token",
+            headers={"Authorization": authorization}
+        )
+    except httpx.RequestError as e:
+        print(f"⚠️ User service unavailable, using token claims: {e}")
+        return None
+    
+    if response.status_code in (401, 403, 404):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if response.status_code != 200:
+        print(f"⚠️ User service returned {response.status_code}, using token claims")
+        return None
+    
+    profile = response.json()
+    profile_cache.put(user_id, profile)
+    return profile
+
+async def verify_token(authorization: Optional[str]) -> dict:
+    """
+    Thay cho việc gọi /verify-token mỗi request:
+    decode token tại chỗ, profile (role, is_active) lấy từ cache.
+    """
+    claims = decode_token_claims(authorization)
+    if claims.get("role") == SERVICE_ROLE:
+        return claims
+    user_id = claims.get("user_id")
+    if user_id is None:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
+    profile = await fetch_user_profile(user_id, authorization)
+    if profile is None:
+        return claims
+    if not profile.get("is_active", True):
+        raise HTTPException(status_code=403, detail="User account is inactive")
+    return profile
+
+_service_tokens: Dict[str, Tuple[float, str]] = {}
+
+def service_authorization(service_name: str) -> str:
+    """Authorization header (role=service) cho call nội bộ; token được dùng lại tới gần hết hạn"""
+    now = time.time()
+    cached = _service_tokens.get(service_name)
+    if cached is None or cached[0] - 60 <= now:
+        expires_at = now + SERVICE_TOKEN_TTL
+        token = jwt.encode(
+            {"sub": service_name, "role": SERVICE_ROLE, "exp": int(expires_at)},
+            JWT_SECRET,
+            algorithm=JWT_ALGORITHM,
+        )
+        cached = _service_tokens[service_name] = (expires_at, f"Bearer {token}")
+    return cached[1]
+
+# ==========================================
+# INVALIDATION (Redis pub/sub)
+# ==========================================
+_redis: Optional[aioredis.Redis] = None
+_listener_task: Optional[asyncio.Task] = None
+
+def get_redis() -> aioredis.Redis:
+    global _redis
+    if _redis is None:
+        _redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+    return _redis
+
+async def publish_user_invalidation(user_id: int):
+    """Gọi từ user_service khi role / is_active / profile của user thay đổi"""
+    profile_cache.invalidate(user_id)
+    try:
+        await get_redis().publish(AUTH_INVALIDATION_CHANNEL, str(user_id))
+    except Exception as e:
+        print(f"⚠️ Failed to publish auth invalidation for user {user_id}: {e}")
+
+async def _listen_invalidations():
+    while True:
+        try:
+            pubsub = get_redis().pubsub()
+            await pubsub.subscribe(AUTH_INVALIDATION_CHANNEL)
+            # Có thể đã lỡ message trong lúc mất kết nối
+            profile_cache.clear()
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    profile_cache.invalidate(int(message["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Auth invalidation listener error: {e}")
+            await asyncio.sleep(5)
+
+async def start_auth():
+    global _listener_task
+    if _listener_task is None:
+        _listener_task = asyncio.create_task(_listen_invalidations())
+
+async def stop_auth():
+    global _listener_task, _user_client, _redis
+    if _listener_task is not None:
+        _listener_task.cancel()
+        try:
+            await _listener_task
+        except asyncio.CancelledError:
+            pass
+        _listener_task = None
+    if _user_client is not None:
+        await _user_client.aclose()
+        _user_client = None
+    if _redis is not None:
+        await _redis.close()
+        _redis = None
+
+def install(app):
+    """Gắn verifier vào app: middleware identity + listener invalidation"""
+    app.add_middleware(IdentityMiddleware)
+    app.add_event_handler("startup", start_auth)
+    app.add_event_handler("shutdown", stop_auth)
@@ -0,0 +1,109 @@
+from typing import Awaitable, Callable
+import asyncio
+import json
+import os
+from common.auth import get_redis
+
+# ==========================================
+# CONFIGURATION
+# ==========================================
+ORDER_EVENTS_STREAM = os.getenv("ORDER_EVENTS_STREAM", "orders:events")
+
+EVENT_CONSUMER_BATCH_SIZE = int(os.getenv("EVENT_CONSUMER_BATCH_SIZE", "100"))
+EVENT_CONSUMER_BLOCK_MS = int(os.getenv("EVENT_CONSUMER_BLOCK_MS", "5000"))
+# Message chưa ack quá lâu (consumer chết / handler lỗi) được consumer khác nhận lại
+EVENT_CONSUMER_CLAIM_IDLE_MS = int(os.getenv("EVENT_CONSUMER_CLAIM_IDLE_MS", "60000"))
+
+# ==========================================
+# EVENT FORMAT
+# ==========================================
+# Mỗi entry trong stream: event_id, type, order_id, payload (JSON)
+def event_fields(event_id: str, event_type: str, order_id: int, payload: dict) -> dict:
+    return {
+        "event_id": event_id,
+        "type": event_type,
+        "order_id": str(order_id),
+        "payload": json.dumps(payload, default=str),
+    }
+
+def parse_event(fields: dict) -> dict:
+    return {
+        "event_id": fields["event_id"],
+        "type": fields["type"],
+        "order_id": int(fields["order_id"]),
+        "payload": json.loads(fields["payload"]),
+    }
+
+# ==========================================
+# CONSUMER GROUPS
+# ==========================================
+async def ensure_group(stream: str, group: str, start_id: str = "$"):
+    """
+    Tạo consumer group nếu chưa có. Mặc định bắt đầu từ "$" (chỉ event mới): deploy lần đầu
+    không xử lý lại toàn bộ lịch sử stream (vd dispatch drone cho đơn cũ).
+    """
+    try:
+        await get_redis().xgroup_create(stream, group, id=start_id, mkstream=True)
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+async def consume(
+    stream: str,
+    group: str,
+    consumer: str,
+    handler: Callable[[dict], Awaitable[None]],
+    concurrent: bool = False,
+):
+    """
+    Đọc stream theo consumer group, at-least-once:
+    message chỉ được XACK sau khi handler chạy xong, handler lỗi thì message
+    nằm lại trong pending list và được nhận lại sau EVENT_CONSUMER_CLAIM_IDLE_MS.
+    Handler phải idempotent (dùng event_id để bỏ qua event đã xử lý).
+    concurrent=True: các message trong một lần đọc được xử lý song song
+    (không giữ thứ tự giữa các message).
+    Chạy như background task: asyncio.create_task(events.consume(...)).
+    """
+    while True:
+        try:
+            redis = get_redis()
+            await ensure_group(stream, group)
+            while True:
+                # Ưu tiên nhận lại message bị treo, sau đó mới đọc message mới
+                _, messages, *_ = await redis.xautoclaim(
+                    stream, group, consumer,
+                    min_idle_time=EVENT_CONSUMER_CLAIM_IDLE_MS,
+                    start_id="0-0",
+                    count=EVENT_CONSUMER_BATCH_SIZE,
+                )
+                if not messages:
+                    response = await redis.xreadgroup(
+                        group, consumer, {stream: ">"},
+                        count=EVENT_CONSUMER_BATCH_SIZE,
+                        block=EVENT_CONSUMER_BLOCK_MS,
+                    )
+                    messages = response[0][1] if response else []
+
+                if concurrent:
+                    results = await asyncio.gather(
+                        *(handler(parse_event(fields)) for _, fields in messages),
+                        return_exceptions=True,
+                    )
+                else:
+                    results = []
+                    for _, fields in messages:
+                        try:
+                            results.append(await handler(parse_event(fields)))
+                        except Exception as e:
+                            results.append(e)
+
+                for (message_id, _), result in zip(messages, results):
+                    if isinstance(result, Exception):
+                        print(f"⚠️ {group}: failed to handle {stream} {message_id}: {result}")
+                        continue
+                    await redis.xack(stream, group, message_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ {group}: stream consumer error: {e}")
+            await asyncio.sleep(5)
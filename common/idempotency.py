@@ -0,0 +1,130 @@
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from typing import Any, Awaitable, Callable, Optional
+import asyncio
+import hashlib
+import json
+import os
+from common.auth import get_redis
+
+# ==========================================
+# CONFIGURATION
+# ==========================================
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))  # giữ response 24h
+# Key pending được gia hạn mỗi IDEMPOTENCY_LOCK_TTL/3 giây khi handler còn chạy, nên TTL
+# chỉ cần đủ dài cho một lần gia hạn chứ không phải cho cả checkout;
+# request đầu chết giữa chừng -> key tự hết hạn sau tối đa TTL
+IDEMPOTENCY_LOCK_TTL = int(os.getenv("IDEMPOTENCY_LOCK_TTL", "60"))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "30"))
+IDEMPOTENCY_MAX_KEY_LENGTH = 255
+
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+# ==========================================
+# IDEMPOTENT EXECUTION
+# ==========================================
+def request_hash(scope: str, payload: Any) -> str:
+    body = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{scope}\n{body}".encode()).hexdigest()
+
+async def _wait_for_result(redis, redis_key: str, fingerprint: str) -> Optional[dict]:
+    """Chờ request đầu tiên (cùng key) xong; trả None nếu nó thất bại và key đã bị xóa"""
+    deadline = asyncio.get_running_loop().time() + IDEMPOTENCY_WAIT_SECONDS
+    delay = 0.05
+    while True:
+        raw = await redis.get(redis_key)
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        if entry["hash"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was used with a different request")
+        if entry["state"] == "done":
+            return entry
+        if asyncio.get_running_loop().time() >= deadline:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+async def _keep_pending(redis, redis_key: str, pending: str):
+    """Gia hạn key pending khi call còn chạy (chỉ khi key vẫn là của request này)"""
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_LOCK_TTL / 3)
+        try:
+            if await redis.get(redis_key) == pending:
+                await redis.expire(redis_key, IDEMPOTENCY_LOCK_TTL)
+        except Exception as e:
+            print(f"⚠️ Failed to extend idempotency key {redis_key}: {e}")
+
+async def run(
+    key: Optional[str],
+    scope: str,
+    payload: Any,
+    call: Callable[[], Awaitable[Any]],
+    status_code: int = 200,
+):
+    """
+    Chạy `call` tối đa một lần cho mỗi Idempotency-Key (trong scope, vd "checkout:<user_id>").
+
+    - Request đầu: giữ key ở trạng thái pending (gia hạn định kỳ khi call còn chạy),
+      chạy call, lưu response (2xx) trong IDEMPOTENCY_TTL.
+    - Request lặp lại (cùng key + cùng payload): trả response đã lưu, header Idempotent-Replayed.
+      Nếu request đầu còn đang chạy thì chờ nó xong.
+    - Cùng key nhưng payload khác: 422.
+    - call raise lỗi: xóa key để client retry được.
+    Không có key, hoặc Redis lỗi: chạy call bình thường.
+    """
+    if not key:
+        return await call()
+    if len(key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+
+    redis_key = f"idem:{scope}:{key}"
+    fingerprint = request_hash(scope, payload)
+    redis = get_redis()
+    pending = json.dumps({"state": "pending", "hash": fingerprint})
+
+    while True:
+        try:
+            acquired = await redis.set(
+                redis_key,
+                pending,
+                nx=True,
+                ex=IDEMPOTENCY_LOCK_TTL,
+            )
+            if acquired:
+                break
+            entry = await _wait_for_result(redis, redis_key, fingerprint)
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f"⚠️ Idempotency store unavailable, processing without key: {e}")
+            return await call()
+        if entry is not None:
+            response = JSONResponse(status_code=entry["status"], content=entry["body"])
+            response.headers[REPLAYED_HEADER] = "true"
+            return response
+        # Request đầu thất bại -> thử giữ key lại
+
+    keep_pending = asyncio.create_task(_keep_pending(redis, redis_key, pending))
+    try:
+        result = await call()
+    except BaseException:
+        try:
+            await redis.delete(redis_key)
+        except Exception as e:
+            print(f"⚠️ Failed to release idempotency key {redis_key}: {e}")
+        raise
+    finally:
+        keep_pending.cancel()
+
+    body = jsonable_encoder(result)
+    try:
+        await redis.set(
+            redis_key,
+            json.dumps({"state": "done", "hash": fingerprint, "status": status_code, "body": body}),
+            ex=IDEMPOTENCY_TTL,
+        )
+    except Exception as e:
+        print(f"⚠️ Failed to store idempotent response {redis_key}: {e}")
+    return JSONResponse(status_code=status_code, content=body)
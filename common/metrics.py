@@ -0,0 +1,311 @@
+from fastapi.responses import Response
+from starlette.routing import Match
+from typing import Callable, Dict, List, Optional, Tuple
+import bisect
+import os
+import threading
+import time
+
+# ==========================================
+# CONFIGURATION
+# ==========================================
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+METRICS_LATENCY_BUCKETS = [
+    float(b) for b in os.getenv(
+        "METRICS_LATENCY_BUCKETS",
+        "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10"
+    ).split(",") if b.strip()
+]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Route label cho request không khớp route nào (tránh label theo path thật)
+UNMATCHED_ROUTE = "<unmatched>"
+
+# ==========================================
+# METRIC TYPES
+# ==========================================
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+class Gauge(Metric):
+    """Gauge set/inc trực tiếp, hoặc đọc từ callback lúc scrape"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 callback: Optional[Callable[[], Dict[Tuple, float]]] = None):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple, float] = {}
+        self.callback = callback
+
+    def set(self, *labels, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        if self.callback is not None:
+            values.update(self.callback())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in values.items()
+        ]
+
+class Histogram(Metric):
+    """Histogram với bucket cố định (upper bound, giây)"""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets: Optional[List[float]] = None):
+        super().__init__(name, help, labels)
+        self.buckets = sorted(buckets or METRICS_LATENCY_BUCKETS)
+        # labels -> [counts theo bucket (+Inf ở cuối), sum]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, *labels, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = self.header()
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float("inf")], counts):
+                cumulative += count
+                le = _format_labels(self.labels, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total!r}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def counter(name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+    return registry.register(Counter(name, help, labels))
+
+def gauge(name: str, help: str, labels: Tuple[str, ...] = (), callback=None) -> Gauge:
+    return registry.register(Gauge(name, help, labels, callback))
+
+def histogram(name: str, help: str, labels: Tuple[str, ...] = (), buckets=None) -> Histogram:
+    return registry.register(Histogram(name, help, labels, buckets))
+
+# ==========================================
+# HTTP METRICS (server side)
+# ==========================================
+http_requests = counter(
+    "http_requests_total", "HTTP requests handled", ("method", "route", "status"))
+http_in_flight = gauge(
+    "http_requests_in_flight", "HTTP requests currently being handled", ("method", "route"))
+http_latency = histogram(
+    "http_request_duration_seconds", "Time until the response headers are sent", ("method", "route"))
+
+def resolve_route(scope) -> str:
+    """Path template của route khớp request (vd /orders/{order_id}), không phải path thật"""
+    app = scope.get("app")
+    for route in getattr(app, "routes", ()):
+        match, _ = route.matches(scope)
+        if match != Match.NONE:
+            return getattr(route, "path", UNMATCHED_ROUTE)
+    return UNMATCHED_ROUTE
+
+class MetricsMiddleware:
+    """ASGI middleware: count, in-flight, latency theo (method, route template)"""
+
+    def __init__(self, app, route_label: Callable = resolve_route):
+        self.app = app
+        self.route_label = route_label
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        method = scope["method"]
+        route = self.route_label(scope)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                http_latency.observe(method, route, value=time.perf_counter() - started)
+            await send(message)
+
+        http_in_flight.inc(method, route)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_in_flight.dec(method, route)
+            http_requests.inc(method, route, str(status))
+
+# ==========================================
+# UPSTREAM METRICS (httpx)
+# ==========================================
+upstream_requests = counter(
+    "upstream_requests_total", "Outgoing HTTP calls to other services", ("upstream", "method", "status"))
+upstream_latency = histogram(
+    "upstream_request_duration_seconds", "Outgoing HTTP call latency (until response headers)", ("upstream", "method"))
+
+def observe_upstream(upstream: str, method: str, status, seconds: float):
+    upstream_requests.inc(upstream, method, str(status))
+    upstream_latency.observe(upstream, method, value=seconds)
+
+def upstream_hooks(upstream: str) -> dict:
+    """
+    event_hooks cho httpx.AsyncClient:
+        httpx.AsyncClient(event_hooks=metrics.upstream_hooks("product"))
+    Lỗi kết nối không đi qua response hook; caller tự gọi observe_upstream(..., "error", ...) nếu cần.
+    """
+    async def on_request(request):
+        request.extensions["metrics_started"] = time.perf_counter()
+
+    async def on_response(response):
+        started = response.request.extensions.get("metrics_started")
+        if started is not None:
+            observe_upstream(upstream, response.request.method, response.status_code,
+                             time.perf_counter() - started)
+
+    return {"request": [on_request], "response": [on_response]}
+
+# ==========================================
+# DATABASE POOL METRICS (SQLAlchemy)
+# ==========================================
+_engines: Dict[str, object] = {}
+
+def _pool_stats(attribute: str) -> Callable[[], Dict[Tuple, float]]:
+    def read():
+        values = {}
+        for name, engine in list(_engines.items()):
+            stat = getattr(engine.pool, attribute, None)
+            if stat is not None:
+                values[(name,)] = max(stat(), 0)  # QueuePool.overflow() âm khi pool chưa đầy
+        return values
+    return read
+
+db_pool_size = gauge(
+    "db_pool_size", "Configured connection pool size", ("engine",), _pool_stats("size"))
+db_pool_checked_out = gauge(
+    "db_pool_checked_out", "Connections currently checked out", ("engine",), _pool_stats("checkedout"))
+db_pool_overflow = gauge(
+    "db_pool_overflow", "Connections open beyond pool_size", ("engine",), _pool_stats("overflow"))
+db_pool_wait = histogram(
+    "db_pool_wait_seconds", "Time to acquire a connection from the pool", ("engine",))
+db_pool_timeouts = counter(
+    "db_pool_timeouts_total", "Pool checkouts that timed out", ("engine",))
+
+def instrument_engine(engine, name: str = "default"):
+    """Đo thời gian lấy connection từ pool; size / checked out / overflow đọc lúc scrape"""
+    from sqlalchemy import event
+    from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+    _engines[name] = engine
+
+    def wrap(pool):
+        connect = pool.connect
+
+        def timed_connect():
+            started = time.perf_counter()
+            try:
+                return connect()
+            except PoolTimeout:
+                db_pool_timeouts.inc(name)
+                raise
+            finally:
+                db_pool_wait.observe(name, value=time.perf_counter() - started)
+
+        pool.connect = timed_connect
+
+    wrap(engine.pool)
+    # engine.dispose() tạo pool mới
+    event.listen(engine, "engine_disposed", lambda _: wrap(engine.pool))
+
+# ==========================================
+# INSTALL
+# ==========================================
+async def metrics_endpoint():
+    return Response(content=registry.render(), media_type=CONTENT_TYPE)
+
+def install(app, engine=None, route_label: Callable = resolve_route):
+    """
+    Gắn metrics vào app: middleware + GET /metrics (+ pool stats nếu có engine).
+    Gọi trước khi khai báo route catch-all.
+    """
+    app.add_middleware(MetricsMiddleware, route_label=route_label)
+    app.add_api_route(METRICS_PATH, metrics_endpoint, methods=["GET"], include_in_schema=False)
+    if engine is not None:
+        instrument_engine(engine)
@@ -0,0 +1,157 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from common import idempotency
+
+
+class FakeRedis:
+    """Đủ các lệnh idempotency.run dùng (get / set nx ex / expire / delete)"""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = []
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    async def expire(self, key, seconds):
+        self.expires.append((key, seconds))
+        return key in self.data
+
+    async def delete(self, key):
+        return 1 if self.data.pop(key, None) is not None else 0
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    fake = FakeRedis()
+    monkeypatch.setattr(idempotency, "get_redis", lambda: fake)
+    return fake
+
+
+def counting_call(result=None):
+    calls = []
+
+    async def call():
+        calls.append(1)
+        return result if result is not None else {"order_id": len(calls)}
+
+    return call, calls
+
+
+def test_replays_stored_response(redis):
+    call, calls = counting_call()
+    first = asyncio.run(idempotency.run("k1", "checkout:1", {"cart": 1}, call, status_code=201))
+    second = asyncio.run(idempotency.run("k1", "checkout:1", {"cart": 1}, call, status_code=201))
+
+    assert len(calls) == 1
+    assert first.status_code == second.status_code == 201
+    assert first.body == second.body
+    assert idempotency.REPLAYED_HEADER not in first.headers
+    assert second.headers[idempotency.REPLAYED_HEADER] == "true"
+
+
+def test_same_key_different_payload_is_422(redis):
+    call, calls = counting_call()
+    asyncio.run(idempotency.run("k1", "checkout:1", {"cart": 1}, call))
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(idempotency.run("k1", "checkout:1", {"cart": 2}, call))
+    assert exc.value.status_code == 422
+    assert len(calls) == 1
+
+
+def test_scope_separates_keys(redis):
+    call, calls = counting_call()
+    asyncio.run(idempotency.run("k1", "checkout:1", {"cart": 1}, call))
+    asyncio.run(idempotency.run("k1", "checkout:2", {"cart": 1}, call))
+    assert len(calls) == 2
+
+
+def test_in_progress_request_is_409(redis, monkeypatch):
+    monkeypatch.setattr(idempotency, "IDEMPOTENCY_WAIT_SECONDS", 0.1)
+    started = asyncio.Event()
+    finish = asyncio.Event()
+
+    async def slow():
+        started.set()
+        await finish.wait()
+        return {"ok": True}
+
+    async def scenario():
+        first = asyncio.create_task(idempotency.run("k1", "checkout:1", {"cart": 1}, slow))
+        await started.wait()
+        try:
+            with pytest.raises(HTTPException) as exc:
+                await idempotency.run("k1", "checkout:1", {"cart": 1}, slow)
+            assert exc.value.status_code == 409
+        finally:
+            finish.set()
+        return await first
+
+    assert asyncio.run(scenario()).status_code == 200
+
+
+def test_concurrent_duplicate_waits_for_result(redis):
+    calls = []
+
+    async def slow():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        return {"ok": True}
+
+    async def scenario():
+        return await asyncio.gather(
+            idempotency.run("k1", "checkout:1", {"cart": 1}, slow),
+            idempotency.run("k1", "checkout:1", {"cart": 1}, slow),
+        )
+
+    first, second = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert first.body == second.body
+    assert second.headers[idempotency.REPLAYED_HEADER] == "true"
+
+
+def test_failed_call_releases_key(redis):
+    async def failing():
+        raise HTTPException(status_code=400, detail="Cart is empty")
+
+    with pytest.raises(HTTPException):
+        asyncio.run(idempotency.run("k1", "checkout:1", {"cart": 1}, failing))
+    assert redis.data == {}
+
+    call, calls = counting_call()
+    response = asyncio.run(idempotency.run("k1", "checkout:1", {"cart": 1}, call))
+    assert response.status_code == 200
+    assert len(calls) == 1
+
+
+def test_pending_key_is_extended_while_running(redis, monkeypatch):
+    monkeypatch.setattr(idempotency, "IDEMPOTENCY_LOCK_TTL", 0.3)
+
+    async def slow():
+        await asyncio.sleep(0.5)
+        return {"ok": True}
+
+    asyncio.run(idempotency.run("k1", "checkout:1", {"cart": 1}, slow))
+    assert redis.expires and all(key == "idem:checkout:1:k1" for key, _ in redis.expires)
+
+
+def test_without_key_runs_call_directly(redis):
+    call, calls = counting_call({"ok": True})
+    assert asyncio.run(idempotency.run(None, "checkout:1", {"cart": 1}, call)) == {"ok": True}
+    assert redis.data == {}
+
+
+def test_key_too_long_is_400(redis):
+    call, _ = counting_call()
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(idempotency.run("x" * 256, "checkout:1", {"cart": 1}, call))
+    assert exc.value.status_code == 400
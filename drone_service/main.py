@@ -1,10 +1,12 @@
-from fastapi import FastAPI, Depends, HTTPException, Header, BackgroundTasks, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Depends, HTTPException, Header, BackgroundTasks, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, Index, bindparam, insert, select, update
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from pydantic import BaseModel
-from typing import Optional, List, Dict
+from typing import Callable, Optional, List, Dict, Set
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import json
 import asyncio
@@ -12,8 +14,10 @@ import math
 import os
 import time
 import httpx
+import numpy as np
 import redis
 import threading
+from common import auth, events, metrics
 from enum import Enum
 
 # ==========================================
@@ -29,13 +33,50 @@ DRONE_MAX_SPEED = float(os.getenv("DRONE_MAX_SPEED", "50"))  # km/h
 DRONE_BATTERY_DRAIN_RATE = float(os.getenv("DRONE_BATTERY_DRAIN_RATE", "0.5"))  # % per km
 DRONE_DEFAULT_LAT = float(os.getenv("DRONE_DEFAULT_LAT", "10.762622"))
 DRONE_DEFAULT_LNG = float(os.getenv("DRONE_DEFAULT_LNG", "106.660172"))
+DRONE_TRACKING_TTL = int(os.getenv("DRONE_TRACKING_TTL", "60"))  # giây, key drone:{id}:tracking
+NEARBY_MAX_RADIUS_KM = float(os.getenv("NEARBY_MAX_RADIUS_KM", "100"))
+
+# WebSocket fan-out: mỗi tick publish vị trí một lần qua Redis pub/sub, mỗi worker đẩy cho client của mình
+DRONE_POSITIONS_CHANNEL = os.getenv("DRONE_POSITIONS_CHANNEL", "drones:positions")
+POSITIONS_MESSAGE_CHUNK = int(os.getenv("POSITIONS_MESSAGE_CHUNK", "1000"))  # số drone mỗi message pub/sub
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "64"))  # client chậm hơn -> bị ngắt
+
+# Dispatch tự động (đơn ready -> drone), theo readme/DroneFlow.md
+DISPATCH_ENABLED = os.getenv("DISPATCH_ENABLED", "true").lower() == "true"
+DISPATCH_MIN_BATTERY = float(os.getenv("DISPATCH_MIN_BATTERY", "20"))  # %
+DISPATCH_WINDOW_SECONDS = float(os.getenv("DISPATCH_WINDOW_SECONDS", "0.5"))  # gom đơn ready thành batch
+DISPATCH_BATCH_SIZE = int(os.getenv("DISPATCH_BATCH_SIZE", "50"))
+DISPATCH_SEARCH_RADIUS_KM = float(os.getenv("DISPATCH_SEARCH_RADIUS_KM", "20"))  # chỉ xét drone trong bán kính này
+DISPATCH_CONSUMER_GROUP = os.getenv("DISPATCH_CONSUMER_GROUP", "drone-dispatch")
+DISPATCH_CONSUMER_NAME = os.getenv("DISPATCH_CONSUMER_NAME", os.getenv("HOSTNAME", "drone_service"))
+
+# Mô phỏng fleet: một replica (giữ leader lock trên Redis) chạy tick theo lịch cố định
+SIMULATION_ENABLED = os.getenv("SIMULATION_ENABLED", "true").lower() == "true"
+SIMULATION_LEADER_KEY = os.getenv("SIMULATION_LEADER_KEY", "drones:simulation:leader")
+SIMULATION_LEADER_TTL = float(os.getenv("SIMULATION_LEADER_TTL", str(max(DRONE_GPS_UPDATE_INTERVAL * 3, 15))))  # giây
+SIMULATION_DB_POOL_SIZE = int(os.getenv("SIMULATION_DB_POOL_SIZE", "2"))  # tick + telemetry writer
+
+# Telemetry (DroneTracking) ghi theo batch trên thread riêng
+TELEMETRY_BATCH_SIZE = int(os.getenv("TELEMETRY_BATCH_SIZE", "5000"))  # số điểm mỗi lần insert
+TELEMETRY_FLUSH_INTERVAL = float(os.getenv("TELEMETRY_FLUSH_INTERVAL", "2.0"))  # giây, flush dù batch chưa đầy
+TELEMETRY_MAX_BUFFER = int(os.getenv("TELEMETRY_MAX_BUFFER", "100000"))  # đầy (DB chậm) -> bỏ điểm mới
+TELEMETRY_DROP_REPORT_SECONDS = float(os.getenv("TELEMETRY_DROP_REPORT_SECONDS", "60"))
 
 # Database & Cache
-engine = create_engine(DATABASE_URL, echo=False)
+# pyodbc: gửi executemany thành một lượt (insert telemetry / update fleet theo batch)
+engine_options = {"fast_executemany": True} if DATABASE_URL and DATABASE_URL.startswith("mssql+pyodbc") else {}
+engine = create_engine(DATABASE_URL, echo=False, **engine_options)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 redis_client = redis.from_url(REDIS_URL, decode_responses=True)
 
+# Pool / client riêng cho mô phỏng + telemetry: tick nặng không chiếm connection của request
+simulation_engine = create_engine(
+    DATABASE_URL, echo=False, pool_size=SIMULATION_DB_POOL_SIZE, max_overflow=0, **engine_options
+)
+SimulationSession = sessionmaker(autocommit=False, autoflush=False, bind=simulation_engine)
+simulation_redis = redis.from_url(REDIS_URL, decode_responses=True)
+
 # ==========================================
 # DATABASE MODELS
 # ==========================================
@@ -59,6 +100,12 @@ class Drone(Base):
     flight_hours = Column(Float, default=0.0)
     created_at = Column(DateTime, default=datetime.utcnow)
     last_update = Column(DateTime, default=datetime.utcnow)
+    
+    # Tìm drone cho dispatch: status + pin, rồi lọc theo vị trí
+    __table_args__ = (
+        Index("ix_drones_dispatch", "status", "battery_level", "max_payload"),
+        Index("ix_drones_assigned_order", "assigned_order_id"),
+    )
 
 class DroneTracking(Base):
     __tablename__ = "drone_tracking"
@@ -127,6 +174,7 @@ class DroneAssignmentRequest(BaseModel):
     order_id: int
     destination_lat: float
     destination_lng: float
+    total_weight: Optional[float] = None
 
 class DroneChargingRequest(BaseModel):
     drone_id: int
@@ -143,6 +191,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+metrics.install(app, engine=engine)
+metrics.instrument_engine(simulation_engine, name="simulation")
 
 def get_db():
     db = SessionLocal()
@@ -153,7 +203,11 @@ def get_db():
 
 @app.on_event("startup")
 async def startup():
+    global _simulation_task
     Base.metadata.create_all(bind=engine)
+    # create_all không thêm index vào bảng đã có sẵn
+    for index in Drone.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
     print("✅ Drone Service Started")
     
     # Create sample drones if none exist
@@ -202,8 +256,18 @@ async def startup():
         print("✅ Sample drones created")
     db.close()
     
-    # Start background tracking thread
-    threading.Thread(target=background_drone_tracking, daemon=True).start()
+    try:
+        rebuild_geo_index()
+    except redis.RedisError as e:
+        print(f"⚠️ Could not build drone GEO index: {e}")
+    
+    # Start fleet simulation (chỉ replica giữ leader lock chạy tick)
+    telemetry.start()
+    if SIMULATION_ENABLED:
+        _simulation_task = asyncio.create_task(run_simulation())
+    
+    if DISPATCH_ENABLED:
+        dispatcher.start()
 
 # ==========================================
 # HELPER FUNCTIONS
@@ -219,133 +283,838 @@ def calculate_distance(lat1: float, lng1: float, lat2: float, lng2: float) -> fl
     c = 2 * math.asin(math.sqrt(a))
     return R * c
 
-def calculate_bearing(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
-    """Calculate bearing (hướng) từ điểm A đến B"""
-    lat1_rad = math.radians(lat1)
-    lat2_rad = math.radians(lat2)
-    delta_lng = math.radians(lng2 - lng1)
+def check_assignment(drone: Drone, destination_lat: float, destination_lng: float,
+                     total_weight: Optional[float] = None) -> Optional[str]:
+    """Điều kiện gán drone (readme/DroneFlow.md); trả lý do nếu không gán được"""
+    if drone.status != "idle":
+        return f"Drone is {drone.status}"
+    if drone.battery_level < DISPATCH_MIN_BATTERY:
+        return "Battery too low"
+    if total_weight is not None and drone.max_payload < total_weight:
+        return "Order exceeds drone payload"
+    distance = calculate_distance(drone.current_lat, drone.current_lng, destination_lat, destination_lng)
+    if distance > drone.max_distance_km:
+        return "Distance exceeds drone range"
+    return None
+
+def assign_drone_to_order(db: Session, drone: Drone, order_id: int,
+                          destination_lat: float, destination_lng: float) -> bool:
+    """
+    Chuyển drone idle sang in_delivery cho order. UPDATE có điều kiện status='idle'
+    nên gán thủ công và dispatch không lấy cùng một drone. Không commit.
+    """
+    result = db.execute(
+        update(Drone)
+        .where(Drone.id == drone.id, Drone.status == "idle")
+        .values(
+            status="in_delivery",
+            assigned_order_id=order_id,
+            destination_lat=destination_lat,
+            destination_lng=destination_lng,
+            last_update=datetime.utcnow(),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+# ==========================================
+# LIVE POSITIONS (Redis)
+# ==========================================
+# drone:{id}:tracking  JSON vị trí mới nhất (TTL DRONE_TRACKING_TTL)
+# drones:geo:{status}  GEO set (member = drone id) theo trạng thái, cho GEOSEARCH
+GEO_MAX_LAT = 85.05112878  # giới hạn vĩ độ của GEO index Redis
+
+def tracking_key(drone_id: int) -> str:
+    return f"drone:{drone_id}:tracking"
+
+def geo_key(status: str) -> str:
+    return f"drones:geo:{status}"
+
+def position_entry(drone: Drone) -> dict:
+    return {
+        "drone_id": drone.id,
+        "lat": drone.current_lat,
+        "lng": drone.current_lng,
+        "status": drone.status,
+        "battery": drone.battery_level,
+        "timestamp": (drone.last_update or datetime.utcnow()).isoformat(),
+    }
+
+def cache_positions(entries: List[dict], previous_status: Optional[Dict[int, str]] = None,
+                    client: Optional[redis.Redis] = None):
+    """
+    Ghi vị trí + GEO set của nhiều drone trong một pipeline (một round trip).
+    previous_status: trạng thái cũ của từng drone để bỏ khỏi GEO set cũ;
+    không có thì bỏ khỏi mọi GEO set khác trạng thái hiện tại.
+    """
+    pipe = (client or redis_client).pipeline(transaction=False)
+    for entry in entries:
+        drone_id, status = entry["drone_id"], entry["status"]
+        pipe.set(tracking_key(drone_id), json.dumps(entry), ex=DRONE_TRACKING_TTL)
+        if previous_status is None:
+            stale = [name for name in STATUSES if name != status]
+        else:
+            stale = [previous_status[drone_id]] if previous_status.get(drone_id, status) != status else []
+        for name in stale:
+            pipe.zrem(geo_key(name), drone_id)
+        if entry["lat"] is not None and entry["lng"] is not None:
+            pipe.geoadd(geo_key(status), (entry["lng"], entry["lat"], drone_id))
+    # WebSocket subscribers (mọi worker) nhận cùng thay đổi
+    for start in range(0, len(entries), POSITIONS_MESSAGE_CHUNK):
+        pipe.publish(DRONE_POSITIONS_CHANNEL, json.dumps(entries[start:start + POSITIONS_MESSAGE_CHUNK]))
+    pipe.execute()
+
+def cache_drones(db: Session, drone_ids: List[int]):
+    """Cập nhật Redis cho drone vừa đổi qua API / dispatch; Redis lỗi không làm hỏng thao tác DB"""
+    if not drone_ids:
+        return
+    try:
+        drones = db.query(Drone).filter(Drone.id.in_(drone_ids)).all()
+        cache_positions([position_entry(drone) for drone in drones])
+    except redis.RedisError as e:
+        print(f"⚠️ Failed to cache drone positions: {e}")
+
+def rebuild_geo_index(batch_size: int = 5000):
+    """Dựng lại GEO set từ DB (lúc startup; cũng publish cho WebSocket subscribers)"""
+    db = SessionLocal()
+    try:
+        redis_client.delete(*[geo_key(status) for status in STATUSES])
+        drones = db.query(Drone).order_by(Drone.id).yield_per(batch_size)
+        batch = []
+        for drone in drones:
+            batch.append(position_entry(drone))
+            if len(batch) >= batch_size:
+                cache_positions(batch, previous_status={})
+                batch = []
+        if batch:
+            cache_positions(batch, previous_status={})
+    finally:
+        db.close()
+
+def nearby_drones(lat: float, lng: float, radius_km: float, status: str = "idle",
+                  limit: Optional[int] = None) -> List[tuple]:
+    """GEOSEARCH: [(drone_id, distance_km, lat, lng)] gần nhất trước"""
+    results = redis_client.geosearch(
+        geo_key(status),
+        longitude=lng,
+        latitude=lat,
+        radius=radius_km,
+        unit="km",
+        sort="ASC",
+        count=limit,
+        withdist=True,
+        withcoord=True,
+    )
+    return [(int(member), distance, coord[1], coord[0]) for member, distance, coord in results]
+
+# ==========================================
+# FLEET SIMULATION (NumPy)
+# ==========================================
+EARTH_RADIUS_KM = 6371
+ARRIVAL_DISTANCE_KM = 0.05  # cách đích dưới 50m = đã tới
+LOW_BATTERY_CHARGE = 15  # drone idle dưới mức này -> charging
+
+# Status <-> mã số trong mảng
+STATUSES = ["idle", "in_delivery", "returning", "charging", "maintenance"]
+STATUS_CODES = {name: code for code, name in enumerate(STATUSES)}
+IDLE, IN_DELIVERY, RETURNING, CHARGING = (STATUS_CODES[name] for name in ("idle", "in_delivery", "returning", "charging"))
+
+fleet_step_seconds = metrics.histogram(
+    "drone_fleet_step_seconds", "Time to simulate and persist one fleet tick")
+fleet_active_drones = metrics.gauge(
+    "drone_fleet_active", "Drones moved in the last fleet tick")
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """calculate_distance cho mảng (độ -> km)"""
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def initial_bearing(lat1, lng1, lat2, lng2):
+    """Hướng bay (radian) từ điểm 1 tới điểm 2"""
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    y = np.sin(lng2 - lng1) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lng2 - lng1)
+    return np.arctan2(y, x)
+
+def destination_point(lat, lng, bearing, distance_km):
+    """Điểm đến sau khi bay distance_km theo bearing (great circle)"""
+    lat, lng = np.radians(lat), np.radians(lng)
+    delta = distance_km / EARTH_RADIUS_KM
+    new_lat = np.arcsin(np.sin(lat) * np.cos(delta) + np.cos(lat) * np.sin(delta) * np.cos(bearing))
+    new_lng = lng + np.arctan2(
+        np.sin(bearing) * np.sin(delta) * np.cos(lat),
+        np.cos(delta) - np.sin(lat) * np.sin(new_lat),
+    )
+    return np.degrees(new_lat), (np.degrees(new_lng) + 540) % 360 - 180
+
+class FleetState:
+    """
+    Drone đang bay (in_delivery / returning) dưới dạng mảng NumPy, một phần tử mỗi drone.
+    Nạp bằng một SELECT mỗi tick (DB vẫn là nguồn chính: API gán / đổi trạng thái drone),
+    step() di chuyển cả đội trong một lượt, save() ghi lại bằng một UPDATE executemany.
+    """
+    
+    COLUMNS = (
+        Drone.id, Drone.status, Drone.current_lat, Drone.current_lng,
+        Drone.destination_lat, Drone.destination_lng, Drone.base_lat, Drone.base_lng,
+        Drone.battery_level, Drone.total_distance_traveled, Drone.flight_hours, Drone.assigned_order_id,
+    )
+    
+    def __init__(self, rows: list):
+        columns = list(zip(*rows)) or [()] * len(self.COLUMNS)
+        as_float = lambda values: np.array(values, dtype=np.float64)
+        self.ids = np.array(columns[0], dtype=np.int64)
+        self.loaded_status = np.array([STATUS_CODES[status] for status in columns[1]], dtype=np.int8)
+        self.status = self.loaded_status.copy()
+        self.lat, self.lng = as_float(columns[2]), as_float(columns[3])
+        self.dest_lat, self.dest_lng = as_float(columns[4]), as_float(columns[5])
+        self.base_lat = as_float([v if v is not None else DRONE_DEFAULT_LAT for v in columns[6]])
+        self.base_lng = as_float([v if v is not None else DRONE_DEFAULT_LNG for v in columns[7]])
+        self.battery = as_float([v or 0.0 for v in columns[8]])
+        self.distance = as_float([v or 0.0 for v in columns[9]])
+        self.flight_hours = as_float([v or 0.0 for v in columns[10]])
+        self.order_ids = np.array([v if v is not None else -1 for v in columns[11]], dtype=np.int64)
+        self.speed = np.zeros(len(self.ids))
+        self.has_destination = np.ones(len(self.ids), dtype=bool)
+    
+    def __len__(self):
+        return len(self.ids)
     
-    y = math.sin(delta_lng) * math.cos(lat2_rad)
-    x = math.cos(lat1_rad) * math.sin(lat2_rad) - math.sin(lat1_rad) * math.cos(lat2_rad) * math.cos(delta_lng)
-    bearing = math.degrees(math.atan2(y, x))
-    return (bearing + 360) % 360
+    @classmethod
+    def load(cls, db: Session) -> "FleetState":
+        rows = db.execute(
+            select(*cls.COLUMNS).where(
+                Drone.status.in_(["in_delivery", "returning"]),
+                Drone.destination_lat.isnot(None),
+                Drone.destination_lng.isnot(None),
+            )
+        ).all()
+        return cls(rows)
+    
+    def step(self, interval_sec: float, speed_kmh: float = DRONE_MAX_SPEED):
+        """Bay interval_sec giây về phía đích; tới đích thì chuyển trạng thái như luồng giao hàng"""
+        if not len(self):
+            return
+        max_step = speed_kmh / 3600 * interval_sec
+        distance = haversine_km(self.lat, self.lng, self.dest_lat, self.dest_lng)
+        traveled = np.minimum(distance, max_step)
+        bearing = initial_bearing(self.lat, self.lng, self.dest_lat, self.dest_lng)
+        
+        reached = distance <= max_step
+        new_lat, new_lng = destination_point(self.lat, self.lng, bearing, traveled)
+        self.lat = np.where(reached, self.dest_lat, new_lat)
+        self.lng = np.where(reached, self.dest_lng, new_lng)
+        
+        self.speed = traveled / interval_sec * 3600 if interval_sec > 0 else np.zeros(len(self))
+        self.battery = np.maximum(self.battery - traveled * DRONE_BATTERY_DRAIN_RATE, 0)
+        self.distance += traveled
+        self.flight_hours += interval_sec / 3600
+        
+        arrived = (distance - traveled) < ARRIVAL_DISTANCE_KM
+        # Giao xong -> bay về base
+        delivered = arrived & (self.status == IN_DELIVERY)
+        self.status[delivered] = RETURNING
+        self.dest_lat[delivered] = self.base_lat[delivered]
+        self.dest_lng[delivered] = self.base_lng[delivered]
+        # Về tới base -> idle (hoặc charging nếu pin thấp)
+        landed = arrived & (self.loaded_status == RETURNING)
+        self.status[landed] = np.where(self.battery[landed] < LOW_BATTERY_CHARGE, CHARGING, IDLE)
+        self.has_destination[landed] = False
+        self.order_ids[landed] = -1
+    
+    def save(self, db: Session, now: datetime) -> Set[int]:
+        """
+        Ghi vị trí / pin / trạng thái mới bằng một UPDATE executemany; trả id các drone đã ghi.
+        Chỉ ghi drone còn ở trạng thái lúc nạp (API có thể vừa đổi trạng thái drone, vd maintenance):
+        trạng thái hiện tại được đọc kèm khóa dòng (SQL Server: UPDLOCK; DB khác: FOR UPDATE)
+        nên không đổi được giữa lúc kiểm tra và commit.
+        """
+        if not len(self):
+            return set()
+        table = Drone.__table__
+        current = dict(db.execute(
+            select(table.c.id, table.c.status)
+            .where(table.c.status.in_(["in_delivery", "returning"]))
+            .with_hint(table, "WITH (UPDLOCK, ROWLOCK)", "mssql")
+            .with_for_update()
+        ).all())
+        records = [r for r in self.records() if current.get(r["drone_id"]) == r["loaded_status"]]
+        if not records:
+            return set()
+        statement = (
+            update(table)
+            .where(table.c.id == bindparam("drone_id"), table.c.status == bindparam("loaded_status"))
+            .values(
+                status=bindparam("new_status"),
+                current_lat=bindparam("lat"),
+                current_lng=bindparam("lng"),
+                destination_lat=bindparam("dest_lat"),
+                destination_lng=bindparam("dest_lng"),
+                battery_level=bindparam("battery"),
+                total_distance_traveled=bindparam("distance"),
+                flight_hours=bindparam("flight_hours"),
+                assigned_order_id=bindparam("order_id"),
+                last_update=now,
+            )
+        )
+        db.execute(statement, records)
+        return {r["drone_id"] for r in records}
+    
+    def records(self) -> List[dict]:
+        """Một dict mỗi drone (giá trị Python thuần, None thay cho giá trị trống)"""
+        dest_lat = np.where(self.has_destination, self.dest_lat, np.nan).tolist()
+        dest_lng = np.where(self.has_destination, self.dest_lng, np.nan).tolist()
+        return [
+            {
+                "drone_id": drone_id,
+                "loaded_status": STATUSES[loaded],
+                "new_status": STATUSES[status],
+                "lat": lat,
+                "lng": lng,
+                "dest_lat": None if math.isnan(d_lat) else d_lat,
+                "dest_lng": None if math.isnan(d_lng) else d_lng,
+                "battery": battery,
+                "distance": distance,
+                "flight_hours": hours,
+                "order_id": None if order_id < 0 else order_id,
+                "speed": speed,
+            }
+            for drone_id, loaded, status, lat, lng, d_lat, d_lng, battery, distance, hours, order_id, speed in zip(
+                self.ids.tolist(), self.loaded_status.tolist(), self.status.tolist(),
+                self.lat.tolist(), self.lng.tolist(), dest_lat, dest_lng,
+                self.battery.tolist(), self.distance.tolist(), self.flight_hours.tolist(),
+                self.order_ids.tolist(), self.speed.tolist(),
+            )
+        ]
 
-def move_towards_target(
-    current_lat: float, current_lng: float, 
-    target_lat: float, target_lng: float,
-    speed_kmh: float, time_interval_sec: float
-) -> tuple:
-    """Tính vị trí mới sau khi bay với tốc độ nhất định trong khoảng thời gian"""
-    distance = calculate_distance(current_lat, current_lng, target_lat, target_lng)
-    bearing = calculate_bearing(current_lat, current_lng, target_lat, target_lng)
+def fleet_tick(interval_sec: float = DRONE_GPS_UPDATE_INTERVAL,
+               is_leader: Optional[Callable[[], bool]] = None) -> int:
+    """
+    Một tick mô phỏng: nạp đội bay, step, ghi DB + Redis, đẩy điểm tracking cho telemetry; trả số drone đã xử lý.
+    Chỉ drone thực sự được ghi xuống DB mới được đẩy lên Redis / WebSocket / telemetry.
+    is_leader được kiểm tra ngay trước commit: đã mất leader lock thì bỏ cả tick (rollback).
+    """
+    db = SimulationSession()
+    try:
+        fleet = FleetState.load(db)
+        if not len(fleet):
+            return 0
+        fleet.step(interval_sec)
+        now = datetime.utcnow()
+        saved = fleet.save(db, now)
+        if is_leader is not None and not is_leader():
+            db.rollback()
+            print("⚠️ Lost simulation leader lock during tick, discarding tick")
+            return 0
+        db.commit()
+        
+        records = [r for r in fleet.records() if r["drone_id"] in saved]
+        telemetry.submit([
+            {
+                "drone_id": r["drone_id"],
+                "order_id": r["order_id"],
+                "latitude": r["lat"],
+                "longitude": r["lng"],
+                "speed": r["speed"],
+                "battery_level": r["battery"],
+                "status": r["new_status"],
+                "timestamp": now,
+            }
+            for r in records
+        ])
+        
+        # Save to Redis for real-time (một pipeline cho cả tick)
+        timestamp = now.isoformat()
+        cache_positions(
+            [
+                {
+                    "drone_id": r["drone_id"],
+                    "lat": r["lat"],
+                    "lng": r["lng"],
+                    "status": r["new_status"],
+                    "battery": r["battery"],
+                    "timestamp": timestamp
+                }
+                for r in records
+            ],
+            previous_status={r["drone_id"]: r["loaded_status"] for r in records},
+            client=simulation_redis,
+        )
+        return len(records)
+    finally:
+        db.close()
+
+# ==========================================
+# TELEMETRY WRITER
+# ==========================================
+telemetry_written = metrics.counter(
+    "drone_telemetry_points_written_total", "Tracking points inserted into drone_tracking")
+telemetry_dropped = metrics.counter(
+    "drone_telemetry_points_dropped_total", "Tracking points dropped because the buffer was full")
+telemetry_flush_seconds = metrics.histogram(
+    "drone_telemetry_flush_seconds", "Time to insert one telemetry batch")
+
+class TelemetryWriter:
+    """
+    Buffer điểm tracking trong bộ nhớ, thread riêng insert theo batch (executemany,
+    một transaction mỗi batch) khi đủ batch_size điểm hoặc sau flush_interval giây.
+    submit() không chờ DB: buffer đầy thì bỏ điểm mới và đếm số điểm bị bỏ.
+    DB lỗi thì giữ batch và thử lại (backoff) -> buffer đầy dần, đó là backpressure.
+    """
     
-    # km đã bay = tốc độ (km/h) * thời gian (h)
-    distance_traveled = (speed_kmh / 3600) * time_interval_sec  # convert to km
+    def __init__(self, batch_size: int, flush_interval: float, max_buffer: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer: deque = deque()
+        self.dropped = 0  # từ lần báo cáo trước
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._last_drop_report = time.monotonic()
+        metrics.gauge(
+            "drone_telemetry_buffer_points", "Tracking points waiting to be written",
+            callback=lambda: {(): len(self.buffer)},
+        )
     
-    if distance_traveled >= distance:
-        # Đã tới đích
-        return target_lat, target_lng, distance, 0.0
+    def submit(self, points: List[dict]) -> int:
+        """Thêm điểm vào buffer; trả số điểm được nhận"""
+        with self._cond:
+            accepted = points[:max(self.max_buffer - len(self.buffer), 0)]
+            self.buffer.extend(accepted)
+            rejected = len(points) - len(accepted)
+            if rejected:
+                self.dropped += rejected
+                telemetry_dropped.inc(amount=rejected)
+            if len(self.buffer) >= self.batch_size:
+                self._cond.notify()
+        return len(accepted)
     
-    # Tính vị trí mới dựa trên bearing
-    bearing_rad = math.radians(bearing)
-    lat_change = distance_traveled * 111  # 1 degree ≈ 111 km
-    lng_change = distance_traveled * 111 / math.cos(math.radians(current_lat))
+    def start(self):
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="telemetry-writer", daemon=True)
+            self._thread.start()
     
-    new_lat = current_lat + (lat_change * math.cos(bearing_rad) / 111)
-    new_lng = current_lng + (lng_change * math.sin(bearing_rad) / 111)
+    def stop(self, timeout: float = 10.0):
+        """Ghi nốt phần còn trong buffer rồi dừng thread"""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._thread = None
     
-    remaining_distance = calculate_distance(new_lat, new_lng, target_lat, target_lng)
-    actual_speed = (distance_traveled / (time_interval_sec / 3600)) if time_interval_sec > 0 else 0
+    def _next_batch(self) -> List[dict]:
+        deadline = time.monotonic() + self.flush_interval
+        with self._cond:
+            while len(self.buffer) < self.batch_size and not self._stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
     
-    return new_lat, new_lng, remaining_distance, actual_speed
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+            self._report_drops()
+            if self._stopping and not self.buffer:
+                return
+    
+    def _write(self, batch: List[dict]):
+        delay = 1.0
+        while True:
+            started = time.perf_counter()
+            try:
+                with simulation_engine.begin() as conn:
+                    conn.execute(insert(DroneTracking), batch)
+                telemetry_flush_seconds.observe(value=time.perf_counter() - started)
+                telemetry_written.inc(amount=len(batch))
+                return
+            except Exception as e:
+                print(f"❌ Telemetry write failed ({len(batch)} points): {e}")
+                if self._stopping:
+                    with self._cond:
+                        self.dropped += len(batch)
+                    telemetry_dropped.inc(amount=len(batch))
+                    return
+                time.sleep(delay)
+                delay = min(delay * 2, 30.0)
+    
+    def _report_drops(self):
+        now = time.monotonic()
+        if now - self._last_drop_report < TELEMETRY_DROP_REPORT_SECONDS and not self._stopping:
+            return
+        self._last_drop_report = now
+        with self._cond:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            print(f"⚠️ Telemetry: dropped {dropped} tracking points (buffer {len(self.buffer)}/{self.max_buffer})")
 
-def background_drone_tracking():
-    """Background thread - simulate drone movement every 5 seconds"""
-    while True:
+telemetry = TelemetryWriter(TELEMETRY_BATCH_SIZE, TELEMETRY_FLUSH_INTERVAL, TELEMETRY_MAX_BUFFER)
+
+# ==========================================
+# SIMULATION SCHEDULER
+# ==========================================
+fleet_tick_overruns = metrics.counter(
+    "drone_fleet_tick_overruns_total", "Fleet ticks that took longer than the tick interval")
+fleet_ticks_skipped = metrics.counter(
+    "drone_fleet_ticks_skipped_total", "Scheduled fleet ticks skipped after an overrun")
+simulation_leader = metrics.gauge(
+    "drone_simulation_leader", "1 if this replica runs the fleet simulation")
+
+class LeaderLock:
+    """
+    Leader lock trên Redis: SET NX PX với token riêng của replica, gia hạn / nhả bằng
+    WATCH + MULTI (chỉ khi key còn đúng token). Replica chết -> key hết hạn sau ttl,
+    replica khác lên thay.
+    """
+    
+    def __init__(self, key: str, ttl: float):
+        self.key = key
+        self.ttl_ms = int(ttl * 1000)
+        self.token = f"{os.getenv('HOSTNAME', 'drone_service')}:{os.getpid()}:{id(self)}"
+        self.held = False
+    
+    async def _if_owner(self, action) -> bool:
+        async with auth.get_redis().pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(self.key)
+                if await pipe.get(self.key) != self.token:
+                    return False
+                pipe.multi()
+                action(pipe)
+                await pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+    
+    async def renew(self) -> bool:
+        """Gia hạn lock đang giữ; đã mất thì không giành lại (để tick đang chạy biết mà dừng)"""
+        if self.held:
+            try:
+                self.held = await self._if_owner(lambda pipe: pipe.pexpire(self.key, self.ttl_ms))
+            except redis.RedisError as e:
+                # Không xác nhận được lock -> coi như mất quyền, tránh hai replica cùng chạy
+                print(f"⚠️ Simulation leader lock unavailable: {e}")
+                self.held = False
+            simulation_leader.set(value=1 if self.held else 0)
+        return self.held
+    
+    async def ensure(self) -> bool:
+        """Giữ (hoặc giành) quyền leader; gọi mỗi tick"""
+        if self.held and await self.renew():
+            return True
         try:
-            db = SessionLocal()
-            drones = db.query(Drone).filter(Drone.status.in_(["in_delivery", "returning"])).all()
-            
-            for drone in drones:
-                if not drone.destination_lat or not drone.destination_lng:
-                    continue
-                
-                # Move drone towards destination
-                new_lat, new_lng, remaining_dist, speed = move_towards_target(
-                    drone.current_lat, drone.current_lng,
-                    drone.destination_lat, drone.destination_lng,
-                    DRONE_MAX_SPEED,
-                    DRONE_GPS_UPDATE_INTERVAL
-                )
-                
-                # Update position
-                drone.current_lat = new_lat
-                drone.current_lng = new_lng
-                
-                # Update battery
-                distance_traveled = calculate_distance(
-                    new_lat, new_lng, 
-                    drone.current_lat - 0.001, drone.current_lng - 0.001  # Approximation
-                )
-                battery_drain = distance_traveled * DRONE_BATTERY_DRAIN_RATE
-                drone.battery_level = max(0, drone.battery_level - battery_drain)
-                
-                # Update distance & flight hours
-                drone.total_distance_traveled += distance_traveled
-                drone.flight_hours += (DRONE_GPS_UPDATE_INTERVAL / 3600)
-                
-                # Check if reached destination
-                if remaining_dist < 0.05:  # Within 50 meters
-                    if drone.status == "in_delivery":
-                        drone.status = "returning"
-                        drone.destination_lat = drone.base_lat
-                        drone.destination_lng = drone.base_lng
-                    elif drone.status == "returning":
-                        drone.status = "idle"
-                        drone.destination_lat = None
-                        drone.destination_lng = None
-                        drone.assigned_order_id = None
-                
-                # Auto-charge if battery low
-                if drone.battery_level < 15 and drone.status == "idle":
-                    drone.status = "charging"
-                
-                # Update last_update
-                drone.last_update = datetime.utcnow()
-                
-                # Save to DB
-                db.commit()
-                
-                # Save to Redis for real-time
-                tracking_data = {
-                    "drone_id": drone.id,
-                    "lat": drone.current_lat,
-                    "lng": drone.current_lng,
-                    "status": drone.status,
-                    "battery": drone.battery_level,
-                    "timestamp": datetime.utcnow().isoformat()
-                }
-                redis_client.set(f"drone:{drone.id}:tracking", json.dumps(tracking_data), ex=60)
-                
-                # Create tracking record
-                tracking = DroneTracking(
-                    drone_id=drone.id,
-                    order_id=drone.assigned_order_id,
-                    latitude=drone.current_lat,
-                    longitude=drone.current_lng,
-                    speed=speed,
-                    battery_level=drone.battery_level,
-                    status=drone.status
+            self.held = bool(await auth.get_redis().set(self.key, self.token, nx=True, px=self.ttl_ms))
+        except redis.RedisError as e:
+            print(f"⚠️ Simulation leader lock unavailable: {e}")
+            self.held = False
+        simulation_leader.set(value=1 if self.held else 0)
+        return self.held
+    
+    async def keep(self):
+        """Gia hạn mỗi ttl/3 trong lúc tick chạy (tick có thể lâu hơn ttl); dừng khi mất lock"""
+        while self.held:
+            await asyncio.sleep(self.ttl_ms / 3000)
+            await self.renew()
+    
+    async def release(self):
+        if self.held:
+            try:
+                await self._if_owner(lambda pipe: pipe.delete(self.key))
+            except redis.RedisError:
+                pass
+            self.held = False
+            simulation_leader.set(value=0)
+
+leader_lock = LeaderLock(SIMULATION_LEADER_KEY, SIMULATION_LEADER_TTL)
+simulation_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fleet-sim")
+_simulation_task: Optional[asyncio.Task] = None
+
+async def run_simulation(interval: float = DRONE_GPS_UPDATE_INTERVAL):
+    """
+    Tick theo lịch cố định (không trôi): tick thứ n chạy ở start + n * interval, không phụ thuộc
+    thời gian chạy tick. Tick chạy quá interval -> bỏ các mốc đã lỡ, tick sau mô phỏng đủ
+    khoảng thời gian thực đã trôi qua. DB / Redis của tick chạy trong simulation_executor.
+    """
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+    last_tick: Optional[float] = None
+    while True:
+        if await leader_lock.ensure():
+            started = loop.time()
+            # Vừa lên leader: mô phỏng một interval; sau đó theo thời gian thực giữa hai tick
+            simulated = interval if last_tick is None else started - last_tick
+            last_tick = started
+            keeper = asyncio.create_task(leader_lock.keep())
+            try:
+                active = await loop.run_in_executor(
+                    simulation_executor, fleet_tick, simulated, lambda: leader_lock.held
                 )
-                db.add(tracking)
+                fleet_active_drones.set(value=active)
+            except Exception as e:
+                print(f"❌ Tracking error: {e}")
+            finally:
+                keeper.cancel()
+            elapsed = loop.time() - started
+            fleet_step_seconds.observe(value=elapsed)
+            if elapsed > interval:
+                fleet_tick_overruns.inc()
+                print(f"⚠️ Fleet tick took {elapsed:.2f}s (interval {interval}s)")
+        else:
+            last_tick = None
+        
+        next_tick += interval
+        now = loop.time()
+        if now > next_tick:
+            missed = math.ceil((now - next_tick) / interval)
+            fleet_ticks_skipped.inc(amount=missed)
+            next_tick += missed * interval
+        await asyncio.sleep(next_tick - now)
+
+# ==========================================
+# DISPATCH (đơn ready -> drone)
+# ==========================================
+class NoDroneAvailable(Exception):
+    pass
+
+class DispatchRequest:
+    __slots__ = ("order_id", "total_weight", "pickup", "destination", "future")
+    
+    def __init__(self, order_id: int, total_weight: float, pickup: tuple, destination: tuple):
+        self.order_id = order_id
+        self.total_weight = total_weight
+        self.pickup = pickup
+        self.destination = destination
+        self.future: Optional[asyncio.Future] = None
+
+def find_candidates(db: Session, requests: List[DispatchRequest]) -> List[Drone]:
+    """
+    Drone idle đủ pin, chở được đơn nhẹ nhất trong batch, trong DISPATCH_SEARCH_RADIUS_KM
+    quanh các điểm lấy hàng: GEOSEARCH trên drones:geo:idle rồi kiểm tra lại trên DB theo id.
+    Redis lỗi hoặc GEO index rỗng/cũ (không ra drone nào hợp lệ) -> bounding box trên DB
+    (dùng ix_drones_dispatch, không quét cả bảng).
+    """
+    conditions = (
+        Drone.status == "idle",
+        Drone.battery_level >= DISPATCH_MIN_BATTERY,
+        Drone.max_payload >= min(r.total_weight for r in requests),
+    )
+    try:
+        drone_ids = set()
+        for request in requests:
+            drone_ids.update(
+                drone_id for drone_id, *_ in
+                nearby_drones(*request.pickup, DISPATCH_SEARCH_RADIUS_KM)
+            )
+        if drone_ids:
+            candidates = db.query(Drone).filter(Drone.id.in_(drone_ids), *conditions).all()
+            if candidates:
+                return candidates
+    except redis.RedisError as e:
+        print(f"⚠️ Dispatch: GEO index unavailable, using DB search: {e}")
+    
+    lats = [r.pickup[0] for r in requests]
+    lngs = [r.pickup[1] for r in requests]
+    lat_margin = DISPATCH_SEARCH_RADIUS_KM / 111
+    lng_margin = DISPATCH_SEARCH_RADIUS_KM / (111 * max(math.cos(math.radians(max(map(abs, lats)))), 0.01))
+    return (
+        db.query(Drone)
+        .filter(
+            *conditions,
+            Drone.current_lat.between(min(lats) - lat_margin, max(lats) + lat_margin),
+            Drone.current_lng.between(min(lngs) - lng_margin, max(lngs) + lng_margin),
+        )
+        .all()
+    )
+
+def dispatch_batch(requests: List[DispatchRequest]) -> Dict[int, int]:
+    """
+    Gán drone cho một batch đơn ready, trả {order_id: drone_id}.
+    Đơn nặng trước (ít drone chở được hơn); mỗi đơn lấy drone khả thi gần điểm lấy hàng nhất,
+    hòa thì drone nhiều pin hơn.
+    """
+    db = SessionLocal()
+    try:
+        order_ids = [r.order_id for r in requests]
+        # Event được gửi lại (at-least-once): đơn đã có drone thì giữ nguyên
+        assigned = dict(
+            db.query(Drone.assigned_order_id, Drone.id)
+            .filter(Drone.assigned_order_id.in_(order_ids))
+            .all()
+        )
+        pending = [r for r in requests if r.order_id not in assigned]
+        if pending:
+            candidates = find_candidates(db, pending)
+            for request in sorted(pending, key=lambda r: -r.total_weight):
+                feasible = [
+                    drone for drone in candidates
+                    if check_assignment(drone, *request.destination, request.total_weight) is None
+                ]
+                feasible.sort(key=lambda drone: (
+                    calculate_distance(drone.current_lat, drone.current_lng, *request.pickup),
+                    -drone.battery_level,
+                ))
+                for drone in feasible:
+                    candidates.remove(drone)
+                    if assign_drone_to_order(db, drone, request.order_id, *request.destination):
+                        assigned[request.order_id] = drone.id
+                        break
+        db.commit()
+        cache_drones(db, list(assigned.values()))
+        return assigned
+    finally:
+        db.close()
+
+class Dispatcher:
+    """
+    Nhận đơn ready từ ORDER_EVENTS_STREAM (consumer group), gom thành batch trong
+    DISPATCH_WINDOW_SECONDS rồi gán drone cho cả batch với một lần tìm candidate.
+    Event chỉ được ack khi đơn đã có drone và order_service đã ghi drone_id;
+    không có drone -> event được nhận lại sau EVENT_CONSUMER_CLAIM_IDLE_MS.
+    """
+    
+    def __init__(self):
+        self.pending: List[DispatchRequest] = []
+        self._has_work = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    def start(self):
+        self._client = httpx.AsyncClient(
+            base_url=ORDER_SERVICE_URL,
+            timeout=10.0,
+            event_hooks=metrics.upstream_hooks("order"),
+        )
+        self._tasks = [
+            asyncio.create_task(self._run()),
+            asyncio.create_task(events.consume(
+                events.ORDER_EVENTS_STREAM,
+                DISPATCH_CONSUMER_GROUP,
+                DISPATCH_CONSUMER_NAME,
+                self.handle_event,
+                concurrent=True,
+            )),
+        ]
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def handle_event(self, event: dict):
+        payload = event["payload"]
+        if event["type"] != "order.status_changed" or payload.get("status") != "ready":
+            return
+        
+        request = DispatchRequest(
+            order_id=event["order_id"],
+            total_weight=payload.get("total_weight") or 0.0,
+            pickup=(
+                payload.get("restaurant_lat") or DRONE_DEFAULT_LAT,
+                payload.get("restaurant_lng") or DRONE_DEFAULT_LNG,
+            ),
+            destination=(
+                payload.get("delivery_lat") or DRONE_DEFAULT_LAT,
+                payload.get("delivery_lng") or DRONE_DEFAULT_LNG,
+            ),
+        )
+        drone_id = await self.submit(request)
+        
+        res = await self._client.post(
+            f"/orders/{request.order_id}/assign-drone",
+            json={"drone_id": drone_id},
+            headers={"Authorization": auth.service_authorization("drone_service")},
+        )
+        if res.status_code in (404, 409):
+            # Đơn không còn ở trạng thái ready (vd bị hủy) hoặc không còn (archive / xóa)
+            # -> trả drone và ack, không retry mãi
+            await asyncio.to_thread(release_drone, drone_id, request.order_id)
+            print(f"⚠️ Dispatch: order {request.order_id} no longer ready ({res.status_code}), drone #{drone_id} released")
+            return
+        res.raise_for_status()
+        print(f"🚁 Dispatch: drone #{drone_id} -> order {request.order_id}")
+    
+    async def submit(self, request: DispatchRequest) -> int:
+        request.future = asyncio.get_running_loop().create_future()
+        self.pending.append(request)
+        self._has_work.set()
+        return await request.future
+    
+    async def _run(self):
+        while True:
+            await self._has_work.wait()
+            if len(self.pending) < DISPATCH_BATCH_SIZE:
+                await asyncio.sleep(DISPATCH_WINDOW_SECONDS)
+            batch = self.pending[:DISPATCH_BATCH_SIZE]
+            self.pending = self.pending[DISPATCH_BATCH_SIZE:]
+            if not self.pending:
+                self._has_work.clear()
             
-            db.commit()
-            db.close()
+            try:
+                assigned = await asyncio.to_thread(dispatch_batch, batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
             
-        except Exception as e:
-            print(f"❌ Tracking error: {e}")
-        
-        time.sleep(DRONE_GPS_UPDATE_INTERVAL)
+            for request in batch:
+                if request.future.done():
+                    continue
+                drone_id = assigned.get(request.order_id)
+                if drone_id is None:
+                    request.future.set_exception(NoDroneAvailable(f"No drone available for order {request.order_id}"))
+                else:
+                    request.future.set_result(drone_id)
+
+dispatcher = Dispatcher()
+
+def release_drone(drone_id: int, order_id: int):
+    """Trả drone về idle nếu nó vẫn đang giữ order_id (bù cho gán thất bại)"""
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(Drone)
+            .where(Drone.id == drone_id, Drone.assigned_order_id == order_id)
+            .values(status="idle", assigned_order_id=None, destination_lat=None, destination_lng=None)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+        cache_drones(db, [drone_id])
+    finally:
+        db.close()
+
+@app.on_event("shutdown")
+async def stop_dispatcher():
+    await dispatcher.stop()
+
+@app.on_event("shutdown")
+async def stop_simulation():
+    if _simulation_task is not None:
+        _simulation_task.cancel()
+        try:
+            await _simulation_task
+        except asyncio.CancelledError:
+            pass
+    await leader_lock.release()
+    # Chờ tick đang chạy (nếu có) xong rồi mới flush telemetry
+    await asyncio.to_thread(simulation_executor.shutdown, wait=True)
+    await asyncio.to_thread(telemetry.stop)
 
 # ==========================================
 # REST API ROUTES
@@ -368,6 +1137,59 @@ async def list_drones(
         query = query.filter(Drone.status == status)
     return query.all()
 
+@app.get("/drones/nearby")
+async def get_nearby_drones(
+    lat: float = Query(..., ge=-85, le=85),
+    lng: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(5.0, gt=0, le=NEARBY_MAX_RADIUS_KM),
+    status: str = "idle",
+    limit: int = Query(20, ge=1, le=500),
+):
+    """Drone gần một điểm nhất (GEOSEARCH trên Redis, không đọc DB)"""
+    if status not in STATUS_CODES:
+        raise HTTPException(status_code=400, detail=f"Unknown status: {status}")
+    try:
+        found = nearby_drones(lat, lng, radius_km, status, limit)
+        cached = redis_client.mget([tracking_key(drone_id) for drone_id, *_ in found]) if found else []
+    except redis.RedisError:
+        raise HTTPException(status_code=503, detail="Position index unavailable")
+    result = []
+    for (drone_id, distance, drone_lat, drone_lng), raw in zip(found, cached):
+        position = json.loads(raw) if raw else {}
+        result.append({
+            "drone_id": drone_id,
+            "distance_km": round(distance, 3),
+            "lat": drone_lat,
+            "lng": drone_lng,
+            "status": status,
+            "battery": position.get("battery"),
+        })
+    return result
+
+@app.get("/drones/positions")
+async def get_positions(
+    ids: str = Query(..., description="Comma-separated drone ids"),
+    db: Session = Depends(get_db)
+):
+    """Vị trí hiện tại của nhiều drone: một MGET trên Redis, drone nào không có trong cache thì đọc DB một lần"""
+    try:
+        drone_ids = list(dict.fromkeys(int(value) for value in ids.split(",") if value.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be comma-separated integers")
+    if not drone_ids:
+        return []
+    if len(drone_ids) > 1000:
+        raise HTTPException(status_code=400, detail="At most 1000 ids per request")
+    
+    cached = redis_client.mget([tracking_key(drone_id) for drone_id in drone_ids])
+    positions = {drone_id: json.loads(raw) for drone_id, raw in zip(drone_ids, cached) if raw}
+    
+    missing = [drone_id for drone_id in drone_ids if drone_id not in positions]
+    if missing:
+        for drone in db.query(Drone).filter(Drone.id.in_(missing)).all():
+            positions[drone.id] = position_entry(drone)
+    return [positions[drone_id] for drone_id in drone_ids if drone_id in positions]
+
 @app.get("/drones/{drone_id}", response_model=DroneResponse)
 async def get_drone(drone_id: int, db: Session = Depends(get_db)):
     """Get drone details"""
@@ -392,6 +1214,7 @@ async def create_drone(drone_data: DroneCreate, db: Session = Depends(get_db)):
     db.add(new_drone)
     db.commit()
     db.refresh(new_drone)
+    cache_drones(db, [new_drone.id])
     return new_drone
 
 # --- DRONE OPERATIONS ---
@@ -408,29 +1231,18 @@ async def assign_drone(
         raise HTTPException(status_code=404, detail="Drone not found")
     
     # Check requirements
-    if drone.status != "idle":
-        raise HTTPException(status_code=400, detail=f"Drone is {drone.status}")
-    
-    if drone.battery_level < 20:
-        raise HTTPException(status_code=400, detail="Battery too low")
-    
-    distance = calculate_distance(
-        drone.current_lat, drone.current_lng,
-        request.destination_lat, request.destination_lng
-    )
-    
-    if distance > drone.max_distance_km:
-        raise HTTPException(status_code=400, detail="Distance exceeds drone range")
+    reason = check_assignment(drone, request.destination_lat, request.destination_lng, request.total_weight)
+    if reason:
+        raise HTTPException(status_code=400, detail=reason)
     
     # Assign
-    drone.status = "in_delivery"
-    drone.assigned_order_id = request.order_id
-    drone.destination_lat = request.destination_lat
-    drone.destination_lng = request.destination_lng
-    drone.last_update = datetime.utcnow()
+    if not assign_drone_to_order(db, drone, request.order_id, request.destination_lat, request.destination_lng):
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Drone was assigned concurrently")
     
     db.commit()
     db.refresh(drone)
+    cache_drones(db, [drone.id])
     
     return {"message": "Drone assigned", "drone": drone}
 
@@ -446,6 +1258,7 @@ async def charge_drone(drone_id: int, db: Session = Depends(get_db)):
     drone.destination_lat = None
     drone.destination_lng = None
     db.commit()
+    cache_drones(db, [drone_id])
     return {"message": "Drone charging", "battery": 100.0}
 
 @app.post("/drones/{drone_id}/return")
@@ -462,6 +1275,7 @@ async def return_drone(drone_id: int, db: Session = Depends(get_db)):
     drone.destination_lat = drone.base_lat
     drone.destination_lng = drone.base_lng
     db.commit()
+    cache_drones(db, [drone_id])
     return {"message": "Drone returning to base"}
 
 @app.post("/drones/{drone_id}/maintenance")
@@ -475,6 +1289,7 @@ async def maintenance_mode(drone_id: int, db: Session = Depends(get_db)):
     drone.destination_lat = None
     drone.destination_lng = None
     db.commit()
+    cache_drones(db, [drone_id])
     return {"message": "Drone in maintenance"}
 
 # --- TRACKING ---
@@ -499,7 +1314,7 @@ async def get_current_position(drone_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Drone not found")
     
     # Try Redis first (fresher data)
-    cached = redis_client.get(f"drone:{drone_id}:tracking")
+    cached = redis_client.get(tracking_key(drone_id))
     if cached:
         return json.loads(cached)
     
@@ -543,45 +1358,314 @@ async def get_drone_stats(drone_id: int, db: Session = Depends(get_db)):
 
 # --- REAL-TIME UPDATES (WebSocket) ---
 
-manager = {}  # Store active WebSocket connections
+class WebSocketClient:
+    """
+    Một WebSocket với hàng đợi gửi giới hạn: broadcaster chỉ put_nowait,
+    task riêng gửi ra socket. Hàng đợi đầy (client chậm) -> ngắt client.
+    """
+    
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.closed = False
+        self._sender: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self._sender = asyncio.create_task(self._send_loop())
+    
+    def send(self, text: str):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            self.closed = True
+            ws_clients_dropped.inc()
+            asyncio.create_task(self._close(1013))
+    
+    async def _send_loop(self):
+        try:
+            while True:
+                await self.websocket.send_text(await self.queue.get())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.closed = True
+    
+    async def _close(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+    
+    async def stop(self):
+        self.closed = True
+        if self._sender is not None:
+            self._sender.cancel()
+            try:
+                await self._sender
+            except asyncio.CancelledError:
+                pass
+
+def round_position(entry: dict) -> dict:
+    """Bản ghi gọn cho fleet channel (~10cm, pin 0.1%)"""
+    return {
+        "id": entry["drone_id"],
+        "lat": round(entry["lat"], 6) if entry["lat"] is not None else None,
+        "lng": round(entry["lng"], 6) if entry["lng"] is not None else None,
+        "status": entry["status"],
+        "battery": round(entry["battery"], 1) if entry.get("battery") is not None else None,
+    }
+
+class FleetClient(WebSocketClient):
+    """
+    Client của /ws/fleet: chỉ nhận drone trong viewport (bbox) và chỉ các field đã đổi
+    so với lần gửi trước (delta). Drone ra khỏi viewport -> "removed".
+    """
+    
+    def __init__(self, websocket: WebSocket):
+        super().__init__(websocket)
+        self.bbox: Optional[tuple] = None  # (south, west, north, east)
+        self.last: Dict[int, dict] = {}
+    
+    def contains(self, entry: dict) -> bool:
+        if self.bbox is None:
+            return True
+        if entry["lat"] is None or entry["lng"] is None:
+            return False
+        south, west, north, east = self.bbox
+        return south <= entry["lat"] <= north and west <= entry["lng"] <= east
+    
+    def snapshot(self, entries: List[dict]):
+        self.last = {entry["drone_id"]: round_position(entry) for entry in entries if self.contains(entry)}
+        self.send(json.dumps({"type": "fleet_snapshot", "drones": list(self.last.values())}))
+    
+    def push(self, entries: List[dict]):
+        updates, removed = [], []
+        for entry in entries:
+            drone_id = entry["drone_id"]
+            previous = self.last.get(drone_id)
+            if not self.contains(entry):
+                if previous is not None:
+                    del self.last[drone_id]
+                    removed.append(drone_id)
+                continue
+            current = round_position(entry)
+            if previous is None:
+                updates.append(current)
+            else:
+                changed = {key: value for key, value in current.items() if previous[key] != value}
+                if not changed:
+                    continue
+                updates.append({"id": drone_id, **changed})
+            self.last[drone_id] = current
+        if updates or removed:
+            self.send(json.dumps({"type": "fleet_delta", "updates": updates, "removed": removed}))
+
+ws_clients_dropped = metrics.counter(
+    "drone_ws_clients_dropped_total", "WebSocket clients disconnected for falling behind")
+
+class PositionBroadcaster:
+    """
+    Một subscription Redis (DRONE_POSITIONS_CHANNEL) mỗi worker, đẩy thay đổi vị trí cho:
+    - subscriber của từng drone (/ws/drone/{id}): message serialize một lần, dùng chung
+    - client /ws/fleet: lọc theo viewport + delta riêng từng client
+    """
+    
+    def __init__(self):
+        self.drone_clients: Dict[int, Set[WebSocketClient]] = {}
+        self.fleet_clients: Set[FleetClient] = set()
+        self._task: Optional[asyncio.Task] = None
+        metrics.gauge(
+            "drone_ws_clients", "Connected WebSocket clients", ("channel",),
+            callback=lambda: {
+                ("drone",): sum(len(clients) for clients in list(self.drone_clients.values())),
+                ("fleet",): len(self.fleet_clients),
+            },
+        )
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    def add_drone_client(self, drone_id: int, client: WebSocketClient):
+        self.drone_clients.setdefault(drone_id, set()).add(client)
+    
+    def remove_drone_client(self, drone_id: int, client: WebSocketClient):
+        clients = self.drone_clients.get(drone_id)
+        if clients is not None:
+            clients.discard(client)
+            if not clients:
+                del self.drone_clients[drone_id]
+    
+    async def _listen(self):
+        while True:
+            try:
+                pubsub = auth.get_redis().pubsub()
+                await pubsub.subscribe(DRONE_POSITIONS_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.dispatch(json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Position broadcaster error: {e}")
+                await asyncio.sleep(5)
+    
+    def dispatch(self, entries: List[dict]):
+        if self.drone_clients:
+            for entry in entries:
+                clients = self.drone_clients.get(entry["drone_id"])
+                if clients:
+                    text = json.dumps({"type": "position_update", **entry})
+                    for client in list(clients):
+                        client.send(text)
+        for client in list(self.fleet_clients):
+            client.push(entries)
+
+broadcaster = PositionBroadcaster()
+manager = broadcaster.drone_clients  # drone_id -> clients đang theo dõi
+
+async def load_positions(bbox: Optional[tuple]) -> List[dict]:
+    """Vị trí mới nhất của mọi drone (trong bbox) từ GEO set + tracking cache, không đọc DB"""
+    if bbox is None:
+        # Bán kính nửa vòng trái đất quanh (0, 0): phủ toàn bộ
+        area = {"longitude": 0, "latitude": 0, "radius": 20038}
+    else:
+        south, west, north, east = bbox
+        center_lat, center_lng = (south + north) / 2, (west + east) / 2
+        area = {
+            "longitude": center_lng,
+            "latitude": center_lat,
+            "width": max(calculate_distance(center_lat, west, center_lat, east), 0.001) * 1.01,
+            "height": max(calculate_distance(south, center_lng, north, center_lng), 0.001) * 1.01,
+        }
+    
+    redis = auth.get_redis()
+    pipe = redis.pipeline(transaction=False)
+    for status in STATUSES:
+        pipe.geosearch(geo_key(status), unit="km", withcoord=True, **area)
+    found = [
+        (int(member), status, coord)
+        for status, results in zip(STATUSES, await pipe.execute())
+        for member, coord in results
+    ]
+    if not found:
+        return []
+    
+    cached = await redis.mget([tracking_key(drone_id) for drone_id, _, _ in found])
+    entries = []
+    for (drone_id, status, (lng, lat)), raw in zip(found, cached):
+        if raw:
+            entries.append(json.loads(raw))
+        else:
+            # Tracking key đã hết hạn (drone đứng yên): dùng tọa độ trong GEO set
+            entries.append({"drone_id": drone_id, "lat": lat, "lng": lng, "status": status, "battery": None})
+    return entries
+
+@app.on_event("startup")
+async def start_broadcaster():
+    broadcaster.start()
+
+@app.on_event("shutdown")
+async def stop_broadcaster():
+    await broadcaster.stop()
 
 @app.websocket("/ws/drone/{drone_id}")
 async def websocket_drone_tracking(websocket: WebSocket, drone_id: int):
-    """WebSocket for real-time drone tracking"""
+    """
+    WebSocket: vị trí hiện tại khi kết nối, sau đó server tự đẩy mỗi lần drone đổi vị trí / trạng thái.
+    Redis lỗi khi lấy vị trí ban đầu -> đóng với code 1011.
+    """
     await websocket.accept()
-    
-    if drone_id not in manager:
-        manager[drone_id] = []
-    manager[drone_id].append(websocket)
-    
+    client = WebSocketClient(websocket)
     try:
-        while True:
-            # Receive message (keep connection alive)
-            data = await websocket.receive_text()
-            
-            # Broadcast position update to all clients
+        client.start()
+        cached = await auth.get_redis().get(tracking_key(drone_id))
+        if cached:
+            client.send(json.dumps({"type": "position_update", **json.loads(cached)}))
+        else:
             db = SessionLocal()
-            drone = db.query(Drone).filter(Drone.id == drone_id).first()
-            db.close()
-            
-            if drone:
-                position = {
-                    "type": "position_update",
-                    "drone_id": drone.id,
-                    "lat": drone.current_lat,
-                    "lng": drone.current_lng,
-                    "status": drone.status,
-                    "battery": drone.battery_level,
-                    "timestamp": datetime.utcnow().isoformat()
-                }
-                await websocket.send_json(position)
-            
-            await asyncio.sleep(1)
-    
+            try:
+                drone = db.query(Drone).filter(Drone.id == drone_id).first()
+                if drone:
+                    client.send(json.dumps({"type": "position_update", **position_entry(drone)}))
+            finally:
+                db.close()
+        
+        broadcaster.add_drone_client(drone_id, client)
+        while not client.closed:
+            # Message từ client chỉ để giữ kết nối (ping)
+            await websocket.receive_text()
+    except redis.RedisError as e:
+        print(f"⚠️ Drone WebSocket: position unavailable: {e}")
+        await client.stop()
+        await client._close(1011)
     except WebSocketDisconnect:
-        manager[drone_id].remove(websocket)
-        if not manager[drone_id]:
-            del manager[drone_id]
+        pass
+    finally:
+        broadcaster.remove_drone_client(drone_id, client)
+        await client.stop()
+
+def parse_bbox(bbox) -> Optional[tuple]:
+    """[south, west, north, east] hợp lệ -> tuple; sai định dạng / ngoài phạm vi -> ValueError"""
+    if bbox is None:
+        return None
+    if not isinstance(bbox, list) or len(bbox) != 4:
+        raise ValueError("bbox must be [south, west, north, east]")
+    try:
+        south, west, north, east = (float(value) for value in bbox)
+    except (TypeError, ValueError):
+        raise ValueError("bbox must be [south, west, north, east]")
+    if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+        raise ValueError("bbox out of range: -90 <= south <= north <= 90, -180 <= west <= east <= 180")
+    return max(south, -GEO_MAX_LAT), west, min(north, GEO_MAX_LAT), east
+
+@app.websocket("/ws/fleet")
+async def websocket_fleet(websocket: WebSocket):
+    """
+    WebSocket cho bản đồ fleet. Client gửi {"type": "viewport", "bbox": [south, west, north, east]}
+    (bbox null = toàn bộ); server trả fleet_snapshot rồi fleet_delta mỗi khi có thay đổi trong viewport.
+    Message sai -> frame {"type": "error"}; Redis lỗi khi lấy snapshot -> đóng với code 1011.
+    """
+    await websocket.accept()
+    client = FleetClient(websocket)
+    client.start()
+    try:
+        client.snapshot(await load_positions(None))
+        broadcaster.fleet_clients.add(client)
+        while not client.closed:
+            message = await websocket.receive_json()
+            if not isinstance(message, dict):
+                client.send(json.dumps({"type": "error", "detail": "message must be a JSON object"}))
+                continue
+            if message.get("type") != "viewport":
+                continue
+            try:
+                bbox = parse_bbox(message.get("bbox"))
+            except ValueError as e:
+                client.send(json.dumps({"type": "error", "detail": str(e)}))
+                continue
+            client.bbox = bbox
+            client.snapshot(await load_positions(bbox))
+    except redis.RedisError as e:
+        print(f"⚠️ Fleet WebSocket: position snapshot unavailable: {e}")
+        await client.stop()
+        await client._close(1011)
+    except (WebSocketDisconnect, ValueError):
+        pass
+    finally:
+        broadcaster.fleet_clients.discard(client)
+        await client.stop()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,148 @@
+import os
+import tempfile
+from datetime import datetime
+
+import pytest
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db"))
+
+from drone_service.main import (
+    ARRIVAL_DISTANCE_KM, CHARGING, DRONE_BATTERY_DRAIN_RATE, IDLE, IN_DELIVERY, LOW_BATTERY_CHARGE,
+    RETURNING, Base, Drone, FleetState, SessionLocal, engine, haversine_km,
+)
+
+BASE = (10.7769, 106.7009)
+
+
+def drone_row(drone_id, status, position, destination, battery=80.0, order_id=None):
+    # Thứ tự như FleetState.COLUMNS
+    return (drone_id, status, *position, *destination, *BASE, battery, 0.0, 0.0, order_id)
+
+
+def test_in_delivery_moves_toward_destination():
+    destination = (10.8769, 106.7009)  # ~11km về phía bắc
+    fleet = FleetState([drone_row(1, "in_delivery", BASE, destination, order_id=5)])
+    fleet.step(60, speed_kmh=60)  # 1 phút ở 60km/h = 1km
+
+    assert fleet.status[0] == IN_DELIVERY
+    assert fleet.lat[0] > BASE[0]
+    assert haversine_km(BASE[0], BASE[1], fleet.lat[0], fleet.lng[0]) == pytest.approx(1.0, rel=1e-3)
+    assert fleet.distance[0] == pytest.approx(1.0)
+    assert fleet.battery[0] == pytest.approx(80.0 - DRONE_BATTERY_DRAIN_RATE)
+    assert fleet.flight_hours[0] == pytest.approx(60 / 3600)
+    assert fleet.speed[0] == pytest.approx(60.0)
+    assert fleet.order_ids[0] == 5
+
+
+def test_delivery_arrival_turns_back_to_base():
+    destination = (10.7809, 106.7009)  # ~450m
+    fleet = FleetState([drone_row(1, "in_delivery", BASE, destination, order_id=5)])
+    fleet.step(60, speed_kmh=60)
+
+    assert fleet.status[0] == RETURNING
+    assert (fleet.lat[0], fleet.lng[0]) == destination
+    assert (fleet.dest_lat[0], fleet.dest_lng[0]) == BASE
+    record = fleet.records()[0]
+    assert record["new_status"] == "returning"
+    assert record["loaded_status"] == "in_delivery"
+    assert record["order_id"] == 5
+    assert record["dest_lat"] == BASE[0]
+
+
+def test_returning_drone_lands_idle():
+    position = (10.7789, 106.7009)
+    fleet = FleetState([drone_row(1, "returning", position, BASE, battery=60.0, order_id=5)])
+    fleet.step(60, speed_kmh=60)
+
+    assert fleet.status[0] == IDLE
+    record = fleet.records()[0]
+    assert record["order_id"] is None
+    assert record["dest_lat"] is None and record["dest_lng"] is None
+    assert (record["lat"], record["lng"]) == BASE
+
+
+def test_returning_drone_with_low_battery_charges():
+    position = (10.7789, 106.7009)
+    fleet = FleetState([drone_row(1, "returning", position, BASE, battery=LOW_BATTERY_CHARGE - 1)])
+    fleet.step(60, speed_kmh=60)
+
+    assert fleet.status[0] == CHARGING
+
+
+def test_just_delivered_drone_does_not_land_in_same_tick():
+    # Đích trùng base: giao xong chỉ chuyển returning, tick sau mới hạ cánh
+    fleet = FleetState([drone_row(1, "in_delivery", BASE, BASE, order_id=5)])
+    fleet.step(1)
+    assert fleet.status[0] == RETURNING
+    assert fleet.order_ids[0] == 5
+
+
+def test_arrival_threshold():
+    # Còn cách đích ít hơn ARRIVAL_DISTANCE_KM sau khi bay = đã tới
+    near = (BASE[0] + (ARRIVAL_DISTANCE_KM * 0.5) / 111, BASE[1])
+    fleet = FleetState([drone_row(1, "returning", near, BASE, battery=60.0)])
+    fleet.step(0.001)
+    assert fleet.status[0] == IDLE
+
+
+def test_battery_never_goes_negative():
+    destination = (11.7769, 106.7009)
+    fleet = FleetState([drone_row(1, "in_delivery", BASE, destination, battery=0.1)])
+    fleet.step(600, speed_kmh=60)
+    assert fleet.battery[0] == 0.0
+    assert fleet.status[0] == IN_DELIVERY
+
+
+def test_steps_each_drone_independently():
+    fleet = FleetState([
+        drone_row(1, "in_delivery", BASE, (10.8769, 106.7009), order_id=5),
+        drone_row(2, "in_delivery", BASE, (10.7809, 106.7009), order_id=6),
+        drone_row(3, "returning", (10.7789, 106.7009), BASE, battery=5.0),
+    ])
+    fleet.step(60, speed_kmh=60)
+    assert fleet.status.tolist() == [IN_DELIVERY, RETURNING, CHARGING]
+    assert [r["order_id"] for r in fleet.records()] == [5, 6, None]
+
+
+def test_empty_fleet():
+    fleet = FleetState([])
+    fleet.step(60)
+    assert len(fleet) == 0
+    assert fleet.records() == []
+
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(bind=engine)
+    session = SessionLocal()
+    yield session
+    session.close()
+    Base.metadata.drop_all(bind=engine)
+
+
+def add_drone(db, status, destination):
+    drone = Drone(name=f"d-{status}", status=status, current_lat=BASE[0], current_lng=BASE[1],
+                  destination_lat=destination[0], destination_lng=destination[1], battery_level=80.0)
+    db.add(drone)
+    db.commit()
+    return drone.id
+
+
+def test_save_skips_drones_changed_since_load(db):
+    destination = (10.8769, 106.7009)
+    flying = add_drone(db, "in_delivery", destination)
+    grounded = add_drone(db, "in_delivery", destination)
+    fleet = FleetState.load(db)
+
+    # API đổi trạng thái drone trong lúc tick đang chạy
+    db.query(Drone).filter(Drone.id == grounded).update({"status": "maintenance"})
+    db.commit()
+
+    fleet.step(60, speed_kmh=60)
+    assert fleet.save(db, datetime.utcnow()) == {flying}
+    db.commit()
+
+    db.expire_all()
+    assert db.get(Drone, flying).current_lat > BASE[0]
+    assert db.get(Drone, grounded).status == "maintenance"
+    assert db.get(Drone, grounded).current_lat == BASE[0]
@@ -232,6 +232,13 @@ CREATE TABLE order_status_history (
     note NVARCHAR(MAX),
     changed_at DATETIME DEFAULT GETDATE()
 );
+
+CREATE INDEX ix_orders_restaurant_status_created ON orders (restaurant_id, status, created_at, id);
+CREATE INDEX ix_orders_restaurant_created ON orders (restaurant_id, created_at, id);
+CREATE INDEX ix_orders_user_created ON orders (user_id, created_at, id);
+CREATE INDEX ix_orders_status_updated ON orders (status, updated_at);
+CREATE INDEX ix_order_items_order_id ON order_items (order_id);
+CREATE INDEX ix_order_status_history_order_id ON order_status_history (order_id);
 GO
 
 -- ==========================================
@@ -1,15 +1,30 @@
-from fastapi import FastAPI, Depends, HTTPException, Header, status
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, Header, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, Enum as SQLEnum
+from sqlalchemy import create_engine, Column, Integer, String, Float, Date, DateTime, Text, Index, UniqueConstraint, Enum as SQLEnum, and_, or_, delete, insert, literal, select, update as sql_update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from pydantic import BaseModel
-from typing import Optional, List
-from datetime import datetime
+from typing import Callable, Dict, Optional, List
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+import argparse
+import asyncio
+import base64
 import enum
+import hashlib
+import hmac
+import json
 import os
 import httpx
 import math
+import re
+import time
+import uuid
+import redis
+from common import auth, events, idempotency, metrics
+from common.auth import SERVICE_ROLE, get_redis, verify_token
 
 # ==========================================
 # CONFIG
@@ -19,7 +34,47 @@ CART_SERVICE_URL = os.getenv("CART_SERVICE_URL", "http://cart_service:8000")
 PRODUCT_SERVICE_URL = os.getenv("PRODUCT_SERVICE_URL", "http://product_service:8000")
 PAYMENT_SERVICE_URL = os.getenv("PAYMENT_SERVICE_URL", "http://payment_service:8000")
 DELIVERY_SERVICE_URL = os.getenv("DELIVERY_SERVICE_URL", "http://delivery_service:8000")
-USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user_service:8000")
+
+# Số order_id tối đa trong một câu IN (...) (SQL Server giới hạn 2100 parameter)
+ORDER_LOAD_BATCH_SIZE = int(os.getenv("ORDER_LOAD_BATCH_SIZE", "1000"))
+
+# HTTP client dùng chung tới các service khác (keep-alive, giới hạn connection)
+DOWNSTREAM_MAX_CONNECTIONS = int(os.getenv("DOWNSTREAM_MAX_CONNECTIONS", "50"))
+DOWNSTREAM_MAX_KEEPALIVE = int(os.getenv("DOWNSTREAM_MAX_KEEPALIVE", "10"))
+DOWNSTREAM_TIMEOUT = float(os.getenv("DOWNSTREAM_TIMEOUT", "10"))
+# Số call song song tối đa trong một checkout (vd tạo payment + xóa giỏ hàng)
+CHECKOUT_FANOUT_CONCURRENCY = int(os.getenv("CHECKOUT_FANOUT_CONCURRENCY", "8"))
+
+# Outbox: event đổi trạng thái đơn -> Redis Stream (events.ORDER_EVENTS_STREAM)
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "200"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+OUTBOX_RETENTION_HOURS = int(os.getenv("OUTBOX_RETENTION_HOURS", "24"))  # xóa event đã publish sau N giờ
+ORDER_EVENTS_MAXLEN = int(os.getenv("ORDER_EVENTS_MAXLEN", "100000"))
+
+# Server-sent events (GET /orders/{id}/events, GET /orders/stream)
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", "100"))  # client chậm hơn -> ngắt, client resume bằng Last-Event-ID
+SSE_RETRY_MS = int(os.getenv("SSE_RETRY_MS", "3000"))
+
+# Phân trang GET /orders (keyset trên created_at, id)
+ORDER_PAGE_DEFAULT_LIMIT = int(os.getenv("ORDER_PAGE_DEFAULT_LIMIT", "50"))
+ORDER_PAGE_MAX_LIMIT = int(os.getenv("ORDER_PAGE_MAX_LIMIT", "200"))
+ORDER_CURSOR_SECRET = os.getenv("ORDER_CURSOR_SECRET", auth.JWT_SECRET)  # ký cursor, client không sửa được
+
+# Analytics (GET /orders/analytics đọc bảng rollup theo ngày)
+ANALYTICS_DEFAULT_DAYS = int(os.getenv("ANALYTICS_DEFAULT_DAYS", "30"))
+ANALYTICS_MAX_DAYS = int(os.getenv("ANALYTICS_MAX_DAYS", "366"))
+ANALYTICS_BACKFILL_BATCH_SIZE = int(os.getenv("ANALYTICS_BACKFILL_BATCH_SIZE", "1000"))
+
+# Archive: đơn đã kết thúc lâu -> bảng *_archive, giữ bảng chính nhỏ
+# Tắt mặc định: chỉ bật ARCHIVE_ENABLED=true trên đúng một replica, tránh nhiều replica
+# cùng chuyển một batch (tranh chấp lock, làm việc thừa)
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "false").lower() == "true"
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))  # số đơn mỗi transaction
+ARCHIVE_BATCH_PAUSE = float(os.getenv("ARCHIVE_BATCH_PAUSE", "0.1"))  # nghỉ giữa các batch, giảm tranh chấp lock
+ARCHIVE_INTERVAL_SECONDS = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
 
 # Database
 engine = create_engine(DATABASE_URL, echo=False)
@@ -63,6 +118,14 @@ class Order(Base):
     notes = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Index cho GET /orders: filter theo restaurant/user (+ status), sort theo (created_at, id)
+    __table_args__ = (
+        Index("ix_orders_restaurant_status_created", "restaurant_id", "status", "created_at", "id"),
+        Index("ix_orders_restaurant_created", "restaurant_id", "created_at", "id"),
+        Index("ix_orders_user_created", "user_id", "created_at", "id"),
+        Index("ix_orders_status_updated", "status", "updated_at"),
+    )
 
 class OrderItem(Base):
     __tablename__ = "order_items"
@@ -86,6 +149,96 @@ class OrderStatusHistory(Base):
     note = Column(Text, nullable=True)
     changed_at = Column(DateTime, default=datetime.utcnow)
 
+class OutboxEvent(Base):
+    """Event chờ publish, ghi cùng transaction với thay đổi trạng thái đơn"""
+    __tablename__ = "order_outbox"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    event_id = Column(String(36), nullable=False, unique=True)
+    event_type = Column(String(50), nullable=False)
+    order_id = Column(Integer, nullable=False)
+    payload = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    published_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        Index("ix_order_outbox_published", "published_at", "id"),
+    )
+
+# Bảng archive: cùng cột (và id) với bảng chính, chỉ đọc khi include_archived=true
+class ArchivedOrder(Base):
+    __tablename__ = "orders_archive"
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, nullable=False)
+    restaurant_id = Column(Integer, nullable=False)
+    total_amount = Column(Float, nullable=False)
+    total_weight = Column(Float, default=0)
+    status = Column(SQLEnum(OrderStatus), nullable=False)
+    delivery_address = Column(String(500), nullable=False)
+    delivery_lat = Column(Float, nullable=True)
+    delivery_lng = Column(Float, nullable=True)
+    restaurant_lat = Column(Float, nullable=True)
+    restaurant_lng = Column(Float, nullable=True)
+    distance_km = Column(Float, nullable=True)
+    drone_id = Column(Integer, nullable=True)
+    estimated_delivery_time = Column(Integer, default=30)
+    rejection_reason = Column(Text, nullable=True)
+    notes = Column(Text, nullable=True)
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_orders_archive_restaurant_created", "restaurant_id", "created_at", "id"),
+        Index("ix_orders_archive_user_created", "user_id", "created_at", "id"),
+    )
+
+class ArchivedOrderItem(Base):
+    __tablename__ = "order_items_archive"
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    order_id = Column(Integer, nullable=False, index=True)
+    product_id = Column(Integer, nullable=False)
+    product_name = Column(String(255), nullable=False)
+    quantity = Column(Integer, nullable=False)
+    price = Column(Float, nullable=False)
+    weight = Column(Float, default=0.5)
+
+class ArchivedOrderStatusHistory(Base):
+    __tablename__ = "order_status_history_archive"
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    order_id = Column(Integer, nullable=False, index=True)
+    status = Column(String(50), nullable=False)
+    changed_by = Column(Integer, nullable=True)
+    role = Column(String(50), nullable=True)
+    note = Column(Text, nullable=True)
+    changed_at = Column(DateTime)
+
+class OrderDailyStats(Base):
+    """
+    Rollup theo (nhà hàng, ngày tạo đơn, trạng thái hiện tại), cập nhật cùng transaction
+    với mỗi lần đổi trạng thái: đơn chuyển trạng thái -> trừ ở dòng cũ, cộng vào dòng mới.
+    Ngày tính theo created_at (UTC).
+    """
+    __tablename__ = "order_daily_stats"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    restaurant_id = Column(Integer, nullable=False)
+    day = Column(Date, nullable=False)
+    status = Column(String(50), nullable=False)
+    order_count = Column(Integer, nullable=False, default=0)
+    total_amount = Column(Float, nullable=False, default=0)
+    total_weight = Column(Float, nullable=False, default=0)
+    # Tổng thời gian từ lúc đặt tới lúc giao (giây), chỉ có ở dòng delivered
+    delivery_seconds = Column(Float, nullable=False, default=0)
+    
+    __table_args__ = (
+        UniqueConstraint("restaurant_id", "day", "status", name="uq_order_daily_stats"),
+        Index("ix_order_daily_stats_day", "day", "restaurant_id"),
+    )
+
 # ==========================================
 # PYDANTIC MODELS
 # ==========================================
@@ -131,6 +284,7 @@ class OrderResponse(BaseModel):
     drone_id: Optional[int]
     estimated_delivery_time: Optional[int]
     created_at: datetime
+    archived: bool = False
     items: List[OrderItemResponse] = []
     history: List[OrderStatusHistoryResponse] = []
     class Config:
@@ -142,6 +296,31 @@ class OrderStatusUpdate(BaseModel):
 class OrderReject(BaseModel):
     reason: str
 
+class OrderDroneAssignment(BaseModel):
+    drone_id: int
+
+class OrderAnalyticsRow(BaseModel):
+    restaurant_id: int
+    day: date
+    status: OrderStatus
+    order_count: int
+    total_amount: float
+    total_weight: float
+    avg_delivery_minutes: Optional[float] = None
+
+class OrderAnalyticsTotals(BaseModel):
+    order_count: int = 0
+    total_amount: float = 0
+    total_weight: float = 0
+    delivered_count: int = 0
+    avg_delivery_minutes: Optional[float] = None
+
+class OrderAnalyticsResponse(BaseModel):
+    date_from: date
+    date_to: date
+    rows: List[OrderAnalyticsRow]
+    totals: OrderAnalyticsTotals
+
 # ==========================================
 # APP SETUP
 # ==========================================
@@ -153,7 +332,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+auth.install(app)
+metrics.install(app, engine=engine)
 
 def get_db():
     db = SessionLocal()
@@ -162,24 +344,149 @@ def get_db():
     finally:
         db.close()
 
-async def verify_token(authorization: str = Header(None)):
-    """Verify JWT token"""
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Not authenticated")
+# ==========================================
+# ANALYTICS ROLLUPS
+# ==========================================
+def rollup_entry(order) -> tuple:
+    """Phần đóng góp của một đơn vào bảng rollup: (key, (count, amount, weight, delivery_seconds))"""
+    status = OrderStatus(order.status)
+    delivery_seconds = 0.0
+    if status == OrderStatus.DELIVERED and order.updated_at and order.created_at:
+        delivery_seconds = max((order.updated_at - order.created_at).total_seconds(), 0.0)
+    key = (order.restaurant_id, order.created_at.date(), status.value)
+    return key, (1, order.total_amount or 0.0, order.total_weight or 0.0, delivery_seconds)
+
+def adjust_rollup(db: Session, key: tuple, delta: tuple):
+    restaurant_id, day, status = key
+    order_count, total_amount, total_weight, delivery_seconds = delta
+    condition = and_(
+        OrderDailyStats.restaurant_id == restaurant_id,
+        OrderDailyStats.day == day,
+        OrderDailyStats.status == status,
+    )
+    increment = sql_update(OrderDailyStats).where(condition).values(
+        order_count=OrderDailyStats.order_count + order_count,
+        total_amount=OrderDailyStats.total_amount + total_amount,
+        total_weight=OrderDailyStats.total_weight + total_weight,
+        delivery_seconds=OrderDailyStats.delivery_seconds + delivery_seconds,
+    ).execution_options(synchronize_session=False)
     
-    token = authorization.split(" ")[1]
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                f"{USER_SERVICE_URL}/verify-token",
-                headers={"Authorization": f"Bearer {token}"},
-                timeout=5.0
+    if db.execute(increment).rowcount:
+        return
+    try:
+        with db.begin_nested():
+            db.add(OrderDailyStats(
+                restaurant_id=restaurant_id,
+                day=day,
+                status=status,
+                order_count=order_count,
+                total_amount=total_amount,
+                total_weight=total_weight,
+                delivery_seconds=delivery_seconds,
+            ))
+    except IntegrityError:
+        # Request khác vừa tạo dòng này
+        db.execute(increment)
+
+def update_rollup(db: Session, before: Optional[tuple], order: Order):
+    """
+    Ghi lần đổi trạng thái vào rollup (không commit, chạy trong transaction của caller).
+    before = rollup_entry(order) lấy trước khi sửa đơn; None với đơn mới.
+    """
+    after = rollup_entry(order)
+    if before == after:
+        return
+    if before is not None:
+        key, values = before
+        adjust_rollup(db, key, tuple(-value for value in values))
+    adjust_rollup(db, *after)
+
+def backfill_rollups(date_from: Optional[date] = None, date_to: Optional[date] = None) -> int:
+    """
+    Dựng lại rollup từ orders + orders_archive cho khoảng ngày [date_from, date_to] (mặc định: tất cả),
+    trong một transaction. Chạy lại bao nhiêu lần cũng được; trả số dòng rollup.
+    """
+    db = SessionLocal()
+    try:
+        stats = db.query(OrderDailyStats)
+        if date_from:
+            stats = stats.filter(OrderDailyStats.day >= date_from)
+        if date_to:
+            stats = stats.filter(OrderDailyStats.day <= date_to)
+        
+        totals: Dict[tuple, list] = defaultdict(lambda: [0, 0.0, 0.0, 0.0])
+        # Đơn đã archive vẫn nằm trong rollup
+        for model in (Order, ArchivedOrder):
+            orders = db.query(model)
+            if date_from:
+                orders = orders.filter(model.created_at >= datetime.combine(date_from, datetime.min.time()))
+            if date_to:
+                orders = orders.filter(model.created_at < datetime.combine(date_to + timedelta(days=1), datetime.min.time()))
+            for order in orders.order_by(model.id).yield_per(ANALYTICS_BACKFILL_BATCH_SIZE):
+                key, values = rollup_entry(order)
+                entry = totals[key]
+                for i, value in enumerate(values):
+                    entry[i] += value
+        
+        stats.delete(synchronize_session=False)
+        db.add_all([
+            OrderDailyStats(
+                restaurant_id=restaurant_id,
+                day=day,
+                status=status,
+                order_count=order_count,
+                total_amount=total_amount,
+                total_weight=total_weight,
+                delivery_seconds=delivery_seconds,
             )
-            if response.status_code == 200:
-                return response.json()
-            raise HTTPException(status_code=401, detail="Invalid token")
-        except:
-            raise HTTPException(status_code=401, detail="Auth failed")
+            for (restaurant_id, day, status), (order_count, total_amount, total_weight, delivery_seconds)
+            in totals.items()
+        ])
+        db.commit()
+        return len(totals)
+    finally:
+        db.close()
+
+# ==========================================
+# DOWNSTREAM CLIENTS
+# ==========================================
+DOWNSTREAM_URLS = {
+    "cart": CART_SERVICE_URL,
+    "product": PRODUCT_SERVICE_URL,
+    "payment": PAYMENT_SERVICE_URL,
+}
+_clients: Dict[str, httpx.AsyncClient] = {}
+
+def get_client(name: str) -> httpx.AsyncClient:
+    """httpx client dùng chung cho một service (tạo lần đầu dùng)"""
+    client = _clients.get(name)
+    if client is None:
+        client = _clients[name] = httpx.AsyncClient(
+            base_url=DOWNSTREAM_URLS[name],
+            limits=httpx.Limits(
+                max_connections=DOWNSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=DOWNSTREAM_MAX_KEEPALIVE,
+            ),
+            timeout=DOWNSTREAM_TIMEOUT,
+            event_hooks=metrics.upstream_hooks(name),
+        )
+    return client
+
+@app.on_event("shutdown")
+async def close_clients():
+    for client in _clients.values():
+        await client.aclose()
+    _clients.clear()
+
+async def gather_bounded(calls, limit: int = CHECKOUT_FANOUT_CONCURRENCY) -> list:
+    """Chạy các coroutine song song, tối đa `limit` cái cùng lúc; lỗi được trả về thay vì raise"""
+    semaphore = asyncio.Semaphore(limit)
+    
+    async def run(call):
+        async with semaphore:
+            return await call
+    
+    return await asyncio.gather(*(run(call) for call in calls), return_exceptions=True)
 
 def calculate_distance(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
     """Haversine formula"""
@@ -192,11 +499,479 @@ def calculate_distance(lat1: float, lng1: float, lat2: float, lng2: float) -> fl
     c = 2 * math.asin(math.sqrt(a))
     return R * c
 
+def load_children(db: Session, model, response_model, order_ids: List[int], into: Dict[int, list]):
+    """Dòng con (items / history) của nhiều order, một câu IN (...) mỗi batch"""
+    for start in range(0, len(order_ids), ORDER_LOAD_BATCH_SIZE):
+        batch = order_ids[start:start + ORDER_LOAD_BATCH_SIZE]
+        rows = (
+            db.query(model)
+            .filter(model.order_id.in_(batch))
+            .order_by(model.id)
+            .all()
+        )
+        for row in rows:
+            into[row.order_id].append(response_model.from_orm(row))
+
+def load_order_responses(db: Session, orders: list) -> List[OrderResponse]:
+    """
+    Build OrderResponse cho cả danh sách order: items + history lấy bằng
+    một câu IN (...) mỗi bảng (theo batch), không query lại từng order.
+    Danh sách có thể lẫn Order và ArchivedOrder (include_archived).
+    """
+    items_by_order: Dict[int, list] = defaultdict(list)
+    hist_by_order: Dict[int, list] = defaultdict(list)
+    hot_ids = [order.id for order in orders if not isinstance(order, ArchivedOrder)]
+    archived_ids = [order.id for order in orders if isinstance(order, ArchivedOrder)]
+    
+    load_children(db, OrderItem, OrderItemResponse, hot_ids, items_by_order)
+    load_children(db, OrderStatusHistory, OrderStatusHistoryResponse, hot_ids, hist_by_order)
+    if archived_ids:
+        load_children(db, ArchivedOrderItem, OrderItemResponse, archived_ids, items_by_order)
+        load_children(db, ArchivedOrderStatusHistory, OrderStatusHistoryResponse, archived_ids, hist_by_order)
+    
+    result = []
+    for order in orders:
+        r = OrderResponse.from_orm(order)
+        r.archived = isinstance(order, ArchivedOrder)
+        r.items = items_by_order[order.id]
+        r.history = hist_by_order[order.id]
+        result.append(r)
+    return result
+
+def load_order_response(db: Session, order: Order) -> OrderResponse:
+    return load_order_responses(db, [order])[0]
+
+def cursor_signature(payload: str) -> str:
+    digest = hmac.new(ORDER_CURSOR_SECRET.encode(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:16]).decode().rstrip("=")
+
+def lock_order(db: Session, order_id: int) -> Optional[Order]:
+    """
+    Đọc đơn và giữ khóa dòng tới khi commit (hai thao tác đổi trạng thái cùng đơn chạy nối tiếp).
+    SQL Server: hint UPDLOCK, ROWLOCK (dialect mssql không render FOR UPDATE);
+    DB khác: SELECT ... FOR UPDATE.
+    """
+    return (
+        db.query(Order)
+        .filter(Order.id == order_id)
+        .with_hint(Order, "WITH (UPDLOCK, ROWLOCK)", "mssql")
+        .with_for_update()
+        .first()
+    )
+
+def encode_cursor(order: Order) -> str:
+    """Cursor opaque cho trang tiếp theo: vị trí (created_at, id) của order cuối trang, có ký HMAC"""
+    raw = json.dumps([order.created_at.isoformat(), order.id])
+    payload = base64.urlsafe_b64encode(raw.encode()).decode()
+    return f"{payload}.{cursor_signature(payload)}"
+
+def decode_cursor(cursor: str):
+    try:
+        payload, signature = cursor.split(".")
+        if not hmac.compare_digest(signature, cursor_signature(payload)):
+            raise ValueError("bad signature")
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(payload.encode()))
+        return datetime.fromisoformat(created_at), int(order_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# ==========================================
+# OUTBOX
+# ==========================================
+def record_event(db: Session, event_type: str, order: Order, **extra):
+    """Thêm event vào outbox; commit cùng với thay đổi của order"""
+    payload = {
+        "order_id": order.id,
+        "status": OrderStatus(order.status).value,
+        "user_id": order.user_id,
+        "restaurant_id": order.restaurant_id,
+        "drone_id": order.drone_id,
+        # Thông tin giao hàng cho consumer (vd dispatch drone khi đơn ready)
+        "total_weight": order.total_weight,
+        "restaurant_lat": order.restaurant_lat,
+        "restaurant_lng": order.restaurant_lng,
+        "delivery_lat": order.delivery_lat,
+        "delivery_lng": order.delivery_lng,
+        "occurred_at": datetime.utcnow().isoformat(),
+        **extra,
+    }
+    db.add(OutboxEvent(
+        event_id=str(uuid.uuid4()),
+        event_type=event_type,
+        order_id=order.id,
+        payload=json.dumps(payload, default=str),
+    ))
+
+_stream_client: Optional[redis.Redis] = None
+_outbox_wakeup = asyncio.Event()
+_outbox_task: Optional[asyncio.Task] = None
+
+def notify_outbox():
+    """Gọi sau commit để relay publish ngay, không chờ tới lần poll sau"""
+    _outbox_wakeup.set()
+
+def publish_outbox_batch() -> int:
+    """
+    Publish một batch event chưa gửi lên Redis Stream rồi đánh dấu published_at.
+    At-least-once: nếu lỗi sau XADD mà chưa commit, batch được gửi lại lần sau
+    (consumer bỏ qua trùng bằng event_id). Row được claim bằng khóa dòng giữ tới commit,
+    replica khác bỏ qua row đang bị khóa (SQL Server: UPDLOCK + READPAST; DB khác:
+    FOR UPDATE SKIP LOCKED) nên nhiều replica không gửi cùng một batch.
+    """
+    global _stream_client
+    if _stream_client is None:
+        _stream_client = redis.from_url(REDIS_URL)
+    
+    db = SessionLocal()
+    try:
+        batch = (
+            db.query(OutboxEvent)
+            .filter(OutboxEvent.published_at.is_(None))
+            .order_by(OutboxEvent.id)
+            .limit(OUTBOX_BATCH_SIZE)
+            .with_hint(OutboxEvent, "WITH (UPDLOCK, READPAST, ROWLOCK)", "mssql")
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        if not batch:
+            db.rollback()
+            return 0
+        
+        pipe = _stream_client.pipeline(transaction=False)
+        for event in batch:
+            pipe.xadd(
+                events.ORDER_EVENTS_STREAM,
+                events.event_fields(event.event_id, event.event_type, event.order_id, json.loads(event.payload)),
+                maxlen=ORDER_EVENTS_MAXLEN,
+                approximate=True,
+            )
+        pipe.execute()
+        
+        published_at = datetime.utcnow()
+        for event in batch:
+            event.published_at = published_at
+        db.commit()
+        return len(batch)
+    finally:
+        db.close()
+
+def purge_published_events() -> int:
+    db = SessionLocal()
+    try:
+        cutoff = datetime.utcnow() - timedelta(hours=OUTBOX_RETENTION_HOURS)
+        deleted = (
+            db.query(OutboxEvent)
+            .filter(OutboxEvent.published_at.isnot(None), OutboxEvent.published_at < cutoff)
+            .delete(synchronize_session=False)
+        )
+        db.commit()
+        return deleted
+    finally:
+        db.close()
+
+async def run_outbox_relay():
+    last_purge = 0.0
+    loop = asyncio.get_running_loop()
+    while True:
+        published = 0
+        try:
+            published = await asyncio.to_thread(publish_outbox_batch)
+            if loop.time() - last_purge > 600:
+                await asyncio.to_thread(purge_published_events)
+                last_purge = loop.time()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Outbox relay error: {e}")
+        
+        # Batch đầy -> còn event, gửi tiếp ngay
+        if published < OUTBOX_BATCH_SIZE:
+            try:
+                await asyncio.wait_for(_outbox_wakeup.wait(), OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            _outbox_wakeup.clear()
+
+# ==========================================
+# ARCHIVAL
+# ==========================================
+ARCHIVE_STATUSES = (OrderStatus.DELIVERED, OrderStatus.CANCELLED, OrderStatus.REJECTED)
+
+orders_archived = metrics.counter(
+    "orders_archived_rows_total", "Rows moved to the archive tables", ("table",))
+
+last_archive_report: Optional[dict] = None
+
+def copy_rows(db: Session, source, target, condition, **extra) -> int:
+    """INSERT INTO target SELECT ... FROM source WHERE condition (cùng tên cột, thêm cột hằng trong extra)"""
+    columns = [column.name for column in source.__table__.columns]
+    query = select(
+        *[source.__table__.c[name] for name in columns],
+        *[literal(value, type_=target.__table__.c[name].type).label(name) for name, value in extra.items()],
+    ).where(condition)
+    result = db.execute(insert(target).from_select(columns + list(extra), query))
+    return result.rowcount
+
+def archive_batch(cutoff: datetime) -> Dict[str, int]:
+    """
+    Chuyển tối đa ARCHIVE_BATCH_SIZE đơn đã kết thúc trước cutoff (cùng items + history)
+    sang bảng archive, trong một transaction. Đơn được khóa tới commit và instance khác
+    bỏ qua đơn đang bị khóa (SQL Server: UPDLOCK + READPAST; DB khác: FOR UPDATE SKIP LOCKED),
+    nên hai archiver chạy song song (vd chạy tay trong lúc loop đang chạy) không lấy trùng đơn.
+    """
+    db = SessionLocal()
+    try:
+        order_ids = [
+            order_id for (order_id,) in
+            db.query(Order.id)
+            .filter(Order.status.in_(ARCHIVE_STATUSES), Order.updated_at < cutoff)
+            .order_by(Order.id)
+            .limit(ARCHIVE_BATCH_SIZE)
+            .with_hint(Order, "WITH (UPDLOCK, READPAST, ROWLOCK)", "mssql")
+            .with_for_update(skip_locked=True)
+            .all()
+        ]
+        if not order_ids:
+            return {"orders": 0, "items": 0, "history": 0}
+        
+        moved = {
+            "orders": copy_rows(db, Order, ArchivedOrder, Order.id.in_(order_ids), archived_at=datetime.utcnow()),
+            "items": copy_rows(db, OrderItem, ArchivedOrderItem, OrderItem.order_id.in_(order_ids)),
+            "history": copy_rows(db, OrderStatusHistory, ArchivedOrderStatusHistory, OrderStatusHistory.order_id.in_(order_ids)),
+        }
+        db.execute(delete(OrderStatusHistory).where(OrderStatusHistory.order_id.in_(order_ids)))
+        db.execute(delete(OrderItem).where(OrderItem.order_id.in_(order_ids)))
+        db.execute(delete(Order).where(Order.id.in_(order_ids)))
+        db.commit()
+        return moved
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def archive_orders(older_than_days: int = ARCHIVE_AFTER_DAYS) -> dict:
+    """Archive theo batch tới khi hết đơn đủ điều kiện; trả report (số dòng, thời gian)"""
+    global last_archive_report
+    started_at = datetime.utcnow()
+    started = time.perf_counter()
+    cutoff = started_at - timedelta(days=older_than_days)
+    report = {"orders": 0, "items": 0, "history": 0, "batches": 0}
+    
+    while True:
+        moved = archive_batch(cutoff)
+        if not moved["orders"]:
+            break
+        report["batches"] += 1
+        for table, count in moved.items():
+            report[table] += count
+            orders_archived.inc(table, amount=count)
+        if moved["orders"] < ARCHIVE_BATCH_SIZE:
+            break
+        time.sleep(ARCHIVE_BATCH_PAUSE)
+    
+    report.update(
+        cutoff=cutoff.isoformat(),
+        started_at=started_at.isoformat(),
+        seconds=round(time.perf_counter() - started, 3),
+    )
+    last_archive_report = report
+    if report["orders"]:
+        print(f"🗄️ Archived {report['orders']} orders ({report['items']} items, "
+              f"{report['history']} history) in {report['seconds']}s")
+    return report
+
+_archive_task: Optional[asyncio.Task] = None
+
+async def run_archive_loop():
+    while True:
+        try:
+            await asyncio.to_thread(archive_orders)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Archive job error: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+# ==========================================
+# LIVE EVENTS (SSE)
+# ==========================================
+STREAM_ID_PATTERN = re.compile(r"^\d+-\d+$")
+
+def stream_id_key(entry_id: str):
+    ms, seq = entry_id.split("-")
+    return int(ms), int(seq)
+
+class Subscription:
+    """Một client SSE: queue các event khớp filter"""
+    
+    def __init__(self, matches: Callable[[dict], bool]):
+        self.matches = matches
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.overflowed = False
+    
+    def offer(self, entry_id: str, event: dict):
+        if self.overflowed or not self.matches(event):
+            return
+        try:
+            self.queue.put_nowait((entry_id, event))
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+class OrderEventBroadcaster:
+    """
+    Mỗi process một reader XREAD trên ORDER_EVENTS_STREAM (outbox relay publish vào),
+    fan-out cho các subscriber SSE trong process. Replica nào cũng thấy mọi event;
+    stream entry ID dùng làm SSE id nên client resume được bằng Last-Event-ID.
+    """
+    
+    def __init__(self):
+        self.subscribers = set()
+        self._task: Optional[asyncio.Task] = None
+    
+    def subscribe(self, matches: Callable[[dict], bool]) -> Subscription:
+        subscription = Subscription(matches)
+        self.subscribers.add(subscription)
+        return subscription
+    
+    def unsubscribe(self, subscription: Subscription):
+        self.subscribers.discard(subscription)
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run(self):
+        last_id = None
+        while True:
+            try:
+                redis = get_redis()
+                if last_id is None:
+                    # Bắt đầu từ entry mới nhất hiện có ("$" mỗi lần XREAD có thể lỡ event)
+                    latest = await redis.xrevrange(events.ORDER_EVENTS_STREAM, count=1)
+                    last_id = latest[0][0] if latest else "0-0"
+                response = await redis.xread(
+                    {events.ORDER_EVENTS_STREAM: last_id},
+                    count=500,
+                    block=int(SSE_HEARTBEAT_SECONDS * 1000),
+                )
+                for _, entries in response or []:
+                    for entry_id, fields in entries:
+                        last_id = entry_id
+                        event = events.parse_event(fields)
+                        for subscription in list(self.subscribers):
+                            subscription.offer(entry_id, event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Order event broadcaster error: {e}")
+                await asyncio.sleep(2)
+
+broadcaster = OrderEventBroadcaster()
+
+def format_sse(event_type: str, data: dict, entry_id: Optional[str] = None) -> str:
+    lines = []
+    if entry_id:
+        lines.append(f"id: {entry_id}")
+    lines.append(f"event: {event_type}")
+    lines.append(f"data: {json.dumps(data, default=str)}")
+    return "\n".join(lines) + "\n\n"
+
+async def replay_events(after_id: str, matches: Callable[[dict], bool]):
+    """Event trong stream sau after_id (resume bằng Last-Event-ID)"""
+    redis = get_redis()
+    start = f"({after_id}"
+    while True:
+        entries = await redis.xrange(events.ORDER_EVENTS_STREAM, min=start, max="+", count=500)
+        for entry_id, fields in entries:
+            event = events.parse_event(fields)
+            if matches(event):
+                yield entry_id, event
+        if len(entries) < 500:
+            return
+        start = f"({entries[-1][0]}"
+
+async def sse_stream(matches: Callable[[dict], bool], last_event_id: Optional[str], snapshot: Optional[dict] = None):
+    # Đăng ký trước khi replay để không lỡ event commit trong lúc replay
+    subscription = broadcaster.subscribe(matches)
+    try:
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        if snapshot is not None:
+            yield format_sse("snapshot", snapshot)
+        
+        last_sent = None
+        if last_event_id:
+            try:
+                async for entry_id, event in replay_events(last_event_id, matches):
+                    yield format_sse(event["type"], event, entry_id)
+                    last_sent = entry_id
+            except Exception as e:
+                print(f"⚠️ Failed to replay order events after {last_event_id}: {e}")
+            last_sent = last_sent or last_event_id
+        
+        while not subscription.overflowed:
+            try:
+                entry_id, event = await asyncio.wait_for(subscription.queue.get(), SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            # Đã gửi trong phần replay
+            if last_sent and stream_id_key(entry_id) <= stream_id_key(last_sent):
+                continue
+            yield format_sse(event["type"], event, entry_id)
+            last_sent = entry_id
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+def sse_response(matches: Callable[[dict], bool], last_event_id: Optional[str], snapshot: Optional[dict] = None):
+    if last_event_id and not STREAM_ID_PATTERN.match(last_event_id):
+        last_event_id = None
+    return StreamingResponse(
+        sse_stream(matches, last_event_id, snapshot),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def bearer(authorization: Optional[str], access_token: Optional[str]) -> Optional[str]:
+    """EventSource không gửi được header -> cho phép token qua query ?access_token="""
+    if authorization:
+        return authorization
+    return f"Bearer {access_token}" if access_token else None
+
 @app.on_event("startup")
 async def startup():
+    global _outbox_task, _archive_task
     Base.metadata.create_all(bind=engine)
+    # create_all không thêm index vào bảng đã có sẵn (vd tạo từ init-db.sql)
+    for index in Order.__table__.indexes | OrderDailyStats.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+    _outbox_task = asyncio.create_task(run_outbox_relay())
+    if ARCHIVE_ENABLED:
+        _archive_task = asyncio.create_task(run_archive_loop())
+    broadcaster.start()
     print("✅ Order Service Started")
 
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await broadcaster.stop()
+    for task in (_outbox_task, _archive_task):
+        if task is None:
+            continue
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
 # ==========================================
 # ROUTES
 # ==========================================
@@ -209,45 +984,69 @@ async def root():
 @app.post("/orders/checkout", response_model=OrderResponse, status_code=201)
 async def checkout(
     request: CheckoutRequest,
+    background_tasks: BackgroundTasks,
     authorization: str = Header(None),
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
     """
-    Tạo đơn từ giỏ hàng:
-    1. Gọi CART SERVICE lấy items
-    2. Gọi PRODUCT SERVICE trừ tồn kho
-    3. Gọi PAYMENT SERVICE tạo payment
-    4. Tạo ORDER
-    5. Gọi DELIVERY SERVICE gán drone (nếu ready)
+    Tạo đơn từ giỏ hàng.
+    Header Idempotency-Key: client retry cùng key nhận lại đơn đã tạo, không tạo đơn mới.
     """
     user = await verify_token(authorization)
+    return await idempotency.run(
+        idempotency_key,
+        scope=f"checkout:{user['user_id']}",
+        payload=request,
+        call=lambda: place_order(request, user, authorization, background_tasks, db),
+        status_code=201,
+    )
+
+async def place_order(
+    request: CheckoutRequest,
+    user: dict,
+    authorization: str,
+    background_tasks: BackgroundTasks,
+    db: Session
+) -> OrderResponse:
+    """
+    1. Gọi CART SERVICE lấy items
+    2. Gọi PRODUCT SERVICE reserve tồn kho (một call, all-or-nothing)
+    3. Tạo ORDER (lỗi -> release tồn kho đã reserve)
+    4. Sau khi trả response: tạo payment + xóa giỏ hàng (background)
+    """
     user_id = user["user_id"]
     
     # 1. Lấy giỏ hàng
-    async with httpx.AsyncClient() as client:
-        cart_res = await client.get(
-            f"{CART_SERVICE_URL}/cart",
-            headers={"Authorization": authorization},
-            timeout=10.0
-        )
-        if cart_res.status_code != 200:
-            raise HTTPException(status_code=400, detail="Cart is empty")
-        
-        cart_items = cart_res.json()
-        if not cart_items:
-            raise HTTPException(status_code=400, detail="Cart is empty")
+    cart_res = await get_client("cart").get(
+        "/cart",
+        headers={"Authorization": authorization}
+    )
+    if cart_res.status_code != 200:
+        raise HTTPException(status_code=400, detail="Cart is empty")
     
-    # 2. Trừ tồn kho (PRODUCT SERVICE)
-    async with httpx.AsyncClient() as client:
-        for item in cart_items:
-            res = await client.post(
-                f"{PRODUCT_SERVICE_URL}/products/{item['product_id']}/decrease-stock",
-                params={"quantity": item['quantity']},
-                headers={"Authorization": authorization},
-                timeout=10.0
-            )
-            if res.status_code != 200:
-                raise HTTPException(status_code=400, detail=f"Product {item['product_id']} out of stock")
+    cart_items = cart_res.json()
+    if not cart_items:
+        raise HTTPException(status_code=400, detail="Cart is empty")
+    
+    # 2. Reserve tồn kho (PRODUCT SERVICE) - cả giỏ trong một transaction
+    stock_lines = [
+        {"product_id": item['product_id'], "quantity": item['quantity']}
+        for item in cart_items
+    ]
+    try:
+        res = await get_client("product").post(
+            "/products/stock/reserve",
+            json={"items": stock_lines},
+            headers={"Authorization": auth.service_authorization("order_service")}
+        )
+    except httpx.RequestError:
+        raise HTTPException(status_code=503, detail="Product service unavailable")
+    if res.status_code == 409:
+        failed = [line["product_id"] for line in res.json()["items"] if line["error"]]
+        raise HTTPException(status_code=400, detail=f"Product {', '.join(map(str, failed))} out of stock")
+    if res.status_code != 200:
+        raise HTTPException(status_code=502, detail="Failed to reserve stock")
     
     # 3. Tính tổng & weight
     total = sum(item['quantity'] * item['price'] for item in cart_items)
@@ -264,7 +1063,7 @@ async def checkout(
         request.delivery_lng or 106.660172
     )
     
-    # 5. Tạo order
+    # 5. Tạo order + items + history trong một transaction
     db_order = Order(
         user_id=user_id,
         restaurant_id=request.restaurant_id,
@@ -280,109 +1079,306 @@ async def checkout(
         notes=request.notes,
         status=OrderStatus.WAITING_CONFIRMATION
     )
-    db.add(db_order)
-    db.commit()
-    db.refresh(db_order)
-    
-    # Thêm items
-    for item in cart_items:
-        db_item = OrderItem(
+    try:
+        db.add(db_order)
+        db.flush()
+        
+        # Thêm items
+        for item in cart_items:
+            db_item = OrderItem(
+                order_id=db_order.id,
+                product_id=item['product_id'],
+                product_name=item.get('product_name', 'Unknown'),
+                quantity=item['quantity'],
+                price=item['price'],
+                weight=item.get('weight', 0.5)
+            )
+            db.add(db_item)
+        
+        # Thêm history
+        history = OrderStatusHistory(
             order_id=db_order.id,
-            product_id=item['product_id'],
-            product_name=item.get('product_name', 'Unknown'),
-            quantity=item['quantity'],
-            price=item['price'],
-            weight=item.get('weight', 0.5)
+            status=OrderStatus.WAITING_CONFIRMATION.value,
+            changed_by=user_id,
+            role=user.get('role'),
+            note='Order created'
         )
-        db.add(db_item)
+        db.add(history)
+        update_rollup(db, None, db_order)
+        record_event(db, "order.created", db_order, total_amount=total)
+        db.commit()
+    except Exception:
+        db.rollback()
+        await release_stock(stock_lines)
+        raise
+    notify_outbox()
+    db.refresh(db_order)
     
-    # Thêm history
-    history = OrderStatusHistory(
-        order_id=db_order.id,
-        status=OrderStatus.WAITING_CONFIRMATION.value,
-        changed_by=user_id,
-        role=user.get('role'),
-        note='Order created'
-    )
-    db.add(history)
-    db.commit()
+    # 6. Payment + xóa giỏ hàng chạy sau khi response đã gửi
+    background_tasks.add_task(finish_checkout, db_order.id, user_id, total, authorization)
     
-    # 6. Tạo payment (PAYMENT SERVICE)
-    async with httpx.AsyncClient() as client:
-        await client.post(
-            f"{PAYMENT_SERVICE_URL}/payments",
+    # Lấy items + history
+    return load_order_response(db, db_order)
+
+async def release_stock(stock_lines: List[dict]):
+    """Bù trừ cho reserve khi không tạo được order"""
+    try:
+        res = await get_client("product").post(
+            "/products/stock/release",
+            json={"items": stock_lines},
+            headers={"Authorization": auth.service_authorization("order_service")}
+        )
+        if res.status_code != 200:
+            print(f"⚠️ Failed to release stock {stock_lines}: HTTP {res.status_code}")
+    except httpx.RequestError as e:
+        print(f"⚠️ Failed to release stock {stock_lines}: {e}")
+
+async def finish_checkout(order_id: int, user_id: int, total: float, authorization: str):
+    """Background stage của checkout: tạo payment (PAYMENT SERVICE) và xóa giỏ hàng (CART SERVICE)"""
+    results = await gather_bounded([
+        get_client("payment").post(
+            "/payments",
             json={
-                "order_id": db_order.id,
+                "order_id": order_id,
                 "user_id": user_id,
                 "amount": total,
                 "payment_method": "cod"  # Default: cash on delivery
             },
-            headers={"Authorization": authorization},
-            timeout=10.0
-        )
-    
-    # Lấy items + history
-    items = db.query(OrderItem).filter(OrderItem.order_id == db_order.id).all()
-    hist = db.query(OrderStatusHistory).filter(OrderStatusHistory.order_id == db_order.id).all()
-    
-    result = OrderResponse.from_orm(db_order)
-    result.items = [OrderItemResponse.from_orm(i) for i in items]
-    result.history = [OrderStatusHistoryResponse.from_orm(h) for h in hist]
-    
-    # 7. Xóa giỏ hàng
-    async with httpx.AsyncClient() as client:
-        await client.delete(
-            f"{CART_SERVICE_URL}/cart",
-            headers={"Authorization": authorization},
-            timeout=10.0
-        )
-    
-    return result
+            # Retry cho cùng đơn không tạo payment lần hai
+            headers={"Authorization": authorization, "Idempotency-Key": f"order-{order_id}"}
+        ),
+        get_client("cart").delete(
+            "/cart",
+            headers={"Authorization": authorization}
+        ),
+    ])
+    for step, res in zip(("create payment", "clear cart"), results):
+        if isinstance(res, BaseException):
+            print(f"⚠️ Checkout {order_id}: failed to {step}: {res}")
+        elif res.status_code >= 400:
+            print(f"⚠️ Checkout {order_id}: failed to {step}: HTTP {res.status_code}")
 
 # List orders
 @app.get("/orders", response_model=List[OrderResponse])
 async def list_orders(
+    response: Response,
     status: Optional[OrderStatus] = None,
+    limit: int = Query(ORDER_PAGE_DEFAULT_LIMIT, ge=1, le=ORDER_PAGE_MAX_LIMIT),
+    cursor: Optional[str] = None,
+    fields: str = Query("full", pattern="^(full|summary)$"),
+    include_archived: bool = False,
     authorization: str = Header(None),
     db: Session = Depends(get_db)
 ):
-    """Danh sách đơn của user"""
+    """
+    Danh sách đơn của user, mới nhất trước.
+    Trả tối đa `limit` đơn; nếu còn, header X-Next-Cursor chứa cursor cho trang sau.
+    fields=summary: không kèm items / history.
+    include_archived=true: gồm cả đơn đã archive (đọc thêm bảng orders_archive).
+    """
     user = await verify_token(authorization)
+    position = decode_cursor(cursor) if cursor else None
     
-    query = db.query(Order)
+    def page(model) -> list:
+        query = db.query(model)
+        if user['role'] == 'customer':
+            query = query.filter(model.user_id == user['user_id'])
+        elif user['role'] == 'restaurant':
+            query = query.filter(model.restaurant_id == user['user_id'])
+        
+        if status:
+            query = query.filter(model.status == status)
+        
+        if position:
+            cursor_created_at, cursor_id = position
+            query = query.filter(or_(
+                model.created_at < cursor_created_at,
+                and_(model.created_at == cursor_created_at, model.id < cursor_id),
+            ))
+        
+        # Lấy dư 1 dòng để biết còn trang sau hay không
+        return query.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1).all()
     
-    if user['role'] == 'customer':
-        query = query.filter(Order.user_id == user['user_id'])
-    elif user['role'] == 'restaurant':
-        query = query.filter(Order.restaurant_id == user['user_id'])
+    orders = page(Order)
+    if include_archived:
+        # Hai bảng cùng thứ tự (created_at, id) -> gộp rồi cắt lại
+        orders = sorted(orders + page(ArchivedOrder), key=lambda o: (o.created_at, o.id), reverse=True)[:limit + 1]
+    if len(orders) > limit:
+        orders = orders[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(orders[-1])
     
+    if fields == "summary":
+        return [
+            OrderResponse.from_orm(order).model_copy(update={"archived": isinstance(order, ArchivedOrder)})
+            for order in orders
+        ]
+    return load_order_responses(db, orders)
+
+# Analytics (Admin / Restaurant) - khai báo trước /orders/{order_id}
+@app.get("/orders/analytics", response_model=OrderAnalyticsResponse)
+async def order_analytics(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    restaurant_id: Optional[int] = None,
+    status: Optional[OrderStatus] = None,
+    authorization: str = Header(None),
+    db: Session = Depends(get_db)
+):
+    """
+    Số đơn, doanh thu, khối lượng, thời gian giao trung bình theo nhà hàng × ngày × trạng thái.
+    Đọc từ bảng rollup (một dòng mỗi nhà hàng/ngày/trạng thái), không quét bảng orders.
+    Mặc định ANALYTICS_DEFAULT_DAYS ngày gần nhất; tối đa ANALYTICS_MAX_DAYS ngày.
+    """
+    user = await verify_token(authorization)
+    if user['role'] == 'restaurant':
+        if restaurant_id is not None and restaurant_id != user['user_id']:
+            raise HTTPException(status_code=403, detail="Permission denied")
+        restaurant_id = user['user_id']
+    elif user['role'] != 'admin':
+        raise HTTPException(status_code=403, detail="Permission denied")
+    
+    date_to = date_to or datetime.utcnow().date()
+    date_from = date_from or date_to - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    if date_from > date_to:
+        raise HTTPException(status_code=400, detail="date_from must not be after date_to")
+    if (date_to - date_from).days >= ANALYTICS_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Date range is limited to {ANALYTICS_MAX_DAYS} days")
+    
+    query = db.query(OrderDailyStats).filter(
+        OrderDailyStats.day >= date_from,
+        OrderDailyStats.day <= date_to,
+        OrderDailyStats.order_count > 0,
+    )
+    if restaurant_id is not None:
+        query = query.filter(OrderDailyStats.restaurant_id == restaurant_id)
     if status:
-        query = query.filter(Order.status == status)
+        query = query.filter(OrderDailyStats.status == status.value)
     
-    orders = query.order_by(Order.id.desc()).all()
+    rows = []
+    totals = OrderAnalyticsTotals()
+    delivery_seconds = 0.0
+    for stat in query.order_by(OrderDailyStats.day, OrderDailyStats.restaurant_id, OrderDailyStats.status):
+        delivered = stat.status == OrderStatus.DELIVERED.value
+        rows.append(OrderAnalyticsRow(
+            restaurant_id=stat.restaurant_id,
+            day=stat.day,
+            status=stat.status,
+            order_count=stat.order_count,
+            total_amount=round(stat.total_amount, 2),
+            total_weight=round(stat.total_weight, 3),
+            avg_delivery_minutes=round(stat.delivery_seconds / stat.order_count / 60, 1) if delivered else None,
+        ))
+        totals.order_count += stat.order_count
+        totals.total_amount += stat.total_amount
+        totals.total_weight += stat.total_weight
+        if delivered:
+            totals.delivered_count += stat.order_count
+            delivery_seconds += stat.delivery_seconds
     
-    result = []
-    for order in orders:
-        items = db.query(OrderItem).filter(OrderItem.order_id == order.id).all()
-        hist = db.query(OrderStatusHistory).filter(OrderStatusHistory.order_id == order.id).all()
-        
-        r = OrderResponse.from_orm(order)
-        r.items = [OrderItemResponse.from_orm(i) for i in items]
-        r.history = [OrderStatusHistoryResponse.from_orm(h) for h in hist]
-        result.append(r)
+    totals.total_amount = round(totals.total_amount, 2)
+    totals.total_weight = round(totals.total_weight, 3)
+    if totals.delivered_count:
+        totals.avg_delivery_minutes = round(delivery_seconds / totals.delivered_count / 60, 1)
+    return OrderAnalyticsResponse(date_from=date_from, date_to=date_to, rows=rows, totals=totals)
+
+# Archive (Admin)
+@app.get("/orders/archive/report")
+async def archive_report(authorization: str = Header(None)):
+    """Kết quả lần archive gần nhất: số đơn / items / history đã chuyển, thời gian chạy"""
+    user = await verify_token(authorization)
+    if user['role'] != 'admin':
+        raise HTTPException(status_code=403, detail="Admin only")
+    return {
+        "enabled": ARCHIVE_ENABLED,
+        "after_days": ARCHIVE_AFTER_DAYS,
+        "interval_seconds": ARCHIVE_INTERVAL_SECONDS,
+        "last_run": last_archive_report,
+    }
+
+@app.post("/orders/archive/run")
+async def run_archive(
+    older_than_days: int = Query(ARCHIVE_AFTER_DAYS, ge=0),
+    authorization: str = Header(None)
+):
+    """Chạy archive ngay (không chờ lịch), trả report"""
+    user = await verify_token(authorization)
+    if user['role'] != 'admin':
+        raise HTTPException(status_code=403, detail="Admin only")
+    return await asyncio.to_thread(archive_orders, older_than_days)
+
+# Live order events (SSE) - khai báo trước /orders/{order_id}
+@app.get("/orders/stream")
+async def stream_orders(
+    restaurant_id: Optional[int] = None,
+    authorization: str = Header(None),
+    access_token: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    SSE: event của mọi đơn user được xem.
+    Restaurant: đơn của nhà hàng mình; customer: đơn của mình; admin: tất cả hoặc theo restaurant_id.
+    Role khác (kể cả service): 403.
+    """
+    user = await verify_token(bearer(authorization, access_token))
     
-    return result
+    if user['role'] == 'restaurant':
+        if restaurant_id is not None and restaurant_id != user['user_id']:
+            raise HTTPException(status_code=403, detail="Permission denied")
+        restaurant_id = user['user_id']
+    elif user['role'] == 'customer':
+        user_id = user['user_id']
+        return sse_response(lambda event: event["payload"]["user_id"] == user_id, last_event_id)
+    elif user['role'] != 'admin':
+        raise HTTPException(status_code=403, detail="Permission denied")
+    
+    if restaurant_id is None:
+        return sse_response(lambda event: True, last_event_id)
+    return sse_response(lambda event: event["payload"]["restaurant_id"] == restaurant_id, last_event_id)
+
+@app.get("/orders/{order_id}/events")
+async def stream_order_events(
+    order_id: int,
+    authorization: str = Header(None),
+    access_token: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None),
+):
+    """SSE: trạng thái hiện tại (snapshot) rồi các lần đổi trạng thái của một đơn"""
+    user = await verify_token(bearer(authorization, access_token))
+    
+    # Không dùng Depends(get_db): connection DB không bị giữ suốt thời gian stream
+    db = SessionLocal()
+    try:
+        order = db.query(Order).filter(Order.id == order_id).first()
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        if user['role'] == 'customer' and order.user_id != user['user_id']:
+            raise HTTPException(status_code=403, detail="Permission denied")
+        if user['role'] == 'restaurant' and order.restaurant_id != user['user_id']:
+            raise HTTPException(status_code=403, detail="Permission denied")
+        snapshot = {
+            "order_id": order.id,
+            "status": OrderStatus(order.status).value,
+            "drone_id": order.drone_id,
+            "updated_at": order.updated_at,
+        }
+    finally:
+        db.close()
+    
+    return sse_response(lambda event: event["order_id"] == order_id, last_event_id, snapshot)
 
 # Get order detail
 @app.get("/orders/{order_id}", response_model=OrderResponse)
 async def get_order(
     order_id: int,
+    include_archived: bool = False,
     authorization: str = Header(None),
     db: Session = Depends(get_db)
 ):
-    """Chi tiết đơn"""
+    """Chi tiết đơn (include_archived=true: tìm cả trong bảng archive)"""
     user = await verify_token(authorization)
     order = db.query(Order).filter(Order.id == order_id).first()
+    if not order and include_archived:
+        order = db.query(ArchivedOrder).filter(ArchivedOrder.id == order_id).first()
     
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
@@ -393,13 +1389,7 @@ async def get_order(
     if user['role'] == 'restaurant' and order.restaurant_id != user['user_id']:
         raise HTTPException(status_code=403, detail="Permission denied")
     
-    items = db.query(OrderItem).filter(OrderItem.order_id == order.id).all()
-    hist = db.query(OrderStatusHistory).filter(OrderStatusHistory.order_id == order.id).all()
-    
-    result = OrderResponse.from_orm(order)
-    result.items = [OrderItemResponse.from_orm(i) for i in items]
-    result.history = [OrderStatusHistoryResponse.from_orm(h) for h in hist]
-    return result
+    return load_order_response(db, order)
 
 # Accept order (Restaurant)
 @app.post("/orders/{order_id}/accept", response_model=OrderResponse)
@@ -413,15 +1403,18 @@ async def accept_order(
     if user['role'] != 'restaurant':
         raise HTTPException(status_code=403, detail="Only restaurant can accept")
     
-    order = db.query(Order).filter(Order.id == order_id).first()
+    # Khóa dòng đơn tới khi commit: rollup cần trạng thái trước đó chính xác
+    order = lock_order(db, order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
     if order.restaurant_id != user['user_id']:
         raise HTTPException(status_code=403, detail="Not your order")
     
+    before = rollup_entry(order)
     order.status = OrderStatus.CONFIRMED
     order.updated_at = datetime.utcnow()
+    update_rollup(db, before, order)
     
     # Thêm history
     hist = OrderStatusHistory(
@@ -432,17 +1425,13 @@ async def accept_order(
         note='Restaurant accepted order'
     )
     db.add(hist)
+    record_event(db, "order.status_changed", order, changed_by=user['user_id'])
     db.commit()
+    notify_outbox()
     db.refresh(order)
     
     # Response
-    items = db.query(OrderItem).filter(OrderItem.order_id == order.id).all()
-    hist_list = db.query(OrderStatusHistory).filter(OrderStatusHistory.order_id == order.id).all()
-    
-    result = OrderResponse.from_orm(order)
-    result.items = [OrderItemResponse.from_orm(i) for i in items]
-    result.history = [OrderStatusHistoryResponse.from_orm(h) for h in hist_list]
-    return result
+    return load_order_response(db, order)
 
 # Reject order
 @app.post("/orders/{order_id}/reject", response_model=OrderResponse)
@@ -457,16 +1446,19 @@ async def reject_order(
     if user['role'] != 'restaurant':
         raise HTTPException(status_code=403, detail="Only restaurant can reject")
     
-    order = db.query(Order).filter(Order.id == order_id).first()
+    # Khóa dòng đơn tới khi commit: rollup cần trạng thái trước đó chính xác
+    order = lock_order(db, order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
     if order.restaurant_id != user['user_id']:
         raise HTTPException(status_code=403, detail="Not your order")
     
+    before = rollup_entry(order)
     order.status = OrderStatus.REJECTED
     order.rejection_reason = reject_data.reason
     order.updated_at = datetime.utcnow()
+    update_rollup(db, before, order)
     
     hist = OrderStatusHistory(
         order_id=order.id,
@@ -476,16 +1468,12 @@ async def reject_order(
         note=f"Rejected: {reject_data.reason}"
     )
     db.add(hist)
+    record_event(db, "order.status_changed", order, changed_by=user['user_id'], reason=reject_data.reason)
     db.commit()
+    notify_outbox()
     db.refresh(order)
     
-    items = db.query(OrderItem).filter(OrderItem.order_id == order.id).all()
-    hist_list = db.query(OrderStatusHistory).filter(OrderStatusHistory.order_id == order.id).all()
-    
-    result = OrderResponse.from_orm(order)
-    result.items = [OrderItemResponse.from_orm(i) for i in items]
-    result.history = [OrderStatusHistoryResponse.from_orm(h) for h in hist_list]
-    return result
+    return load_order_response(db, order)
 
 # Update status (Restaurant)
 @app.put("/orders/{order_id}/status", response_model=OrderResponse)
@@ -497,7 +1485,8 @@ async def update_order_status(
 ):
     """Cập nhật trạng thái đơn"""
     user = await verify_token(authorization)
-    order = db.query(Order).filter(Order.id == order_id).first()
+    # Khóa dòng đơn tới khi commit: rollup cần trạng thái trước đó chính xác
+    order = lock_order(db, order_id)
     
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
@@ -509,8 +1498,10 @@ async def update_order_status(
     if user['role'] == 'customer' and order.user_id != user['user_id']:
         raise HTTPException(status_code=403, detail="Permission denied")
     
+    before = rollup_entry(order)
     order.status = update.status
     order.updated_at = datetime.utcnow()
+    update_rollup(db, before, order)
     
     hist = OrderStatusHistory(
         order_id=order.id,
@@ -520,17 +1511,76 @@ async def update_order_status(
         note=f'Status updated to {update.status.value}'
     )
     db.add(hist)
+    record_event(db, "order.status_changed", order, changed_by=user['user_id'])
     db.commit()
+    notify_outbox()
     db.refresh(order)
     
-    items = db.query(OrderItem).filter(OrderItem.order_id == order.id).all()
-    hist_list = db.query(OrderStatusHistory).filter(OrderStatusHistory.order_id == order.id).all()
+    return load_order_response(db, order)
+
+# Assign drone (Drone service dispatch)
+@app.post("/orders/{order_id}/assign-drone", response_model=OrderResponse)
+async def assign_order_drone(
+    order_id: int,
+    assignment: OrderDroneAssignment,
+    authorization: str = Header(None),
+    db: Session = Depends(get_db)
+):
+    """Drone service báo đã gán drone cho đơn ready -> đơn chuyển sang in_delivery"""
+    user = await verify_token(authorization)
+    if user['role'] not in (SERVICE_ROLE, 'admin'):
+        raise HTTPException(status_code=403, detail="Only dispatch can assign drones")
     
-    result = OrderResponse.from_orm(order)
-    result.items = [OrderItemResponse.from_orm(i) for i in items]
-    result.history = [OrderStatusHistoryResponse.from_orm(h) for h in hist_list]
-    return result
+    # Khóa dòng đơn tới khi commit: rollup cần trạng thái trước đó chính xác
+    order = lock_order(db, order_id)
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    # Dispatch gửi lại (at-least-once) -> không ghi lần hai
+    if order.drone_id == assignment.drone_id:
+        return load_order_response(db, order)
+    if order.status != OrderStatus.READY:
+        raise HTTPException(status_code=409, detail=f"Order is {OrderStatus(order.status).value}")
+    
+    before = rollup_entry(order)
+    order.drone_id = assignment.drone_id
+    order.status = OrderStatus.IN_DELIVERY
+    order.updated_at = datetime.utcnow()
+    update_rollup(db, before, order)
+    
+    hist = OrderStatusHistory(
+        order_id=order.id,
+        status=OrderStatus.IN_DELIVERY.value,
+        changed_by=user.get('user_id'),
+        role=user['role'],
+        note=f'Drone #{assignment.drone_id} assigned'
+    )
+    db.add(hist)
+    record_event(db, "order.status_changed", order, changed_by=user.get('user_id'))
+    db.commit()
+    notify_outbox()
+    db.refresh(order)
+    
+    return load_order_response(db, order)
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    subcommands = parser.add_subparsers(dest="command")
+    backfill = subcommands.add_parser("backfill-analytics", help="Rebuild order analytics rollups from the orders table")
+    backfill.add_argument("--from", dest="date_from", type=date.fromisoformat)
+    backfill.add_argument("--to", dest="date_to", type=date.fromisoformat)
+    archive = subcommands.add_parser("archive-orders", help="Move finished orders to the archive tables")
+    archive.add_argument("--older-than-days", type=int, default=ARCHIVE_AFTER_DAYS)
+    args = parser.parse_args()
+    
+    if args.command == "backfill-analytics":
+        # python main.py backfill-analytics [--from YYYY-MM-DD] [--to YYYY-MM-DD]
+        Base.metadata.create_all(bind=engine)
+        count = backfill_rollups(args.date_from, args.date_to)
+        print(f"✅ Rebuilt {count} analytics rollup rows")
+    elif args.command == "archive-orders":
+        Base.metadata.create_all(bind=engine)
+        print(json.dumps(archive_orders(args.older_than_days)))
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
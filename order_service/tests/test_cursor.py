@@ -0,0 +1,41 @@
+import base64
+import json
+import os
+import tempfile
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db"))
+
+from order_service.main import Order, decode_cursor, encode_cursor
+
+
+def make_order(order_id=42, created_at=datetime(2024, 5, 1, 12, 30, 15, 123456)):
+    return Order(id=order_id, created_at=created_at)
+
+
+def test_cursor_round_trip():
+    order = make_order()
+    assert decode_cursor(encode_cursor(order)) == (order.created_at, order.id)
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor(make_order())
+    assert all(c.isalnum() or c in "-_.=" for c in cursor)
+
+
+def test_tampered_cursor_is_rejected():
+    _, signature = encode_cursor(make_order()).split(".")
+    forged = base64.urlsafe_b64encode(json.dumps(["2024-05-01T12:30:15.123456", 1]).encode()).decode()
+    with pytest.raises(HTTPException) as exc:
+        decode_cursor(f"{forged}.{signature}")
+    assert exc.value.status_code == 400
+
+
+@pytest.mark.parametrize("cursor", ["", "garbage", "a.b.c", "%%%.xyz", "bm90LWpzb24.sig"])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as exc:
+        decode_cursor(cursor)
+    assert exc.value.status_code == 400
@@ -11,10 +11,11 @@ import time
 import httpx
 import uuid
 import random
+from common import auth, idempotency, metrics
+from common.auth import verify_token
 
 # Configuration
 DATABASE_URL = os.getenv("DATABASE_URL")
-USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user_service:8000")
 ORDER_SERVICE_URL = os.getenv("ORDER_SERVICE_URL", "http://order_service:8000") # [MỚI] Thêm URL Order Service
 
 # Database setup
@@ -80,6 +81,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+auth.install(app)
+metrics.install(app, engine=engine)
 
 def get_db():
     db = SessionLocal()
@@ -105,28 +108,6 @@ async def startup_event():
 # ==========================================
 # HELPERS
 # ==========================================
-async def verify_token(authorization: str = Header(None)):
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    token = authorization.split(" ")[1]
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                f"{USER_SERVICE_URL}/verify-token",
-                headers={"Authorization": f"Bearer {token}"},
-                timeout=5.0
-            )
-            if response.status_code == 200:
-                return response.json()
-            raise HTTPException(status_code=401, detail="Invalid token")
-        except httpx.RequestError:
-            raise HTTPException(status_code=503, detail="User service unavailable")
-        except HTTPException as e:
-            raise e
-        except Exception as e:
-            raise HTTPException(status_code=401, detail="Authentication failed")
-
 def process_payment_simulation(payment_method: str, amount: float) -> dict:
     """Simulate payment processing"""
     # Trong thực tế sẽ gọi API Stripe/PayPal/Momo ở đây
@@ -157,11 +138,24 @@ async def root():
 async def create_payment(
     payment: PaymentCreate,
     authorization: str = Header(None),
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db)
 ):
-    """Create and process payment"""
+    """
+    Create and process payment.
+    Header Idempotency-Key: retry cùng key trả lại kết quả cũ, không xử lý thanh toán lần hai.
+    """
     user = await verify_token(authorization)
-    
+    return await idempotency.run(
+        idempotency_key,
+        scope=f"payment:{user['user_id']}",
+        payload=payment,
+        call=lambda: process_payment(payment, user, authorization, db),
+        status_code=status.HTTP_201_CREATED,
+    )
+
+async def process_payment(payment: PaymentCreate, user: dict, authorization: str, db: Session) -> PaymentResponse:
+    """Tạo / cập nhật payment record, xử lý thanh toán, báo Order Service"""
     # Check duplicate
     existing = db.query(Payment).filter(Payment.order_id == payment.order_id).first()
     db_payment = None
@@ -201,7 +195,7 @@ async def create_payment(
         # [QUAN TRỌNG] Gọi Order Service để cập nhật trạng thái đơn hàng
         # Forward token của user để Order Service xác thực quyền sở hữu
         try:
-            async with httpx.AsyncClient() as client:
+            async with httpx.AsyncClient(event_hooks=metrics.upstream_hooks("order")) as client:
                 await client.put(
                     f"{ORDER_SERVICE_URL}/orders/{payment.order_id}/status",
                     json={"status": "confirmed"}, # Chuyển sang CONFIRMED
@@ -218,7 +212,7 @@ async def create_payment(
     db.commit()
     db.refresh(db_payment)
     
-    return db_payment
+    return PaymentResponse.from_orm(db_payment)
 
 @app.get("/payments", response_model=List[PaymentResponse])
 async def list_payments(
@@ -1,22 +1,22 @@
 from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Form, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, JSON
+from fastapi.responses import JSONResponse
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, JSON, case, update
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, Field
+from typing import Dict, Optional, List
 from datetime import datetime
 import os
 import shutil
 import uuid
-import httpx
 import time
+from common import auth, metrics
+from common.auth import SERVICE_ROLE, verify_token
 
 # Configuration
 DATABASE_URL = os.getenv("DATABASE_URL")
-JWT_SECRET = os.getenv("JWT_SECRET")
-USER_SERVICE_URL = os.getenv("USER_SERVICE_URL")
 UPLOAD_DIR = "static/images"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
@@ -104,6 +104,25 @@ class ProductResponse(ProductBase):
     class Config:
         from_attributes = True
 
+class StockLine(BaseModel):
+    product_id: int
+    quantity: int = Field(gt=0)
+
+class StockRequest(BaseModel):
+    """Danh sách (product_id, quantity) để reserve / release"""
+    items: List[StockLine] = Field(min_length=1)
+
+class StockLineResult(BaseModel):
+    product_id: int
+    quantity: int
+    ok: bool
+    remaining: Optional[int] = None
+    error: Optional[str] = None
+
+class StockResponse(BaseModel):
+    success: bool
+    items: List[StockLineResult]
+
 class RestaurantHoursCreate(BaseModel):
     restaurant_id: int
     monday_open: Optional[str] = "08:00"
@@ -142,6 +161,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+auth.install(app)
+metrics.install(app, engine=engine)
 # Mount static files (Chỉ gọi 1 lần)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -170,28 +191,6 @@ async def startup_event():
 # ==========================================
 # HELPERS & AUTH
 # ==========================================
-async def verify_token(token: str):
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                f"{USER_SERVICE_URL}/verify-token",
-                headers={"Authorization": f"Bearer {token}"}
-            )
-            if response.status_code == 200:
-                return response.json()
-            return None
-        except:
-            return None
-
-async def get_current_user(authorization: str = None):
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    token = authorization.split(" ")[1]
-    user_data = await verify_token(token)
-    if not user_data:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    return user_data
-
 def is_restaurant_open(hours: RestaurantHours) -> tuple[bool, str]:
     if hours.is_24h: return True, "Open 24/7"
     now = datetime.now()
@@ -213,6 +212,51 @@ def is_restaurant_open(hours: RestaurantHours) -> tuple[bool, str]:
     except:
         return True, "Time format error"
 
+def merge_stock_lines(items: List[StockLine]) -> Dict[int, int]:
+    """Gộp các dòng cùng product, sắp theo product_id (thứ tự lock cố định, tránh deadlock)"""
+    merged: Dict[int, int] = {}
+    for line in items:
+        merged[line.product_id] = merged.get(line.product_id, 0) + line.quantity
+    return dict(sorted(merged.items()))
+
+def take_stock(db: Session, product_id: int, quantity: int) -> StockLineResult:
+    """
+    Trừ tồn kho bằng một câu UPDATE có điều kiện (stock_quantity >= quantity),
+    không đọc rồi ghi lại nên không oversell khi nhiều checkout chạy song song.
+    Không commit - caller quyết định commit / rollback.
+    """
+    remaining = db.execute(
+        update(Product)
+        .where(Product.id == product_id, Product.stock_quantity >= quantity)
+        .values(
+            stock_quantity=Product.stock_quantity - quantity,
+            is_available=case((Product.stock_quantity == quantity, 0), else_=Product.is_available),
+        )
+        .returning(Product.stock_quantity)
+        .execution_options(synchronize_session=False)
+    ).scalar_one_or_none()
+    
+    if remaining is not None:
+        return StockLineResult(product_id=product_id, quantity=quantity, ok=True, remaining=remaining)
+    
+    current = db.query(Product.stock_quantity).filter(Product.id == product_id).scalar()
+    error = "Product not found" if current is None else "Not enough stock"
+    return StockLineResult(product_id=product_id, quantity=quantity, ok=False, remaining=current, error=error)
+
+def return_stock(db: Session, product_id: int, quantity: int) -> StockLineResult:
+    """Cộng lại tồn kho (bù cho reserve trước đó). Không commit."""
+    remaining = db.execute(
+        update(Product)
+        .where(Product.id == product_id)
+        .values(stock_quantity=Product.stock_quantity + quantity, is_available=1)
+        .returning(Product.stock_quantity)
+        .execution_options(synchronize_session=False)
+    ).scalar_one_or_none()
+    
+    if remaining is None:
+        return StockLineResult(product_id=product_id, quantity=quantity, ok=False, error="Product not found")
+    return StockLineResult(product_id=product_id, quantity=quantity, ok=True, remaining=remaining)
+
 # ==========================================
 # ROUTES
 # ==========================================
@@ -237,7 +281,7 @@ async def create_product(
     db: Session = Depends(get_db)
 ):
     # Check quyền nhà hàng
-    user = await get_current_user(authorization)
+    user = await verify_token(authorization)
     if user["role"] != "restaurant":
         raise HTTPException(status_code=403, detail="Only restaurants can create products")
 
@@ -310,7 +354,7 @@ async def update_product(
     authorization: str = Header(None), # [Secure]
     db: Session = Depends(get_db)
 ):
-    user = await get_current_user(authorization)
+    user = await verify_token(authorization)
     product = db.query(Product).filter(Product.id == product_id).first()
     
     if not product:
@@ -337,7 +381,7 @@ async def delete_product(
     authorization: str = Header(None), # [Secure]
     db: Session = Depends(get_db)
 ):
-    user = await get_current_user(authorization)
+    user = await verify_token(authorization)
     product = db.query(Product).filter(Product.id == product_id).first()
     
     if not product: raise HTTPException(404, "Product not found")
@@ -353,19 +397,67 @@ async def delete_product(
 # 6. STOCK MANAGEMENT (Internal use mainly)
 @app.post("/products/{product_id}/decrease-stock")
 async def decrease_stock(product_id: int, quantity: int, db: Session = Depends(get_db)):
-    product = db.query(Product).filter(Product.id == product_id).first()
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
+    result = take_stock(db, product_id, quantity)
+    if not result.ok:
+        db.rollback()
+        raise HTTPException(status_code=404 if result.remaining is None else 400, detail=result.error)
     
-    if product.stock_quantity < quantity:
-        raise HTTPException(status_code=400, detail="Not enough stock")
+    db.commit()
+    return {"message": "Stock decreased", "remaining": result.remaining}
+
+@app.post("/products/stock/reserve", response_model=StockResponse)
+async def reserve_stock(
+    request: StockRequest,
+    authorization: str = Header(None),
+    db: Session = Depends(get_db)
+):
+    """
+    Trừ tồn kho cho nhiều product trong một transaction, all-or-nothing.
+    Thiếu hàng ở bất kỳ dòng nào -> rollback toàn bộ, trả 409 kèm kết quả từng dòng.
+    Chỉ service nội bộ (order_service) được gọi.
+    """
+    user = await verify_token(authorization)
+    if user['role'] != SERVICE_ROLE:
+        raise HTTPException(status_code=403, detail="Only internal services can reserve stock")
     
-    product.stock_quantity -= quantity
-    if product.stock_quantity == 0:
-        product.is_available = 0
+    results = [
+        take_stock(db, product_id, quantity)
+        for product_id, quantity in merge_stock_lines(request.items).items()
+    ]
+    if not all(r.ok for r in results):
+        db.rollback()
+        # Các dòng đã trừ trong transaction bị rollback
+        for r in results:
+            if r.ok:
+                r.ok, r.remaining = False, None
+        return JSONResponse(
+            status_code=409,
+            content=StockResponse(success=False, items=results).model_dump()
+        )
+    
+    db.commit()
+    return StockResponse(success=True, items=results)
+
+@app.post("/products/stock/release", response_model=StockResponse)
+async def release_stock(
+    request: StockRequest,
+    authorization: str = Header(None),
+    db: Session = Depends(get_db)
+):
+    """
+    Hoàn lại tồn kho đã reserve (vd tạo order thất bại). Product không tồn tại thì bỏ qua.
+    Chỉ service nội bộ (order_service) được gọi.
+    """
+    user = await verify_token(authorization)
+    if user['role'] != SERVICE_ROLE:
+        raise HTTPException(status_code=403, detail="Only internal services can release stock")
     
+    results = [
+        return_stock(db, product_id, quantity)
+        for product_id, quantity in merge_stock_lines(request.items).items()
+    ]
     db.commit()
-    return {"message": "Stock decreased", "remaining": product.stock_quantity}
+    return StockResponse(success=all(r.ok for r in results), items=results)
 
 # 7. GET BY RESTAURANT
 @app.get("/products/restaurant/{restaurant_id}", response_model=List[ProductResponse])
@@ -380,7 +472,7 @@ async def set_restaurant_hours(
     authorization: str = Header(None), # [Secure]
     db: Session = Depends(get_db)
 ):
-    user = await get_current_user(authorization)
+    user = await verify_token(authorization)
     # Check ID: Nhà hàng chỉ được sửa giờ của chính mình
     if user["user_id"] != hours.restaurant_id:
         raise HTTPException(403, "Can only update your own hours")
@@ -0,0 +1,133 @@
+import os
+import tempfile
+
+import pytest
+from fastapi.testclient import TestClient
+from jose import jwt
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db"))
+
+from common import auth
+
+# main.py tạo static/images theo cwd (container chạy trong thư mục service)
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp())
+try:
+    from product_service.main import Base, Product, SessionLocal, app, engine
+finally:
+    os.chdir(_cwd)
+
+
+client = TestClient(app)
+SERVICE_HEADERS = {"Authorization": auth.service_authorization("order_service")}
+
+
+@pytest.fixture(autouse=True)
+def tables():
+    Base.metadata.create_all(bind=engine)
+    yield
+    Base.metadata.drop_all(bind=engine)
+
+
+def add_product(stock):
+    db = SessionLocal()
+    try:
+        product = Product(restaurant_id=1, name="Pho", price=50000, stock_quantity=stock)
+        db.add(product)
+        db.commit()
+        return product.id
+    finally:
+        db.close()
+
+
+def stock_of(product_id):
+    db = SessionLocal()
+    try:
+        return db.get(Product, product_id).stock_quantity
+    finally:
+        db.close()
+
+
+def reserve(items, headers=SERVICE_HEADERS):
+    return client.post(
+        "/products/stock/reserve",
+        json={"items": [{"product_id": p, "quantity": q} for p, q in items]},
+        headers=headers,
+    )
+
+
+def test_reserve_all_lines():
+    a, b = add_product(5), add_product(3)
+    resp = reserve([(a, 2), (b, 3)])
+    assert resp.status_code == 200, resp.text
+    data = resp.json()
+    assert data["success"] is True
+    assert [(line["product_id"], line["ok"], line["remaining"]) for line in data["items"]] == [
+        (a, True, 3),
+        (b, True, 0),
+    ]
+    assert stock_of(a) == 3
+    assert stock_of(b) == 0
+
+
+def test_reserve_is_all_or_nothing():
+    a, b = add_product(5), add_product(1)
+    resp = reserve([(a, 2), (b, 4)])
+    assert resp.status_code == 409
+    data = resp.json()
+    assert data["success"] is False
+    lines = {line["product_id"]: line for line in data["items"]}
+    # Dòng đủ hàng cũng bị rollback
+    assert lines[a]["ok"] is False and lines[a]["error"] is None
+    assert lines[b]["ok"] is False
+    assert lines[b]["error"] == "Not enough stock"
+    assert lines[b]["remaining"] == 1
+    assert stock_of(a) == 5
+    assert stock_of(b) == 1
+
+
+def test_reserve_unknown_product():
+    a = add_product(5)
+    resp = reserve([(a, 1), (a + 100, 1)])
+    assert resp.status_code == 409
+    lines = {line["product_id"]: line for line in resp.json()["items"]}
+    assert lines[a + 100]["error"] == "Product not found"
+    assert stock_of(a) == 5
+
+
+def test_reserve_merges_duplicate_lines():
+    a = add_product(5)
+    resp = reserve([(a, 2), (a, 2)])
+    assert resp.status_code == 200
+    assert resp.json()["items"] == [
+        {"product_id": a, "quantity": 4, "ok": True, "remaining": 1, "error": None}
+    ]
+
+    assert reserve([(a, 1), (a, 1)]).status_code == 409
+    assert stock_of(a) == 1
+
+
+def test_release_returns_stock():
+    a = add_product(5)
+    assert reserve([(a, 3)]).status_code == 200
+    resp = client.post(
+        "/products/stock/release",
+        json={"items": [{"product_id": a, "quantity": 3}]},
+        headers=SERVICE_HEADERS,
+    )
+    assert resp.status_code == 200
+    assert resp.json()["success"] is True
+    assert stock_of(a) == 5
+
+
+def test_reserve_requires_service_role(monkeypatch):
+    async def profile(user_id, authorization):
+        return {"id": user_id, "role": "customer", "is_active": True}
+
+    monkeypatch.setattr(auth, "fetch_user_profile", profile)
+    token = jwt.encode({"sub": "alice", "user_id": 7, "role": "customer"}, auth.JWT_SECRET,
+                       algorithm=auth.JWT_ALGORITHM)
+    a = add_product(5)
+    resp = reserve([(a, 1)], headers={"Authorization": f"Bearer {token}"})
+    assert resp.status_code == 403
+    assert stock_of(a) == 5
@@ -11,6 +11,8 @@ import bcrypt
 from typing import Optional, List
 import os
 import time
+from common import metrics
+from common.auth import publish_user_invalidation
 # 👇👇👇 BẠN ĐANG THIẾU DÒNG QUAN TRỌNG NÀY 👇👇👇
 from pydantic import BaseModel, EmailStr
 # ==========================================
@@ -110,6 +112,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+metrics.install(app, engine=engine)
 
 def get_db():
     db = SessionLocal()
@@ -336,7 +339,8 @@ async def verify_user_token(token_data: dict = Depends(verify_token), db: Sessio
         "username": user.username,
         "email": user.email,
         "role": user.role,
-        "full_name": user.full_name
+        "full_name": user.full_name,
+        "is_active": bool(user.is_active)
     }
 
 # --- ADMIN ---
@@ -431,6 +435,8 @@ async def update_profile(
     if address: user.address = address
     db.commit()
     db.refresh(user)
+    # Profile đang được cache ở các service khác (common.auth)
+    await publish_user_invalidation(user.id)
     return user
 
 